@@ -1,13 +1,24 @@
+import io
+import hashlib
 import os
-import json
+import orjson
+import asyncio
+import collections
+import functools
+import threading
 import traceback
 import sys
 import uuid
 import os.path
 import time
 import locale
-from urllib.parse import quote
-from typing import List, Dict, Any, Optional, Union
+import logging
+from contextlib import asynccontextmanager
+from urllib.parse import unquote
+from typing import List, Dict, Any, Optional, Union, NoReturn
+
+import aiofiles
+import anyio.to_thread
 
 
 # 设置默认编码为UTF-8
@@ -25,11 +36,16 @@ if sys.platform.startswith('win'):
 print(f"系统默认编码: {locale.getpreferredencoding()}")
 print(f"Python默认编码: {sys.getdefaultencoding()}")
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Body, Request, BackgroundTasks
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Body, Request, BackgroundTasks, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse, ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
+
+logger = logging.getLogger("api")
+logger.setLevel(os.getenv("LOG_LEVEL", "WARNING").upper())
 
 # 确保当前目录在sys.path中
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -38,16 +54,195 @@ if parent_dir not in sys.path:
     sys.path.append(parent_dir)
 
 from main import RAGService, DocumentProcessor
-# 添加进度跟踪字典
+# 任务进度存储
 # 格式: {task_id: {"status": "processing/completed/failed", "progress": 0-100, "message": "处理中..."}}
+# 配置了REDIS_URL时存放在Redis中（多worker共享，带过期时间），否则退化为进程内字典
+TASK_TTL = 3600
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = None
+if REDIS_URL:
+    try:
+        import redis.asyncio as aioredis
+        redis_client = aioredis.Redis.from_url(REDIS_URL, decode_responses=True)
+    except ImportError:
+        logger.warning("未安装redis，任务进度和接口缓存将保存在进程内存中")
 processing_tasks = {}
 
+def _task_key(task_id: str) -> str:
+    return f"task:{task_id}"
+
+async def set_task(task_id: str, data: Dict[str, Any]):
+    """覆盖写入任务状态"""
+    if redis_client is None:
+        processing_tasks[task_id] = dict(data)
+        return
+    key = _task_key(task_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, mapping=data)
+        pipe.expire(key, TASK_TTL)
+        await pipe.execute()
+
+async def update_task(task_id: str, **fields):
+    """更新任务状态中的部分字段"""
+    if redis_client is None:
+        if task_id in processing_tasks:
+            processing_tasks[task_id].update(fields)
+        return
+    await redis_client.hset(_task_key(task_id), mapping=fields)
+
+async def incr_task_progress(task_id: str, delta: int, message: Optional[str] = None):
+    """原子地增加任务进度，供并发处理的多个文件共同累加"""
+    if redis_client is None:
+        task = processing_tasks.get(task_id)
+        if task is not None:
+            task["progress"] = task.get("progress", 0) + delta
+            if message is not None:
+                task["message"] = message
+        return
+    key = _task_key(task_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hincrby(key, "progress", delta)
+        if message is not None:
+            pipe.hset(key, "message", message)
+        await pipe.execute()
+
+async def get_task(task_id: str) -> Optional[Dict[str, Any]]:
+    """读取任务状态，不存在时返回None"""
+    if redis_client is None:
+        return processing_tasks.get(task_id)
+    data = await redis_client.hgetall(_task_key(task_id))
+    if not data:
+        return None
+    data["progress"] = int(data.get("progress", 0))
+    return data
+
+class _LocalCache:
+    """进程内缓存，按条目数和（可选）序列化后的总字节数限制容量，超出时淘汰最早写入的条目"""
+    
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # 键 -> (过期时间, 序列化后的字节)
+        self.total_bytes = 0
+    
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self.pop(key)
+            return None
+        return entry[1]
+    
+    def set(self, key: str, data: bytes, ttl: int):
+        self.pop(key)
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            # 单条超过容量上限时不缓存，避免把其他条目全部挤出
+            return
+        self.entries[key] = (time.monotonic() + ttl, data)
+        self.total_bytes += len(data)
+        while len(self.entries) > self.max_entries or (
+                self.max_bytes is not None and self.total_bytes > self.max_bytes):
+            self.pop(next(iter(self.entries)))
+    
+    def pop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[1])
+
+# 读多写少接口的响应缓存（cache-aside），未配置Redis时使用有容量上限的进程内缓存
+# 缓存值统一以orjson序列化后的字节保存，取出时得到的是独立的新对象
+RESPONSE_CACHE_MAX = 256
+response_cache = _LocalCache(RESPONSE_CACHE_MAX)
+# 文件解析/分块结果体积大，进程内使用独立的、按总字节数限制容量的缓存，不与接口响应互相挤占
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+document_cache = _LocalCache(RESPONSE_CACHE_MAX, max_bytes=DOCUMENT_CACHE_MAX_BYTES)
+
+async def cache_get(key: str, local: _LocalCache = response_cache):
+    if redis_client is None:
+        value = local.get(key)
+    else:
+        value = await redis_client.get(key)
+    return orjson.loads(value) if value else None
+
+async def cache_set(key: str, value, ttl: int, local: _LocalCache = response_cache):
+    data = orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    if redis_client is None:
+        local.set(key, data, ttl)
+        return
+    await redis_client.set(key, data, ex=ttl)
+
+async def cache_delete(*keys: str):
+    if redis_client is None:
+        for key in keys:
+            response_cache.pop(key)
+        return
+    await redis_client.delete(*keys)
+
+# 文件解析/分块结果按扩展名和内容哈希缓存，相同文件重复上传时跳过解析（文件按扩展名分派解析方式）
+EXTRACT_CACHE_TTL = 7 * 24 * 3600
+
+def _file_digest(path: str) -> str:
+    """计算文件内容的blake2b摘要"""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _rebind_chunks(chunks: List[Dict[str, Any]], file_name: str, temp_path: str) -> List[Dict[str, Any]]:
+    """
+    把分块的文件相关元数据改写为本次上传的原始文件名
+    
+    临时文件只以uuid命名，知识库的文件注册表按元数据中的file_path登记文件，
+    因此这里用原始文件名替换临时路径，document_id保留唯一的临时文件名
+    """
+    document_id = os.path.basename(temp_path)
+    for chunk in chunks:
+        metadata = chunk.setdefault("metadata", {})
+        metadata["file_name"] = file_name
+        metadata["file_path"] = file_name
+        metadata["document_id"] = document_id
+    return chunks
+
+async def invalidate_kb_cache(kb_name: str, kb_list: bool = False):
+    """知识库内容变更后清除相关缓存；kb_list为True时同时清除知识库列表缓存"""
+    keys = [f"kb:info:{kb_name}", f"kb:files:{kb_name}"]
+    if kb_list:
+        keys.append("kb:list")
+    await cache_delete(*keys)
+
+def cached(key_fn, ttl: int = 30):
+    """
+    缓存接口返回值的装饰器，异常（包括HTTPException）不会被缓存
+    
+    参数:
+        key_fn: 根据接口参数生成缓存键的函数
+        ttl: 缓存过期时间（秒）
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrap(*args, **kwargs):
+            key = key_fn(*args, **kwargs)
+            value = await cache_get(key)
+            if value is not None:
+                return value
+            result = await fn(*args, **kwargs)
+            await cache_set(key, result, ttl)
+            return result
+        return wrap
+    return deco
+
 # # 导入DeepSeek LLM模型
 # from core.llm.local_llm_model import get_llm_model
 # 使用openai接口
 from core.llm.openai_llm_model import get_openai_model as get_llm_model
 from core.chunker.chunker_main import ChunkMethod
 
+# 分块方法集合在运行期不变，导入时计算一次
+CHUNK_METHODS = ChunkMethod.values() if hasattr(ChunkMethod, 'values') else [m.value for m in ChunkMethod]
+
 # 定义API模型
 class KnowledgeBaseCreate(BaseModel):
     kb_name: str
@@ -71,6 +266,40 @@ class ChunkConfig(BaseModel):
     headers_to_split_on: Optional[List[Dict]] = None
     separators: Optional[List[str]] = None
 
+class ChunkConfigForm(BaseModel):
+    """上传/替换文件时的分块配置，直接由multipart表单字段解析"""
+    model_config = ConfigDict(from_attributes=True)
+    
+    method: str = "text_semantic"
+    chunk_size: int = Field(1000, gt=0)
+    chunk_overlap: int = Field(200, ge=0)
+    
+    @field_validator("method")
+    @classmethod
+    def check_method(cls, v: str) -> str:
+        if v not in CHUNK_METHODS:
+            raise ValueError(f"不支持的分块方法: {v}")
+        return v
+    
+    @model_validator(mode="after")
+    def check_overlap(self):
+        if self.chunk_overlap >= self.chunk_size:
+            raise ValueError(f"块重叠大小必须小于块大小: {self.chunk_overlap}")
+        return self
+    
+    @classmethod
+    def as_form(
+        cls,
+        method: str = Form("text_semantic"),
+        chunk_size: int = Form(1000),
+        chunk_overlap: int = Form(200)
+    ) -> "ChunkConfigForm":
+        """作为Depends依赖使用，校验失败时返回422"""
+        try:
+            return cls(method=method, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors(include_url=False, include_context=False))
+
 # 添加文件管理相关模型
 class FileInfo(BaseModel):
     kb_name: str
@@ -85,8 +314,23 @@ class ChatQuery(BaseModel):
     top_k: int = 3
     temperature: float = 0.1
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用启动时初始化RAG服务和文件处理器，整个进程生命周期内复用"""
+    # 同步的检索/分块/入库调用都在线程池中执行，按CPU核数放大线程池容量
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 2 * (os.cpu_count() or 1)
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    app.state.rag = RAGService()
+    app.state.doc = DocumentProcessor()
+    yield
+
 # 初始化FastAPI应用
-app = FastAPI(title="知识库管理API", description="提供知识库管理和检索的RESTful API")
+app = FastAPI(
+    title="知识库管理API",
+    description="提供知识库管理和检索的RESTful API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # 添加CORS中间件
 app.add_middleware(
@@ -97,11 +341,123 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 同时处理（解析+分块）的上传文件数上限
+UPLOAD_SEM = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_FILES", os.cpu_count() or 1)))
+# 同时生成向量并入库的请求数上限，单GPU时保持为1，使向量计算串行化
+EMBED_SEM = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_EMBED", 1)))
+
+# 上传文件的临时目录，在应用启动时创建一次
+TEMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp_files")
+
+@asynccontextmanager
+async def temp_upload(suffix: str = ""):
+    """
+    分配一个唯一的临时文件路径，退出时（无论成功与否）在线程池中删除该文件
+    
+    参数:
+        suffix: 追加在uuid之后的文件名后缀，一般为原文件的扩展名
+    """
+    path = os.path.join(TEMP_DIR, f"{uuid.uuid4().hex}{suffix}")
+    try:
+        yield path
+    finally:
+        await asyncio.to_thread(lambda: os.path.exists(path) and os.remove(path))
 
+def _sendfile_upload(src, path: str) -> Optional[int]:
+    """
+    使用os.sendfile在内核中把已落盘的上传文件复制到path
+    
+    返回:
+        写入的字节数；平台不支持或上传内容仍在内存中时返回None
+    """
+    # SpooledTemporaryFile未落盘时没有真实的文件描述符，这种小文件直接走普通写入
+    if not hasattr(os, "sendfile") or not getattr(src, "_rolled", True):
+        return None
+    try:
+        src_fd = src.fileno()
+        size = os.fstat(src_fd).st_size
+        with open(path, "wb") as dst:
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        return offset
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
 
-# 初始化RAG服务和文件处理器
-rag_service = None
-document_processor = None
+class BufPool:
+    """进程内复用的64KB读缓冲区池，避免流式复制时每个分块都分配新的bytes"""
+    BUF_SIZE = 1 << 16
+    _pool = collections.deque(maxlen=256)
+
+    @classmethod
+    def get(cls) -> bytearray:
+        try:
+            return cls._pool.popleft()
+        except IndexError:
+            return bytearray(cls.BUF_SIZE)
+
+    @classmethod
+    def put(cls, buf: bytearray):
+        if len(cls._pool) < cls._pool.maxlen:
+            cls._pool.append(buf)
+
+async def save_upload(file: UploadFile, path: str) -> int:
+    """将上传文件写入path（优先零拷贝，否则分块流式写入），返回写入的字节数"""
+    total = await anyio.to_thread.run_sync(_sendfile_upload, file.file, path)
+    if total is not None:
+        return total
+    
+    src = file.file
+    if not hasattr(src, "readinto"):
+        total = 0
+        async with aiofiles.open(path, "wb") as out:
+            while chunk := await file.read(BufPool.BUF_SIZE):
+                await out.write(chunk)
+                total += len(chunk)
+        return total
+    
+    # 已落盘的上传文件读取会阻塞，放到线程中执行；仍在内存中的直接读取
+    on_disk = getattr(src, "_rolled", True)
+    buf = BufPool.get()
+    view = memoryview(buf)
+    total = 0
+    try:
+        async with aiofiles.open(path, "wb") as out:
+            while True:
+                if on_disk:
+                    n = await anyio.to_thread.run_sync(src.readinto, buf)
+                else:
+                    n = src.readinto(buf)
+                if not n:
+                    break
+                await out.write(view[:n])
+                total += n
+    finally:
+        view.release()
+        BufPool.put(buf)
+    return total
+
+def handle_exc(e: Exception, msg: str) -> NoReturn:
+    """
+    统一处理接口异常：HTTPException原样抛出，其他异常记录日志后转换为500错误
+    
+    堆栈只写入日志（由logging按级别决定是否格式化），不再返回给客户端
+    """
+    if isinstance(e, HTTPException):
+        raise e
+    logger.exception(msg)
+    raise HTTPException(status_code=500, detail=f"{msg}: {str(e)}")
+
+def get_rag(request: Request) -> RAGService:
+    """依赖注入：获取共享的RAG服务"""
+    return request.app.state.rag
+
+def get_doc(request: Request) -> DocumentProcessor:
+    """依赖注入：获取共享的文件处理器"""
+    return request.app.state.doc
 
 # 定义一个模拟的ChunkMethod类，用于在导入失败时提供备选方案
 class MockChunkMethod:
@@ -113,268 +469,230 @@ class MockChunkMethod:
 
 
 @app.post("/kb/create")
-async def create_knowledge_base(kb_data: KnowledgeBaseCreate):
+async def create_knowledge_base(kb_data: KnowledgeBaseCreate, rag_service: RAGService = Depends(get_rag)):
     """创建新的知识库"""
     try:
-        global rag_service
-        if not rag_service:
-            rag_service = RAGService()
-            
-        success = rag_service.create_knowledge_base(
+        success = await run_in_threadpool(
+            rag_service.create_knowledge_base,
             kb_data.kb_name, 
             kb_data.dimension, 
             kb_data.index_type
         )
         if success:
+            await invalidate_kb_cache(kb_data.kb_name, kb_list=True)
             return {"status": "success", "message": f"成功创建知识库：{kb_data.kb_name}"}
         else:
             raise HTTPException(status_code=400, detail=f"创建知识库失败，可能已存在同名知识库：{kb_data.kb_name}")
     except Exception as e:
-        error_trace = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"创建知识库失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "创建知识库失败")
 
 @app.get("/kb/list")
-async def list_knowledge_bases():
+@cached(lambda **kw: "kb:list")
+async def list_knowledge_bases(rag_service: RAGService = Depends(get_rag)):
     """获取所有知识库列表"""
     try:
-        global rag_service
-        if not rag_service:
-            rag_service = RAGService()
-            
-        kb_list = rag_service.list_knowledge_bases()
+        kb_list = await run_in_threadpool(rag_service.list_knowledge_bases)
         return {"status": "success", "data": kb_list}
     except Exception as e:
-        error_trace = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"获取知识库列表失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "获取知识库列表失败")
 
 @app.get("/kb/info/{kb_name}")
-async def get_knowledge_base_info(kb_name: str):
+@cached(lambda **kw: f"kb:info:{kw['kb_name']}")
+async def get_knowledge_base_info(kb_name: str, rag_service: RAGService = Depends(get_rag)):
     """获取指定知识库的信息"""
     try:
-        global rag_service
-        if not rag_service:
-            rag_service = RAGService()
-            
-        info = rag_service.get_knowledge_base_info(kb_name)
+        info = await run_in_threadpool(rag_service.get_knowledge_base_info, kb_name)
         if info:
             return {"status": "success", "data": info}
         else:
             raise HTTPException(status_code=404, detail=f"知识库 {kb_name} 不存在")
     except Exception as e:
-        error_trace = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"获取知识库信息失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "获取知识库信息失败")
 
 @app.delete("/kb/delete/{kb_name}")
-async def delete_knowledge_base(kb_name: str):
+async def delete_knowledge_base(kb_name: str, rag_service: RAGService = Depends(get_rag)):
     """删除指定的知识库"""
     try:
-        global rag_service
-        if not rag_service:
-            rag_service = RAGService()
-            
-        success = rag_service.delete_knowledge_base(kb_name)
+        success = await run_in_threadpool(rag_service.delete_knowledge_base, kb_name)
         if success:
+            await invalidate_kb_cache(kb_name, kb_list=True)
             return {"status": "success", "message": f"成功删除知识库：{kb_name}"}
         else:
             raise HTTPException(status_code=404, detail=f"知识库 {kb_name} 不存在")
     except Exception as e:
-        error_trace = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"删除知识库失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "删除知识库失败")
 
 @app.get("/kb/progress/{task_id}")
 async def get_processing_progress(task_id: str):
     """获取任务处理进度"""
-    if task_id not in processing_tasks:
+    data = await get_task(task_id)
+    if data is None:
         raise HTTPException(status_code=404, detail=f"任务ID {task_id} 不存在")
     
     return {
         "status": "success",
-        "data": processing_tasks[task_id]
+        "data": data
     }
 
 @app.post("/kb/upload")
 async def upload_files(
     kb_name: str = Form(...),
     files: List[UploadFile] = File(...),
-    chunk_config: str = Form("{}")
+    chunk_config: ChunkConfigForm = Depends(ChunkConfigForm.as_form),
+    rag_service: RAGService = Depends(get_rag)
 ):
     """上传文件到知识库"""
+    # 在处理任何上传内容之前先完成廉价的校验
+    chunk_method, chunk_size, chunk_overlap = chunk_config.method, chunk_config.chunk_size, chunk_config.chunk_overlap
+    logger.debug(f"分块配置: 方法={chunk_method}, 大小={chunk_size}, 重叠={chunk_overlap}")
+    if not rag_service.kb_exists(kb_name):
+        raise HTTPException(status_code=404, detail=f"知识库 {kb_name} 不存在")
+    
     try:
-        # 检查必要的组件是否初始化
-        global rag_service, document_processor
-        if not rag_service:
-            rag_service = RAGService()
-        if not document_processor:
-            document_processor = DocumentProcessor()
-            
         task_id = str(uuid.uuid4())
-        processing_tasks[task_id] = {
+        await set_task(task_id, {
             "status": "processing", 
             "progress": 0, 
             "message": "准备处理文件..."
-        }
-        
-        print(f"开始处理上传任务: {task_id}, 知识库: {kb_name}")
-        print(f"文件数量: {len(files)}")
-        for i, file in enumerate(files):
-            print(f"文件 {i+1}: {file.filename}, 类型: {file.content_type}")
-        
-        # 解析分块配置
-        config = json.loads(chunk_config)
-        chunk_method = config.get("method", "text_semantic")
-        chunk_size = config.get("chunk_size", 1000)
-        chunk_overlap = config.get("chunk_overlap", 200)
+        })
         
-        print(f"分块配置: 方法={chunk_method}, 大小={chunk_size}, 重叠={chunk_overlap}")
+        # 确保只使用文件名，而不是完整路径（忽略任何路径），每个文件只提取一次
+        filenames = [os.path.basename(file.filename) for file in files]
+        logger.info(f"开始处理上传任务: {task_id}, 知识库: {kb_name}, 文件数量: {len(files)}")
         
         total_docs = 0
         failed_files = []
         total_files = len(files)
         
-        for file_index, file in enumerate(files):
-            temp_file_path = None
-            try:
-                # 更新处理进度
-                file_progress = int((file_index / total_files) * 100)
-                processing_tasks[task_id] = {
-                    "status": "processing", 
-                    "progress": file_progress, 
-                    "message": f"处理文件 {file_index+1}/{total_files}: {file.filename}"
-                }
-                
-                print(f"开始处理文件 {file_index+1}/{total_files}: {file.filename}")
-                
-                # 修改这里：确保只使用文件名，而不是完整路径
-                # 从原始文件名中提取文件名部分（忽略任何路径）
-                orig_filename = os.path.basename(file.filename)
-                safe_filename = orig_filename
-                
-                temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp_files")
-                os.makedirs(temp_dir, exist_ok=True)
-                
-                # 使用uuid生成唯一临时文件名，避免冲突
-                temp_file_path = os.path.join(temp_dir, f"{uuid.uuid4()}_{safe_filename}")
-                
-                # 打印文件信息
-                print(f"原始文件名: {file.filename}")
-                print(f"提取的文件名: {orig_filename}")
-                print(f"安全处理后文件名: {safe_filename}")
-                print(f"临时文件路径: {temp_file_path}")
-                
-                # 读取整个文件内容（只读取一次）
-                file_content = await file.read()
-                # print(4444, file_content)
-                # 检查文件是否为空
-                if not file_content or len(file_content) == 0:
-                    error_msg = f"文件 {orig_filename} 为空，跳过处理"
-                    print(error_msg)
-                    failed_files.append(f"{orig_filename} (文件为空)")
-                    processing_tasks[task_id]["message"] = error_msg
-                    continue
-                
-                print(f"文件 '{orig_filename}' 大小: {len(file_content)} 字节")
-                
-                # 直接将文件内容写入临时文件
-                print(f"写入临时文件: {temp_file_path}")
-                with open(temp_file_path, "wb") as temp_file:
-                    temp_file.write(file_content)
-                
-                # 确认文件写入成功
-                if not os.path.exists(temp_file_path):
-                    error_msg = f"临时文件创建失败: {temp_file_path}"
-                    print(error_msg)
-                    failed_files.append(f"{orig_filename} (临时文件创建失败)")
-                    continue
-                
-                temp_file_size = os.path.getsize(temp_file_path)
-                if temp_file_size == 0:
-                    error_msg = f"临时文件为空: {temp_file_path}"
-                    print(error_msg)
-                    failed_files.append(f"{orig_filename} (临时文件为空)")
-                    if os.path.exists(temp_file_path):
-                        os.remove(temp_file_path)
-                    continue
-                
-                print(f"临时文件写入成功，大小: {temp_file_size} 字节")
+        loop = asyncio.get_running_loop()
+        
+        async def _process_one(file, file_index, orig_filename):
+            """
+            处理单个上传文件：读取、写入临时文件、分块、清理（入库在所有文件分块完成后批量进行）
+            
+            返回:
+                (分块后的文档列表, 失败说明)
+            """
+            # 限制同时处理的文件数，避免大量文件同时占满线程池和内存
+            async with UPLOAD_SEM:
+                # 各文件并发执行，每个文件按自身进度(0-100)折算后累加到总进度(0-90)
+                reported = 0
+            
+                def _progress_delta(progress):
+                    nonlocal reported
+                    target = int(progress * 90 / (100 * total_files))
+                    delta, reported = target - reported, max(reported, target)
+                    return max(delta, 0)
+            
+                try:
+                    await update_task(task_id, message=f"处理文件 {file_index+1}/{total_files}: {orig_filename}")
                 
-                # 定义进度回调函数
-                def update_progress(progress, message):
-                    # 计算总进度：文件进度(0-90) + 当前文件处理进度(最后10%)
-                    file_base_progress = int((file_index / total_files) * 90)
-                    current_progress = int(progress * 0.1)  # 当前文件进度占总进度的10%
-                    total_progress = file_base_progress + current_progress
+                    # 临时文件只用uuid加扩展名命名，避免冲突和过长路径；退出时自动删除
+                    async with temp_upload(os.path.splitext(orig_filename)[1].lower()) as temp_file_path:
+                        logger.debug(f"开始处理文件 {file_index+1}/{total_files}: {orig_filename}, 临时文件路径: {temp_file_path}")
                     
-                    processing_tasks[task_id] = {
-                        "status": "processing", 
-                        "progress": total_progress, 
-                        "message": message
-                    }
-                
-                # 使用DocumentProcessor处理文件
-                processing_tasks[task_id]["message"] = f"处理文件 {orig_filename}..."
-                print(f"使用DocumentProcessor处理文件: {temp_file_path}")
-                
-                try:
-                    # 使用DocumentProcessor处理文件
-                    document = document_processor.process_document(
-                        file_path=temp_file_path,
-                        chunk_method=chunk_method,
-                        chunk_size=chunk_size,
-                        chunk_overlap=chunk_overlap,
-                        progress_callback=update_progress
-                    )
-                    # 使用RAGService添加文档到知识库
-                    processing_tasks[task_id]["message"] = f"添加文件 {orig_filename} 到知识库..."
-                    success = rag_service.add_documents(
-                        kb_name=kb_name,
-                        documents=document
-                    )
+                        # 分块流式写入临时文件，避免整个文件驻留内存
+                        total = await save_upload(file, temp_file_path)
+                        # 检查文件是否为空
+                        if total == 0:
+                            error_msg = f"文件 {orig_filename} 为空，跳过处理"
+                            logger.warning(error_msg)
+                            await update_task(task_id, message=error_msg)
+                            return None, f"{orig_filename} (文件为空)"
                     
-                    if success:
-                        print(f"文件 {orig_filename} 处理并添加成功")
-                        total_docs += 1  # 增加成功处理的文档计数
-                    else:
-                        print(f"文件 {orig_filename} 添加到知识库失败")
-                        failed_files.append(f"{orig_filename} (添加到知识库失败)")
-                except Exception as e:
-                    print(f"处理并添加文档时出错: {str(e)}")
-                    traceback.print_exc()
-                    failed_files.append(f"{orig_filename} (处理错误: {str(e)})")
-                
-                # 清理临时文件
-                if temp_file_path and os.path.exists(temp_file_path):
-                    try:
-                        os.remove(temp_file_path)
-                        print(f"临时文件已删除: {temp_file_path}")
-                    except Exception as e:
-                        print(f"删除临时文件时出错: {str(e)}")
+                        logger.debug(f"临时文件写入成功，大小: {total} 字节")
+                    
+                        # 定义进度回调函数（在工作线程中调用，提交到事件循环原子累加进度）
+                        def update_progress(progress, message):
+                            asyncio.run_coroutine_threadsafe(
+                                incr_task_progress(task_id, _progress_delta(progress), message), loop
+                            )
+                    
+                        await update_task(task_id, message=f"处理文件 {orig_filename}...")
+                    
+                        try:
+                            digest = await asyncio.to_thread(_file_digest, temp_file_path)
+                            suffix = os.path.splitext(orig_filename)[1].lower()
+                            cache_key = f"chunks:{suffix}:{digest}:{chunk_method}:{chunk_size}:{chunk_overlap}"
+                            cached_document = await cache_get(cache_key, document_cache)
+                            if cached_document:
+                                logger.debug(f"文件 {orig_filename} 命中分块缓存")
+                                return _rebind_chunks(cached_document, orig_filename, temp_file_path), None
+                        
+                            # process_document 会临时修改分块器配置，每个并发任务使用独立的处理器
+                            processor = DocumentProcessor(
+                                chunk_method=chunk_method,
+                                chunk_size=chunk_size,
+                                chunk_overlap=chunk_overlap
+                            )
+                            document = await run_in_threadpool(
+                                processor.process_document,
+                                file_path=temp_file_path,
+                                chunk_method=chunk_method,
+                                chunk_size=chunk_size,
+                                chunk_overlap=chunk_overlap,
+                                progress_callback=update_progress
+                            )
+                            logger.debug(f"文件 {orig_filename} 分块完成")
+                            # process_document 出错时返回空列表，不能当作处理成功
+                            if not document:
+                                logger.warning(f"文件 {orig_filename} 未提取到任何内容")
+                                return None, f"{orig_filename} (无法提取内容)"
+                            await cache_set(cache_key, document, EXTRACT_CACHE_TTL, document_cache)
+                            return _rebind_chunks(document, orig_filename, temp_file_path), None
+                        except Exception as e:
+                            logger.exception(f"处理文件 {orig_filename} 时出错: {str(e)}")
+                            return None, f"{orig_filename} (处理错误: {str(e)})"
             
-            except Exception as e:
-                error_trace = traceback.format_exc()
-                error_msg = f"处理文件 {file.filename} 时发生未捕获的异常: {str(e)}"
-                print(f"{error_msg}\n{error_trace}")
-                # 使用提取的文件名报告错误
-                orig_filename = os.path.basename(file.filename)
-                failed_files.append(f"{orig_filename} (错误: {str(e)})")
-                
-                # 确保清理临时文件
-                if temp_file_path and os.path.exists(temp_file_path):
-                    try:
-                        os.remove(temp_file_path)
-                        print(f"清理临时文件: {temp_file_path}")
-                    except:
-                        pass
+                except Exception as e:
+                    logger.exception(f"处理文件 {orig_filename} 时发生未捕获的异常: {str(e)}")
+                    return None, f"{orig_filename} (错误: {str(e)})"
+        
+        
+        # 所有文件并发处理，总耗时趋近于最慢的单个文件
+        results = await asyncio.gather(
+            *[_process_one(file, file_index, orig_filename)
+              for file_index, (file, orig_filename) in enumerate(zip(files, filenames))],
+            return_exceptions=True
+        )
+        
+        processed_names = []
+        processed_docs = []
+        for orig_filename, result in zip(filenames, results):
+            if isinstance(result, BaseException):
+                failed_files.append(f"{orig_filename} (错误: {str(result)})")
+                continue
+            document, failure = result
+            if failure:
+                failed_files.append(failure)
+            else:
+                processed_names.append(orig_filename)
+                processed_docs.append(document)
+        
+        # 所有文件的分块一次性批量生成向量并写入知识库
+        if processed_docs:
+            await update_task(task_id, message=f"添加 {len(processed_docs)} 个文件到知识库...")
+            async with EMBED_SEM:
+                added = await run_in_threadpool(rag_service.add_documents_bulk, kb_name, processed_docs)
+            await invalidate_kb_cache(kb_name)
+            for orig_filename, success in zip(processed_names, added):
+                if success:
+                    logger.debug(f"文件 {orig_filename} 处理并添加成功")
+                    total_docs += 1  # 增加成功处理的文档计数
+                else:
+                    logger.warning(f"文件 {orig_filename} 添加到知识库失败")
+                    failed_files.append(f"{orig_filename} (添加到知识库失败)")
         
         # 更新处理完成状态
-        processing_tasks[task_id] = {
+        await set_task(task_id, {
             "status": "completed", 
             "progress": 100, 
             "message": "处理完成"
-        }
-        print(f"任务 {task_id} 处理完成")
+        })
+        logger.info(f"任务 {task_id} 处理完成")
         
         if failed_files:
-            print(f"部分文件处理失败: {failed_files}")
+            logger.warning(f"部分文件处理失败: {failed_files}")
             return {
                 "status": "partial_success",
                 "message": f"成功添加 {total_docs} 个文档，但以下文件处理失败：",
@@ -382,35 +700,27 @@ async def upload_files(
                 "task_id": task_id
             }
         else:
-            print(f"所有文件处理成功")
             return {
                 "status": "success",
                 "message": f"成功添加 {total_docs} 个文档到知识库 {kb_name}",
                 "task_id": task_id
             }
     except Exception as e:
-        error_trace = traceback.format_exc()
-        error_msg = f"文件上传处理失败: {str(e)}"
-        print(f"{error_msg}\n{error_trace}")
-        
-        if 'task_id' in locals() and task_id in processing_tasks:
-            processing_tasks[task_id] = {
+        if 'task_id' in locals():
+            await set_task(task_id, {
                 "status": "failed", 
                 "progress": 0, 
                 "message": f"处理失败: {str(e)}"
-            }
+            })
         
-        raise HTTPException(status_code=500, detail=f"上传文件失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "上传文件失败")
 
 @app.post("/kb/search")
-async def search_knowledge_base(query: SearchQuery):
+async def search_knowledge_base(query: SearchQuery, rag_service: RAGService = Depends(get_rag)):
     """在知识库中搜索内容"""
     try:
-        global rag_service
-        if not rag_service:
-            rag_service = RAGService()
-            
-        results = rag_service.search(
+        results = await run_in_threadpool(
+            rag_service.search,
             query.kb_name,
             query.query,
             query.top_k,
@@ -430,148 +740,96 @@ async def search_knowledge_base(query: SearchQuery):
             "data": results
         }
     except Exception as e:
-        error_trace = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"搜索知识库失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "搜索知识库失败")
 
 @app.post("/kb/delete_documents")
 async def delete_documents(
     kb_name: str = Body(...),
-    filter_criteria: str = Body(...)
+    filter_criteria: str = Body(...),
+    rag_service: RAGService = Depends(get_rag)
 ):
     """根据过滤条件删除知识库中的文档"""
     try:
-        global rag_service
-        if not rag_service:
-            rag_service = RAGService()
-            
         if not filter_criteria:
             raise HTTPException(status_code=400, detail="必须提供过滤条件")
         
-        result = rag_service.delete_documents(kb_name, filter_criteria)
+        result = await run_in_threadpool(rag_service.delete_documents, kb_name, filter_criteria)
+        await invalidate_kb_cache(kb_name)
         
         return {
             "status": "success",
             "message": f"成功从知识库 {kb_name} 中删除 {result.get('deleted', 0)} 个文档"
         }
     except Exception as e:
-        error_trace = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"删除文档失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "删除文档失败")
 
 
 @app.get("/chunker/methods")
+@cached(lambda **kw: "chunker:methods", ttl=86400)
 async def get_chunker_methods():
     """获取所有可用的分块方法"""
-    try:
-        # 定义一个模拟的ChunkMethod类，作为后备方案
-        
-        ChunkMethod = ChunkMethod
-            
-        if hasattr(ChunkMethod, 'values'):
-            methods = ChunkMethod.values()
-        else:
-            methods = [method.value for method in ChunkMethod]
-            
-        return {
-            "status": "success",
-            "data": methods
-        }
-    except Exception as e:
-        error_trace = traceback.format_exc()
-        print(f"获取分块方法失败: {str(e)}")
-        print(error_trace)
-        # 提供一个后备方案
-        return {
-            "status": "success",
-            "message": "使用默认分块方法",
-            "data": ["text_semantic", "semantic", "hierarchical", "markdown_header", "recursive_character", "bm25"]
-        }
+    return {
+        "status": "success",
+        "data": CHUNK_METHODS
+    }
 
 @app.post("/extract_text_from_file")
-async def extract_text_from_file(file: UploadFile = File(...)):
+async def extract_text_from_file(file: UploadFile = File(...), document_processor: DocumentProcessor = Depends(get_doc)):
     """
     从文件中提取文本，不进行分块
     """
     try:
-        global document_processor
-        if not document_processor:
-            document_processor = DocumentProcessor()
-            
         # 从原始文件名中提取文件名部分（忽略任何路径）
         orig_filename = os.path.basename(file.filename)
-        print(f"开始处理文件: {orig_filename}")
-        
-        # 为每个文件创建唯一的临时文件名
-        safe_filename = quote(orig_filename)
-        temp_filename = f"temp_{str(uuid.uuid4())}_{safe_filename}"
-        
-        # 创建temp_files目录（如果不存在）
-        temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp_files")
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_path = os.path.join(temp_dir, temp_filename)
-        
-        # 一次性读取整个文件内容
-        file_content = await file.read()
-        
-        # 检查文件是否为空
-        if not file_content or len(file_content) == 0:
-            print(f"警告: 上传的文件 '{orig_filename}' 内容为空")
-            raise HTTPException(status_code=400, detail=f"上传的文件内容为空: {orig_filename}")
-        
-        print(f"文件 '{orig_filename}' 大小: {len(file_content)} 字节")
-        
-        # 保存临时文件
-        with open(temp_path, "wb") as f:
-            f.write(file_content)
-        
-        # 检查保存的临时文件是否存在
-        if not os.path.exists(temp_path):
-            print(f"错误: 临时文件未成功创建: {temp_path}")
-            raise HTTPException(status_code=500, detail=f"临时文件创建失败: {temp_path}")
-        
-        # 检查临时文件大小
-        temp_file_size = os.path.getsize(temp_path)
-        if temp_file_size == 0:
-            print(f"错误: 保存的临时文件为空: {temp_path}")
-            os.remove(temp_path)  # 清理空文件
-            raise HTTPException(status_code=500, detail=f"临时文件为空: {temp_path}")
-        
-        print(f"临时文件创建成功: {temp_path}, 大小: {temp_file_size} 字节")
+        logger.debug(f"开始处理文件: {orig_filename}")
         
-        # 获取文件扩展名
-        _, file_ext = os.path.splitext(orig_filename.lower())
-        print(f"文件扩展名: {file_ext}")
-        
-        # 特别处理.doc文件
-        if file_ext == '.doc':
-            print(f"检测到.doc文件，将使用专门的处理方法: {orig_filename}")
+        # 为每个文件创建唯一的临时文件名（只保留扩展名，文件处理按扩展名分派）
+        async with temp_upload(os.path.splitext(orig_filename)[1].lower()) as temp_path:
+            # 分块流式保存临时文件
+            total = await save_upload(file, temp_path)
             
-        # 调用DocumentProcessor处理文件
-        try:
-            result = document_processor.extract_text(temp_path)
-            print(f"文件处理成功，提取内容长度: {len(result.get('content', ''))}")
+            # 检查文件是否为空
+            if total == 0:
+                logger.warning(f"上传的文件 '{orig_filename}' 内容为空")
+                raise HTTPException(status_code=400, detail=f"上传的文件内容为空: {orig_filename}")
             
-            if not result.get('content'):
-                print(f"警告: 文件内容提取为空: {orig_filename}")
-                raise HTTPException(status_code=400, detail=f"无法从文件中提取内容: {orig_filename}")
-                
-        except Exception as e:
-            print(f"处理文件时出错: {str(e)}")
-            print(f"错误类型: {type(e).__name__}")
+            logger.debug(f"临时文件创建成功: {temp_path}, 大小: {total} 字节")
+            
+            # 获取文件扩展名
+            _, file_ext = os.path.splitext(orig_filename.lower())
             
-            # 对于特定错误类型给出更详细的错误信息
-            if "PackageNotFoundError" in str(e):
-                print(f"检测到PackageNotFoundError错误，可能是.doc文件格式处理问题")
-                print(f"临时文件位置: {temp_path}, 大小: {os.path.getsize(temp_path)} 字节")
-                print(f"建议检查服务器是否安装了处理.doc文件所需的库")
+            # 特别处理.doc文件
+            if file_ext == '.doc':
+                logger.debug(f"检测到.doc文件，将使用专门的处理方法: {orig_filename}")
+                
+            # 调用DocumentProcessor处理文件，相同内容的文件直接复用缓存结果
+            try:
+                cache_key = f"extract:{file_ext}:{await asyncio.to_thread(_file_digest, temp_path)}"
+                result = await cache_get(cache_key, document_cache)
+                if result is None:
+                    result = await run_in_threadpool(document_processor.extract_text, temp_path)
+                    # 解析出错时content是错误说明，不能缓存
+                    if result.get('content') and not result.get('error'):
+                        await cache_set(cache_key, result, EXTRACT_CACHE_TTL, document_cache)
+                # 结果中的文件信息是（可能是之前某次上传的）临时文件，改写为本次上传的原始文件名
+                result["file_name"] = orig_filename
+                result["file_path"] = orig_filename
+                logger.debug(f"文件处理成功，提取内容长度: {len(result.get('content', ''))}")
                 
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+                if not result.get('content'):
+                    logger.warning(f"文件内容提取为空: {orig_filename}")
+                    raise HTTPException(status_code=400, detail=f"无法从文件中提取内容: {orig_filename}")
+                    
+            except Exception as e:
+                logger.error(f"处理文件时出错: {type(e).__name__}: {str(e)}")
                 
-            raise HTTPException(status_code=500, detail=f"处理文件时出错: {str(e)}")
-        
-        # 清理临时文件
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+                # 对于特定错误类型给出更详细的错误信息
+                if "PackageNotFoundError" in str(e):
+                    logger.error(f"检测到PackageNotFoundError错误，可能是.doc文件格式处理问题，"
+                                 f"临时文件位置: {temp_path}, 大小: {total} 字节，"
+                                 f"建议检查服务器是否安装了处理.doc文件所需的库")
+                    
+                raise HTTPException(status_code=500, detail=f"处理文件时出错: {str(e)}")
             
         return {"status": "success", "message": "文本提取成功", "data": result}
         
@@ -579,21 +837,16 @@ async def extract_text_from_file(file: UploadFile = File(...)):
         # 直接重新抛出HTTP异常
         raise
     except Exception as e:
-        print(f"API处理文件时发生未预期错误: {str(e)}")
-        traceback.print_exc()
+        logger.exception(f"API处理文件时发生未预期错误: {str(e)}")
         raise HTTPException(status_code=500, detail=f"API处理文件时出错: {str(e)}")
 
 @app.get("/kb/files/{kb_name}")
-async def list_files_in_kb(kb_name: str):
+@cached(lambda **kw: f"kb:files:{kw['kb_name']}")
+async def list_files_in_kb(kb_name: str, rag_service: RAGService = Depends(get_rag)):
     """获取知识库中的所有文件"""
     try:
-        global rag_service
-        if not rag_service:
-            rag_service = RAGService()
-            
-        print(f"获取知识库 {kb_name} 的文件列表")
-        files = rag_service.list_files(kb_name)
-        print(f"获取到的文件列表: {files}")
+        files = await run_in_threadpool(rag_service.list_files, kb_name)
+        logger.debug(f"获取到知识库 {kb_name} 的文件列表: {files}")
         
         if files is None:
             raise HTTPException(status_code=404, detail=f"知识库 {kb_name} 不存在")
@@ -603,25 +856,17 @@ async def list_files_in_kb(kb_name: str):
             "status": "success",
             "data": files if files else []
         }
-    except HTTPException:
-        raise
     except Exception as e:
-        error_trace = traceback.format_exc()
-        print(f"获取文件列表失败: {str(e)}\n{error_trace}")
-        raise HTTPException(status_code=500, detail=f"获取文件列表失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "获取文件列表失败")
 
 @app.get("/kb/file/{kb_name}/{file_name}")
-async def get_file_info(kb_name: str, file_name: str):
+async def get_file_info(kb_name: str, file_name: str, rag_service: RAGService = Depends(get_rag)):
     """获取知识库中特定文件的详细信息"""
     try:
-        global rag_service
-        if not rag_service:
-            rag_service = RAGService()
-            
         # URL解码文件名
-        decoded_file_name = quote(file_name, safe='')
+        decoded_file_name = unquote(file_name)
         
-        file_info = rag_service.get_file_info(kb_name, decoded_file_name)
+        file_info = await run_in_threadpool(rag_service.get_file_info, kb_name, decoded_file_name)
         if not file_info:
             raise HTTPException(status_code=404, detail=f"文件 {file_name} 在知识库 {kb_name} 中不存在")
             
@@ -630,22 +875,18 @@ async def get_file_info(kb_name: str, file_name: str):
             "data": file_info
         }
     except Exception as e:
-        error_trace = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"获取文件信息失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "获取文件信息失败")
 
 @app.delete("/kb/file/{kb_name}/{file_name}")
-async def delete_file_from_kb(kb_name: str, file_name: str):
+async def delete_file_from_kb(kb_name: str, file_name: str, rag_service: RAGService = Depends(get_rag)):
     """从知识库中删除文件"""
     try:
-        global rag_service
-        if not rag_service:
-            rag_service = RAGService()
-            
         # URL解码文件名
-        decoded_file_name = quote(file_name, safe='')
+        decoded_file_name = unquote(file_name)
         
-        success = rag_service.delete_file(kb_name, decoded_file_name)
+        success = await run_in_threadpool(rag_service.delete_file, kb_name, decoded_file_name)
         if success:
+            await invalidate_kb_cache(kb_name)
             return {
                 "status": "success",
                 "message": f"成功从知识库 {kb_name} 中删除文件 {file_name}"
@@ -653,103 +894,87 @@ async def delete_file_from_kb(kb_name: str, file_name: str):
         else:
             raise HTTPException(status_code=404, detail=f"文件 {file_name} 在知识库 {kb_name} 中不存在或删除失败")
     except Exception as e:
-        error_trace = traceback.format_exc()
-        raise HTTPException(status_code=500, detail=f"删除文件失败: {str(e)}\n{error_trace}")
+        handle_exc(e, "删除文件失败")
 
 @app.post("/kb/replace_file")
 async def replace_file(
     kb_name: str = Form(...),
     file_to_replace: str = Form(...),
     new_file: UploadFile = File(...),
-    chunk_config: str = Form("{}")
+    chunk_config: ChunkConfigForm = Depends(ChunkConfigForm.as_form),
+    rag_service: RAGService = Depends(get_rag)
 ):
     """替换知识库中的文件"""
-    try:
-        global rag_service, document_processor
-        if not rag_service:
-            rag_service = RAGService()
-        if not document_processor:
-            document_processor = DocumentProcessor()
-        
-        # URL解码文件名
-        decoded_file_to_replace = quote(file_to_replace, safe='')
+    # 在处理上传内容之前先完成廉价的校验
+    chunk_method, chunk_size, chunk_overlap = chunk_config.method, chunk_config.chunk_size, chunk_config.chunk_overlap
+    logger.debug(f"分块配置: 方法={chunk_method}, 大小={chunk_size}, 重叠={chunk_overlap}")
+    if not rag_service.kb_exists(kb_name):
+        raise HTTPException(status_code=404, detail=f"知识库 {kb_name} 不存在")
+    
+    # URL解码文件名
+    decoded_file_to_replace = unquote(file_to_replace)
 
-        # 检查文件是否存在
-        if not rag_service.file_exists(kb_name, decoded_file_to_replace):
-            raise HTTPException(status_code=404, detail=f"文件 {file_to_replace} 在知识库 {kb_name} 中不存在")
-        
-        # 解析分块配置
-        config = json.loads(chunk_config)
-        chunk_method = config.get("method", "text_semantic")
-        chunk_size = config.get("chunk_size", 1000)
-        chunk_overlap = config.get("chunk_overlap", 200)
-        
-        print(f"分块配置: 方法={chunk_method}, 大小={chunk_size}, 重叠={chunk_overlap}")
-        
-        # 保存上传的文件到临时目录
-        temp_dir = "temp_files"
-        os.makedirs(temp_dir, exist_ok=True)
-        temp_file_id = str(uuid.uuid4())
-        temp_path = os.path.join(temp_dir, f"{temp_file_id}_{new_file.filename}")
-        
-        with open(temp_path, "wb") as buffer:
-            content = await new_file.read()
-            buffer.write(content)
-        
-        # 获取文件扩展名
-        _, file_ext = os.path.splitext(new_file.filename.lower())
-        print(f"文件扩展名: {file_ext}")
-        
-        # 处理文件内容
-        try:
-            # 调用DocumentProcessor处理文件
-            result = document_processor.extract_text(temp_path)
+    # 检查文件是否存在
+    if not rag_service.file_exists(kb_name, decoded_file_to_replace):
+        raise HTTPException(status_code=404, detail=f"文件 {file_to_replace} 在知识库 {kb_name} 中不存在")
+    
+    # 与上传接口一致只保留文件名部分，客户端提供的路径不会写入知识库元数据
+    new_file_name = os.path.basename(new_file.filename or "")
+    
+    try:
+        # 保存上传的文件到临时目录，退出时自动清理
+        async with temp_upload(os.path.splitext(new_file_name)[1].lower()) as temp_path:
+            await save_upload(new_file, temp_path)
             
-            if not result.get('content'):
-                os.remove(temp_path)  # 清理临时文件
-                raise HTTPException(status_code=400, detail=f"无法从文件中提取内容: {new_file.filename}")
+            # 获取文件扩展名
+            _, file_ext = os.path.splitext(new_file_name.lower())
+            logger.debug(f"文件扩展名: {file_ext}")
             
-            # 替换知识库中的文件
-            success = rag_service.replace_file(
-                kb_name=kb_name,
-                file_to_replace=decoded_file_to_replace,
-                new_file_path=temp_path,
-                new_file_name=new_file.filename,
+            # 与上传接口相同，按本次分块配置使用独立的处理器提取并分块
+            processor = DocumentProcessor(
+                chunk_method=chunk_method,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap
+            )
+            documents = await run_in_threadpool(
+                processor.process_document,
+                file_path=temp_path,
                 chunk_method=chunk_method,
                 chunk_size=chunk_size,
                 chunk_overlap=chunk_overlap
             )
             
-            # 清理临时文件
-            os.remove(temp_path)
+            if not documents:
+                raise HTTPException(status_code=400, detail=f"无法从文件中提取内容: {new_file_name}")
             
-            if success:
-                return {
-                    "status": "success",
-                    "message": f"成功替换知识库 {kb_name} 中的文件 {file_to_replace}"
-                }
-            else:
-                raise HTTPException(status_code=500, detail=f"替换文件失败")
-                
-        except Exception as e:
-            # 确保清理临时文件
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            raise e
+            # 新内容登记为被替换文件的新版本（文件注册表按元数据中的file_path登记文件）
+            documents = _rebind_chunks(documents, decoded_file_to_replace, temp_path)
+            
+            # 替换知识库中的文件
+            success = await run_in_threadpool(
+                rag_service.replace_file,
+                kb_name=kb_name,
+                file_path=decoded_file_to_replace,
+                documents=documents
+            )
+            
+        if success:
+            await invalidate_kb_cache(kb_name)
+            return {
+                "status": "success",
+                "message": f"成功替换知识库 {kb_name} 中的文件 {file_to_replace}"
+            }
+        else:
+            raise HTTPException(status_code=500, detail=f"替换文件失败")
             
     except Exception as e:
-        error_trace = traceback.format_exc()
-        print(f"替换文件失败: {str(e)}\n{error_trace}")
-        raise HTTPException(status_code=500, detail=f"替换文件失败: {str(e)}")
+        handle_exc(e, "替换文件失败")
         
 
 @app.post("/kb/chat")
-async def chat_with_knowledge_base(query: ChatQuery):
+async def chat_with_knowledge_base(query: ChatQuery, rag_service: RAGService = Depends(get_rag)):
     """与知识库对话"""
     try:
-        # 检查必要的组件是否初始化
-        rag_service = RAGService()
-            
         # 检查知识库是否存在
         if not rag_service.kb_exists(query.kb_name):
             return {"status": "error", "message": f"知识库 {query.kb_name} 不存在"}
@@ -761,8 +986,9 @@ async def chat_with_knowledge_base(query: ChatQuery):
                 if isinstance(msg, dict) and "role" in msg and "content" in msg:
                     history_msgs.append(msg)
         
-        # 调用RAG服务进行知识库对话
-        result = rag_service.chat_with_kb(
+        # 调用RAG服务进行知识库对话（chat_with_kb是流式生成器，这里使用非流式版本）
+        result = await run_in_threadpool(
+            rag_service.chat_with_kb_sync,
             kb_name=query.kb_name,
             query=query.query,
             history=history_msgs,
@@ -773,20 +999,15 @@ async def chat_with_knowledge_base(query: ChatQuery):
         return {"status": "success", "answer": result}
     except Exception as e:
         error_msg = f"与知识库对话失败: {str(e)}"
-        error_trace = traceback.format_exc()
-        print(f"{error_msg}\n{error_trace}")
+        logger.exception(error_msg)
         return {"status": "error", "message": error_msg}
 
 @app.post("/kb/chat_stream")
-async def chat_with_knowledge_base_stream(query: ChatQuery):
+async def chat_with_knowledge_base_stream(query: ChatQuery, rag_service: RAGService = Depends(get_rag)):
     """与知识库对话（流式响应）"""
-    from fastapi.responses import StreamingResponse
     
     async def stream_response():
         try:
-            # 检查必要的组件是否初始化
-            rag_service = RAGService()
-                
             # 检查知识库是否存在
             if not rag_service.kb_exists(query.kb_name):
                 yield f"错误：知识库 {query.kb_name} 不存在"
@@ -799,23 +1020,52 @@ async def chat_with_knowledge_base_stream(query: ChatQuery):
                     if isinstance(msg, dict) and "role" in msg and "content" in msg:
                         history_msgs.append(msg)
             
-            # 调用RAG服务进行知识库对话（流式）
-            for chunk in rag_service.chat_with_kb(
-                kb_name=query.kb_name,
-                query=query.query,
-                history=history_msgs,
-                top_k=query.top_k,
-                temperature=query.temperature
-            ):
-                yield chunk
+            # chat_with_kb是同步生成器，在生产者线程中逐个取出token，
+            # 通过有界队列交给事件循环，客户端消费慢时生产者会阻塞（背压）
+            loop = asyncio.get_running_loop()
+            queue: asyncio.Queue = asyncio.Queue(maxsize=32)
+            stopped = threading.Event()
+            
+            def producer():
+                try:
+                    for chunk in rag_service.chat_with_kb(
+                        kb_name=query.kb_name,
+                        query=query.query,
+                        history=history_msgs,
+                        top_k=query.top_k,
+                        temperature=query.temperature
+                    ):
+                        if stopped.is_set():
+                            return
+                        asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+                except Exception as e:
+                    asyncio.run_coroutine_threadsafe(queue.put(e), loop).result()
+                finally:
+                    if not stopped.is_set():
+                        asyncio.run_coroutine_threadsafe(queue.put(None), loop)
+            
+            threading.Thread(target=producer, daemon=True).start()
+            try:
+                while (chunk := await queue.get()) is not None:
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    yield chunk
+            finally:
+                # 客户端断开时通知生产者退出，并清空队列解除其阻塞
+                stopped.set()
+                while not queue.empty():
+                    queue.get_nowait()
                 
         except Exception as e:
             error_msg = f"与知识库对话失败: {str(e)}"
-            error_trace = traceback.format_exc()
-            print(f"{error_msg}\n{error_trace}")
+            logger.exception(error_msg)
             yield error_msg
     
-    return StreamingResponse(stream_response(), media_type="text/plain")
+    return StreamingResponse(
+        stream_response(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 class ImportanceUpdate(BaseModel):
     kb_name: str
@@ -823,12 +1073,9 @@ class ImportanceUpdate(BaseModel):
     importance_factor: float
 
 @app.post("/kb/set_importance")
-async def set_file_importance(request: ImportanceUpdate):
+async def set_file_importance(request: ImportanceUpdate, rag_service: RAGService = Depends(get_rag)):
     """设置文件的重要性系数"""
     try:
-        # 检查必要的组件是否初始化
-        rag_service = RAGService()
-            
         # 检查知识库是否存在
         if not rag_service.kb_exists(request.kb_name):
             return {"status": "error", "message": f"知识库 {request.kb_name} 不存在"}
@@ -838,41 +1085,35 @@ async def set_file_importance(request: ImportanceUpdate):
             return {"status": "error", "message": "重要性系数必须在0.1到5.0之间"}
 
         # 检查文件是否存在
-        files = rag_service.list_files(request.kb_name)
-        file_exists = False
-        for file in files:
-            if "file_name" in file and file["file_name"] == request.file_name:
-                file_exists = True
-                break
-        
-        if not file_exists:
+        if not await run_in_threadpool(rag_service.file_exists, request.kb_name, request.file_name):
             return {"status": "error", "message": f"文件 {request.file_name} 不存在于知识库 {request.kb_name} 中"}
         
         # 更新文件重要性系数
-        success = rag_service.update_file_importance(
+        success = await run_in_threadpool(
+            rag_service.update_file_importance,
             kb_name=request.kb_name,
             file_name=request.file_name,
             importance_factor=request.importance_factor
         )
         
         if success:
+            await invalidate_kb_cache(request.kb_name)
             return {"status": "success", "message": f"成功设置文件 {request.file_name} 的重要性系数为 {request.importance_factor}"}
         else:
             return {"status": "error", "message": "更新重要性系数失败"}
     except Exception as e:
         error_msg = f"设置文件重要性系数失败: {str(e)}"
-        error_trace = traceback.format_exc()
-        print(f"{error_msg}\n{error_trace}")
+        logger.exception(error_msg)
         return {"status": "error", "message": error_msg}
 
-def update_processing_task(task_id: str, progress: int, message: str):
+async def update_processing_task(task_id: str, progress: int, message: str):
     """更新任务处理状态"""
-    if task_id in processing_tasks:
-        processing_tasks[task_id] = {
+    if await get_task(task_id) is not None:
+        await set_task(task_id, {
             "status": "processing", 
             "progress": progress, 
             "message": message
-        }
+        })
 
 def start_api_server(host: str = "0.0.0.0", port: int = 8023):
     """启动API服务器"""
@@ -1,8 +1,50 @@
 import re
 import numpy as np
 from typing import List, Dict, Any, Optional, Tuple
-from sklearn.feature_extraction.text import CountVectorizer
 from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import HashingVectorizer
+
+# 无状态的哈希词频器，进程内复用：不构建词表，词空间维度固定
+_HASHER = HashingVectorizer(
+    n_features=2 ** 18,
+    token_pattern=r"(?u)\b\w+\b",
+    alternate_sign=False,
+    norm=None,
+    dtype=np.float32
+)
+# 段落分隔（空行）与英文句子分隔
+_PARA_RE = re.compile(r'\n\s*\n')
+# 不是恰好一个空行（\n\n）的段落分隔，出现时才需要走正则分割
+_IRREGULAR_BLANKS_RE = re.compile(r'\n\s+\n')
+_SENT_RE_EN = re.compile(r'(?<=[.!?])\s+')
+
+# numba为可选依赖，未安装时退化为numpy实现
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+    # 不用parallel：上传线程池会并发调用，workqueue线程层并发进入并行区域会终止进程；单次调用的非零元很少
+    @njit(fastmath=True, cache=True)
+    def _bm25_score_sparse(data, indices, indptr, idf, doc_len, avg_len, k1, b, out):
+        for d in range(len(indptr) - 1):
+            norm = k1 * (1 - b + b * doc_len[d] / avg_len)
+            for p in range(indptr[d], indptr[d + 1]):
+                f = data[p]
+                out[p] = idf[indices[p]] * f * (k1 + 1) / (f + norm)
+        return out
+else:
+    def _bm25_score_sparse(data, indices, indptr, idf, doc_len, avg_len, k1, b, out):
+        # 直接在out缓冲区上原地计算，只额外分配一个nnz大小的分母数组
+        np.multiply(data, k1 + 1, out=out)
+        denominator = np.repeat((k1 * (1 - b + b * doc_len / avg_len)).astype(out.dtype), np.diff(indptr))
+        denominator += data
+        np.divide(out, denominator, out=out)
+        out *= idf[indices]
+        return out
 
 
 class BM25Chunker:
@@ -31,14 +73,14 @@ class BM25Chunker:
             text: 要分割的文本
             
         返回:
-            包含分割后文本块的列表，每个块包含内容和元数据
+            包含分割后文本块的列表，每个块包含文本（text）和元数据
         """
         # 首先进行初步分割，获取候选段落
         paragraphs = self._split_into_paragraphs(text)
         
         # 如果段落太少，直接返回
         if len(paragraphs) <= 1:
-            return [{"content": text, "metadata": {"chunk_index": 0, "chunk_size": len(text)}}]
+            return [{"text": text, "metadata": {"chunk_index": 0, "chunk_size": len(text)}}]
         
         # 计算BM25相似度矩阵
         similarity_matrix = self._calculate_bm25_similarity(paragraphs)
@@ -46,18 +88,19 @@ class BM25Chunker:
         # 基于相似度进行聚类分块
         chunks = self._cluster_paragraphs(paragraphs, similarity_matrix)
         
-        # 处理块重叠
-        if self.chunk_overlap > 0:
-            chunks = self._merge_chunks_with_overlap(chunks)
-        
-        # 构建结果
+        # 构建结果，重叠在输出时直接拼接：非首块开头加上前一个原始块的末尾部分
+        # （chunk_overlap>0时，前一个块不足overlap长度的切片即为整个块）
+        overlap = self.chunk_overlap
         result = []
+        prev_chunk = None
         for i, chunk in enumerate(chunks):
+            content = prev_chunk[-overlap:] + chunk if overlap > 0 and prev_chunk is not None else chunk
+            prev_chunk = chunk
             result.append({
-                "content": chunk,
+                "text": content,
                 "metadata": {
                     "chunk_index": i,
-                    "chunk_size": len(chunk)
+                    "chunk_size": len(content)
                 }
             })
         
@@ -73,30 +116,41 @@ class BM25Chunker:
         返回:
             段落列表
         """
-        # 使用空行分割段落
-        paragraphs = re.split(r'\n\s*\n', text)
+        # 使用空行分割段落，常见的\n\n分隔直接用str.split
+        if '\n\n' in text and not _IRREGULAR_BLANKS_RE.search(text):
+            paragraphs = text.split('\n\n')
+        else:
+            paragraphs = _PARA_RE.split(text)
         
-        # 过滤空段落
-        paragraphs = [p.strip() for p in paragraphs if p.strip()]
+        # 过滤空段落（每个段落只strip一次）
+        paragraphs = list(filter(None, map(str.strip, paragraphs)))
         
         # 处理过长的段落
         result = []
         for paragraph in paragraphs:
             if len(paragraph) > self.chunk_size:
                 # 过长段落按句子再分割
-                sentences = re.split(r'(?<=[.!?])\s+', paragraph)
-                current_chunk = ""
+                sentences = _SENT_RE_EN.split(paragraph)
+                # 先收集句子片段并记录拼接后的长度，最后一次性join
+                current_parts = []
+                current_size = 0
                 
                 for sentence in sentences:
-                    if len(current_chunk) + len(sentence) <= self.chunk_size:
-                        current_chunk += " " + sentence if current_chunk else sentence
+                    if current_size + len(sentence) <= self.chunk_size:
+                        if current_size:
+                            current_parts.append(sentence)
+                            current_size += 1 + len(sentence)
+                        else:
+                            current_parts = [sentence]
+                            current_size = len(sentence)
                     else:
-                        if current_chunk:
-                            result.append(current_chunk)
-                        current_chunk = sentence
+                        if current_size:
+                            result.append(" ".join(current_parts))
+                        current_parts = [sentence]
+                        current_size = len(sentence)
                 
-                if current_chunk:
-                    result.append(current_chunk)
+                if current_size:
+                    result.append(" ".join(current_parts))
             else:
                 result.append(paragraph)
         
@@ -112,53 +166,55 @@ class BM25Chunker:
         返回:
             相似度矩阵
         """
-        # 使用CountVectorizer获取词频矩阵
-        vectorizer = CountVectorizer(token_pattern=r"(?u)\b\w+\b")
-        tf = vectorizer.fit_transform(paragraphs)
+        # 获取词频矩阵
+        tf = self._term_frequency(paragraphs)
         
-        # 计算文档频率
-        df = np.bincount(tf.indices, minlength=tf.shape[1])
+        # 计算文档频率：CSC列指针之差即每个词出现的文档数
+        df = np.diff(tf.tocsc().indptr).astype(np.float32)
         
         # 计算IDF
         n_docs = len(paragraphs)
-        idf = np.log((n_docs - df + 0.5) / (df + 0.5) + 1.0)
+        idf = np.log((n_docs - df + 0.5) / (df + 0.5) + 1.0).astype(np.float32)
         
         # 计算文档长度和平均文档长度
-        doc_lengths = tf.sum(axis=1).A1
+        doc_lengths = np.asarray(tf.sum(axis=1), dtype=np.float32).ravel()
         avg_doc_length = np.mean(doc_lengths)
         
-        # 计算BM25相似度矩阵
-        similarity_matrix = np.zeros((n_docs, n_docs))
+        # 对tf的每个非零项(j, t)计算文档j中词t的BM25贡献，得到与tf稀疏结构相同的得分矩阵
+        score_data = _bm25_score_sparse(
+            tf.data, tf.indices, tf.indptr, idf, doc_lengths, float(avg_doc_length),
+            float(self.k1), float(self.b), np.empty(tf.nnz, dtype=np.float32)
+        )
+        scores = csr_matrix((score_data, tf.indices, tf.indptr), shape=tf.shape)
         
-        for i in range(n_docs):
-            for j in range(n_docs):
-                if i == j:
-                    similarity_matrix[i, j] = 1.0  # 自身相似度为1
-                    continue
-                
-                # 获取文档i和j的词频
-                doc_i = tf[i].toarray().flatten()
-                doc_j = tf[j].toarray().flatten()
-                
-                # 计算BM25分数
-                score = 0.0
-                for term_idx in range(len(doc_i)):
-                    if doc_i[term_idx] > 0 and doc_j[term_idx] > 0:
-                        # BM25公式计算
-                        numerator = doc_j[term_idx] * (self.k1 + 1)
-                        denominator = doc_j[term_idx] + self.k1 * (1 - self.b + self.b * doc_lengths[j] / avg_doc_length)
-                        term_score = idf[term_idx] * numerator / denominator
-                        score += term_score
-                
-                similarity_matrix[i, j] = score
+        # similarity[i, j] = 文档i中出现的词在文档j上的BM25得分之和，一次稀疏矩阵乘法完成
+        # 相似度只用于排序，全程使用float32以减半n×n矩阵的内存读写
+        # 出现矩阵与tf共享下标数组，只新建全1的data
+        presence = csr_matrix((np.ones(tf.nnz, dtype=np.float32), tf.indices, tf.indptr), shape=tf.shape)
+        similarity_matrix = (presence @ scores.T).toarray()
+        np.fill_diagonal(similarity_matrix, 1.0)  # 自身相似度为1
         
-        # 归一化相似度矩阵
-        row_max = np.max(similarity_matrix, axis=1).reshape(-1, 1)
-        row_max[row_max == 0] = 1.0  # 避免除以零
-        similarity_matrix = similarity_matrix / row_max
+        # 归一化相似度矩阵（原地按行除以最大值，最大值为零的行保持不变）
+        row_max = similarity_matrix.max(axis=1, keepdims=True)
+        np.divide(similarity_matrix, row_max, out=similarity_matrix, where=row_max > 0)
         
         return similarity_matrix
     
+    def _term_frequency(self, paragraphs: List[str]) -> csr_matrix:
+        """
+        分词并构建(段落, 词哈希桶)的CSR词频矩阵
+        
+        参数:
+            paragraphs: 段落列表
+            
+        返回:
+            词频矩阵，行对应段落，列对应词的哈希桶
+        """
+        tf = _HASHER.transform(paragraphs)
+        if tf.nnz == 0:
+            raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+        return tf
+    
     def _cluster_paragraphs(self, paragraphs: List[str], similarity_matrix: np.ndarray) -> List[str]:
         """
         基于相似度矩阵聚类段落
@@ -171,70 +227,43 @@ class BM25Chunker:
             聚类后的文本块列表
         """
         n_paragraphs = len(paragraphs)
-        visited = [False] * n_paragraphs
+        visited = np.zeros(n_paragraphs, dtype=bool)
+        para_lens = np.fromiter((len(p) for p in paragraphs), dtype=np.int64, count=n_paragraphs)
         chunks = []
         
-        for i in range(n_paragraphs):
+        for i, paragraph in enumerate(paragraphs):
             if visited[i]:
                 continue
                 
-            # 开始一个新的聚类
-            current_chunk = paragraphs[i]
+            # 开始一个新的聚类（收集段落，最后用空行join）
+            current_parts = [paragraph]
+            current_size = int(para_lens[i])
             visited[i] = True
             
+            # 当前段落的相似度行，已访问的置为-inf，之后每加入一个段落只需屏蔽该位置
+            row = similarity_matrix[i].copy()
+            row[visited] = -np.inf
+            
             # 贪婪地添加相似段落
-            while len(current_chunk) < self.chunk_size:
+            while current_size < self.chunk_size:
                 # 找到最相似且未访问的段落
-                best_sim = -1
-                best_idx = -1
-                
-                for j in range(n_paragraphs):
-                    if not visited[j] and similarity_matrix[i, j] > best_sim:
-                        best_sim = similarity_matrix[i, j]
-                        best_idx = j
+                best_idx = int(np.argmax(row))
+                best_len = int(para_lens[best_idx])
                 
                 # 如果没有找到合适的段落或添加后会超过chunk_size，则结束
-                if best_idx == -1 or len(current_chunk) + len(paragraphs[best_idx]) > self.chunk_size:
+                if visited[best_idx] or current_size + best_len > self.chunk_size:
                     break
                     
                 # 添加段落到当前块
-                current_chunk += "\n\n" + paragraphs[best_idx]
+                current_parts.append(paragraphs[best_idx])
+                current_size += 2 + best_len
                 visited[best_idx] = True
+                row[best_idx] = -np.inf
             
-            chunks.append(current_chunk)
+            chunks.append("\n\n".join(current_parts))
         
         # 处理剩余未访问的段落
-        for i in range(n_paragraphs):
-            if not visited[i]:
-                chunks.append(paragraphs[i])
+        for i in np.flatnonzero(~visited):
+            chunks.append(paragraphs[i])
         
         return chunks
-    
-    def _merge_chunks_with_overlap(self, chunks: List[str]) -> List[str]:
-        """
-        处理块之间的重叠
-        
-        参数:
-            chunks: 原始文本块列表
-            
-        返回:
-            处理重叠后的文本块列表
-        """
-        if not chunks or len(chunks) == 1:
-            return chunks
-        
-        result = []
-        for i in range(len(chunks)):
-            if i == 0:
-                # 第一个块不需要前向重叠
-                result.append(chunks[i])
-            else:
-                # 获取前一个块的末尾部分作为重叠
-                prev_chunk = chunks[i-1]
-                overlap_size = min(self.chunk_overlap, len(prev_chunk))
-                overlap_text = prev_chunk[-overlap_size:]
-                
-                # 将重叠部分添加到当前块的开头
-                result.append(overlap_text + chunks[i])
-        
-        return result
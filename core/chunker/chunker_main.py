@@ -6,10 +6,9 @@ from enum import Enum
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-from core.chunker.text_semantic_chunk import TextSemanticChunker
-from core.chunker.semantic_chunk import SemanticChunker
+# 依赖嵌入模型（text_semantic/semantic）或docx（markdown_header）的分块器在_init_chunker中按需导入，
+# 避免只用BM25等轻量方法时也加载嵌入模型
 from core.chunker.hierarchical_chunk import HierarchicalTextSplitter
-from core.chunker.markdown_header_chunk import MarkdownHeaderTextSplitter
 from core.chunker.recursive_character_chunk import RecursiveCharacterTextSplitter
 from core.chunker.bm25_chunk import BM25Chunker
 from core.chunker.subheading_chunk import SubheadingTextSplitter
@@ -27,6 +26,17 @@ class ChunkMethod(Enum):
     BM25 = "bm25"
     SUBHEADING = "subheading"  # 新增的子标题分块方法
 
+# 各分块方法对应的(分块器方法名, 进度描述, 返回纯文本时附加的method元数据)
+_CHUNK_DISPATCH = {
+    ChunkMethod.TEXT_SEMANTIC: ("create_chunks", "文本语义分块", None),
+    ChunkMethod.SEMANTIC: ("chunk_text", "语义分块", "semantic"),
+    ChunkMethod.HIERARCHICAL: ("split_text", "层次分块", None),
+    ChunkMethod.MARKDOWN_HEADER: ("split_text", "Markdown标题分块", None),
+    ChunkMethod.RECURSIVE_CHARACTER: ("split_text", "递归字符分块", None),
+    ChunkMethod.BM25: ("split_text", "BM25分块", None),
+    ChunkMethod.SUBHEADING: ("split_text", "子标题分块", None),
+}
+
 class DocumentChunker:
     """
     文档分块器主类，可以选择不同的分块策略
@@ -68,12 +78,14 @@ class DocumentChunker:
     def _init_chunker(self, **kwargs):
         """初始化具体的分块器"""
         if self.method == ChunkMethod.TEXT_SEMANTIC:
+            from core.chunker.text_semantic_chunk import TextSemanticChunker
             self.chunker = TextSemanticChunker(
                 embedding_model=self.embedding_model,
                 chunk_size=self.chunk_size,
                 chunk_overlap=self.chunk_overlap
             )
         elif self.method == ChunkMethod.SEMANTIC:
+            from core.chunker.semantic_chunk import SemanticChunker
             similarity_threshold = kwargs.get('similarity_threshold', 0.7)
             min_chunk_size = kwargs.get('min_chunk_size', 100)
             self.chunker = SemanticChunker(
@@ -88,6 +100,7 @@ class DocumentChunker:
                 chunk_overlap=self.chunk_overlap
             )
         elif self.method == ChunkMethod.MARKDOWN_HEADER:
+            from core.chunker.markdown_header_chunk import MarkdownHeaderTextSplitter
             headers_to_split_on = kwargs.get('headers_to_split_on', None)
             self.chunker = MarkdownHeaderTextSplitter(
                 headers_to_split_on=headers_to_split_on
@@ -100,10 +113,9 @@ class DocumentChunker:
                 separators=separators
             )
         elif self.method == ChunkMethod.BM25:
-            min_chunk_size = kwargs.get('min_chunk_size', 200)
             self.chunker = BM25Chunker(
-                min_chunk_size=min_chunk_size,
-                max_chunk_size=self.chunk_size
+                chunk_size=self.chunk_size,
+                chunk_overlap=self.chunk_overlap
             )
         elif self.method == ChunkMethod.SUBHEADING:
             main_headers_level = kwargs.get('main_headers_level', 1)
@@ -117,11 +129,18 @@ class DocumentChunker:
         else:
             # 默认使用TextSemanticChunker
             logger.warning(f"未实现的分块方法: {self.method}，使用默认方法: text_semantic")
+            from core.chunker.text_semantic_chunk import TextSemanticChunker
             self.chunker = TextSemanticChunker(
                 embedding_model=self.embedding_model,
                 chunk_size=self.chunk_size,
                 chunk_overlap=self.chunk_overlap
             )
+        
+        # 预先绑定分块函数，chunk_document无需再逐个判断分块方法
+        fn_name, self._chunk_label, self._chunk_tag = _CHUNK_DISPATCH.get(
+            self.method, ("create_chunks", "默认分块", None)
+        )
+        self._chunk_fn = getattr(self.chunker, fn_name)
     
     def chunk_document(self, document: str, progress_callback=None) -> List[Dict[str, Any]]:
         """
@@ -138,69 +157,20 @@ class DocumentChunker:
             if progress_callback:
                 progress_callback(0, f"开始使用 {self.method.value} 方法进行文档分块")
             
-            result = []
-            if self.method == ChunkMethod.TEXT_SEMANTIC:
-                # 这里假设分块过程无法中断，我们在开始和结束时报告进度
-                if progress_callback:
-                    progress_callback(10, "正在进行文本语义分块...")
-                result = self.chunker.create_chunks(document)
-                if progress_callback:
-                    progress_callback(95, f"文本语义分块完成，共生成 {len(result)} 个分块")
-                
-            elif self.method == ChunkMethod.SEMANTIC:
-                if progress_callback:
-                    progress_callback(10, "正在进行语义分块...")
-                chunks = self.chunker.chunk_text(document)
-                result = [{"text": chunk, "metadata": {"method": "semantic"}} for chunk in chunks]
-                if progress_callback:
-                    progress_callback(95, f"语义分块完成，共生成 {len(result)} 个分块")
-                
-            elif self.method == ChunkMethod.HIERARCHICAL:
-                if progress_callback:
-                    progress_callback(10, "正在进行层次分块...")
-                result = self.chunker.split_text(document)
-                if progress_callback:
-                    progress_callback(95, f"层次分块完成，共生成 {len(result)} 个分块")
-                
-            elif self.method == ChunkMethod.MARKDOWN_HEADER:
-                if progress_callback:
-                    progress_callback(10, "正在进行Markdown标题分块...")
-                result = self.chunker.split_text(document)
-                if progress_callback:
-                    progress_callback(95, f"Markdown标题分块完成，共生成 {len(result)} 个分块")
-                
-            elif self.method == ChunkMethod.RECURSIVE_CHARACTER:
-                if progress_callback:
-                    progress_callback(10, "正在进行递归字符分块...")
-                chunks = self.chunker.split_text(document)
-                result = [{"text": chunk, "metadata": {"method": "recursive"}} for chunk in chunks]
-                if progress_callback:
-                    progress_callback(95, f"递归字符分块完成，共生成 {len(result)} 个分块")
-                
-            elif self.method == ChunkMethod.BM25:
-                if progress_callback:
-                    progress_callback(10, "正在进行BM25分块...")
-                result = self.chunker.chunk_document(document)
-                if progress_callback:
-                    progress_callback(95, f"BM25分块完成，共生成 {len(result)} 个分块")
-                
-            elif self.method == ChunkMethod.SUBHEADING:
-                if progress_callback:
-                    progress_callback(10, "正在进行子标题分块...")
-                result = self.chunker.split_text(document)
-                if progress_callback:
-                    progress_callback(95, f"子标题分块完成，共生成 {len(result)} 个分块")
-                
-            else:
-                # 默认使用TextSemanticChunker
-                if progress_callback:
-                    progress_callback(10, "使用默认方法进行分块...")
-                result = self.chunker.create_chunks(document)
-                if progress_callback:
-                    progress_callback(95, f"默认分块完成，共生成 {len(result)} 个分块")
+            # 这里假设分块过程无法中断，我们在开始和结束时报告进度
+            if progress_callback:
+                progress_callback(10, f"正在进行{self._chunk_label}...")
+            result = self._chunk_fn(document)
+            if self._chunk_tag:
+                result = [{"text": chunk, "metadata": {"method": self._chunk_tag}} for chunk in result]
+            if progress_callback:
+                progress_callback(95, f"{self._chunk_label}完成，共生成 {len(result)} 个分块")
             
             # 为每个分块添加唯一ID
             for i, chunk in enumerate(result):
+                if isinstance(chunk, dict) and not isinstance(chunk.get("text"), str):
+                    # 下游按"text"字段生成向量，缺失时会把整块当作空文本写入，这里直接报错改走备用分块
+                    raise ValueError(f"{self._chunk_label}返回的第{i+1}个分块缺少text字段: {list(chunk.keys())}")
                 if isinstance(chunk, dict) and "metadata" in chunk:
                     chunk["metadata"]["chunk_id"] = f"chunk_{i+1}"
                 elif isinstance(chunk, dict):
@@ -220,24 +190,30 @@ class DocumentChunker:
             if progress_callback:
                 progress_callback(50, "主要分块方法失败，使用备用简单分块...")
                 
-            simple_chunks = self._simple_chunk(document)
             result = [{"text": chunk, "metadata": {"method": "simple_fallback", "chunk_id": f"chunk_{i+1}"}} 
-                     for i, chunk in enumerate(simple_chunks)]
+                     for i, chunk in enumerate(self._iter_simple_chunk(document))]
             
             if progress_callback:
                 progress_callback(100, f"备用分块完成，共生成 {len(result)} 个分块")
                 
             return result
     
+    def _simple_chunk_offsets(self, text_length: int) -> range:
+        """计算简单分块各块的起始偏移，最后一块恰好覆盖到文本末尾"""
+        if text_length == 0:
+            return range(0)
+        step = self.chunk_size - self.chunk_overlap
+        last = max(text_length - self.chunk_size, 0)
+        return range(0, (-(-last // step) + 1) * step, step)
+    
     def _simple_chunk(self, text: str) -> List[str]:
         """简单的分块方法，作为出错时的后备方案"""
-        chunks = []
-        for i in range(0, len(text), self.chunk_size - self.chunk_overlap):
-            end = min(i + self.chunk_size, len(text))
-            chunks.append(text[i:end])
-            if end == len(text):
-                break
-        return chunks
+        return [text[i:i + self.chunk_size] for i in self._simple_chunk_offsets(len(text))]
+    
+    def _iter_simple_chunk(self, text: str):
+        """_simple_chunk的生成器版本，按需切片，不一次性持有所有分块"""
+        for i in self._simple_chunk_offsets(len(text)):
+            yield text[i:i + self.chunk_size]
     
     def change_method(self, method: Union[str, ChunkMethod], **kwargs):
         """
@@ -0,0 +1,70 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Sequence
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """按文本内容摘要缓存嵌入向量的LRU缓存，线程安全；向量以只读float32数组保存（512维约2KB一条）"""
+
+    def __init__(self, max_size=10000):
+        """
+        初始化嵌入向量缓存
+
+        参数:
+            max_size: 最多缓存的向量条数，超出时淘汰最久未使用的条目
+        """
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def embed(self, texts: Sequence[str], encode_fn: Callable[[List[str]], Any]) -> List[Any]:
+        """
+        获取一批文本的嵌入向量，只对未命中缓存的文本调用encode_fn
+
+        参数:
+            texts: 文本列表
+            encode_fn: 批量编码函数，接收文本列表，返回按顺序对应的向量序列
+
+        返回:
+            与texts顺序一致的向量列表，每个向量为只读的float32一维数组（缓存中的同一对象）
+        """
+        keys = [self._key(text) for text in texts]
+        results = [None] * len(texts)
+
+        # 先查缓存，同一批中重复的未命中文本只编码一次
+        misses = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    results[i] = self._cache[key]
+                else:
+                    misses.setdefault(key, []).append(i)
+
+        if misses:
+            miss_keys = list(misses)
+            embeddings = encode_fn([texts[misses[key][0]] for key in miss_keys])
+            with self._lock:
+                for key, embedding in zip(miss_keys, embeddings):
+                    # 统一转为float32数组缓存，避免Python float列表每个元素一个对象的内存开销
+                    embedding = np.array(embedding, dtype=np.float32)
+                    embedding.flags.writeable = False
+                    for i in misses[key]:
+                        results[i] = embedding
+                    self._cache[key] = embedding
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+
+        return results
+
+
+# 默认嵌入模型（core.embbeding_model）的进程级共享缓存，跨文档复用
+default_embedding_cache = EmbeddingCache()
@@ -1,9 +1,10 @@
 import re
 import numpy as np
-from typing import List, Dict, Any, Optional, Tuple
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from core.embbeding_model import get_embedding
+from typing import List, Dict, Any, Tuple
+
+# 标题行与中英文句子分隔
+_HDR_RE = re.compile(r'^(#+)\s+(.+)$')
+_SENT_RE_MIX = re.compile(r'(?<=[。！？.!?])')
 
 
 class HierarchicalTextSplitter:
@@ -36,7 +37,8 @@ class HierarchicalTextSplitter:
         # 构建层次结构
         hierarchy = []
         current_section = None
-        current_level = 0
+        # 从根到当前章节的祖先栈，栈内章节级别严格递增
+        section_stack = []
         
         for line in lines:
             line = line.strip()
@@ -44,7 +46,7 @@ class HierarchicalTextSplitter:
                 continue
             
             # 检测标题级别
-            header_match = re.match(r'^(#+)\s+(.+)$', line)
+            header_match = _HDR_RE.match(line)
             if header_match:
                 level = len(header_match.group(1))
                 title = header_match.group(2)
@@ -57,21 +59,16 @@ class HierarchicalTextSplitter:
                     "children": []
                 }
                 
-                # 处理层级关系
-                if current_section is None:
-                    hierarchy.append(new_section)
-                elif level > current_level:
-                    current_section["children"].append(new_section)
+                # 处理层级关系：回溯到最近的级别更小的祖先作为父级
+                while section_stack and section_stack[-1]["level"] >= level:
+                    section_stack.pop()
+                if section_stack:
+                    section_stack[-1]["children"].append(new_section)
                 else:
-                    # 回溯到适当的父级
-                    parent = self._find_parent(hierarchy, level)
-                    if parent:
-                        parent["children"].append(new_section)
-                    else:
-                        hierarchy.append(new_section)
+                    hierarchy.append(new_section)
                 
+                section_stack.append(new_section)
                 current_section = new_section
-                current_level = level
             else:
                 # 普通内容
                 if current_section:
@@ -85,29 +82,13 @@ class HierarchicalTextSplitter:
                         "children": []
                     }
                     hierarchy.append(default_section)
+                    section_stack.append(default_section)
                     current_section = default_section
-                    current_level = 1
         
         # 将层次结构转换为块
         chunks = self._create_chunks_from_hierarchy(hierarchy)
         return chunks
     
-    def _find_parent(self, hierarchy: List[Dict[str, Any]], level: int, current_path: List[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
-        """查找给定级别的父节点"""
-        if current_path is None:
-            current_path = []
-        
-        for section in hierarchy:
-            if section["level"] < level:
-                return section
-            
-            # 递归检查子节点
-            parent = self._find_parent(section.get("children", []), level, current_path + [section])
-            if parent:
-                return parent
-        
-        return None
-    
     def _create_chunks_from_hierarchy(self, hierarchy: List[Dict[str, Any]], parent_path: str = "") -> List[Dict[str, Any]]:
         """从层次结构创建文本块"""
         chunks = []
@@ -153,23 +134,26 @@ class HierarchicalTextSplitter:
     def _split_content(self, content: str) -> List[str]:
         """将大内容分割成更小的块"""
         chunks = []
-        current_chunk = ""
+        current_parts = []
+        current_size = 0  # 当前块拼接后的长度，避免反复计算len
         
-        # 按句子分割
-        sentences = re.split(r'(?<=[。！？.!?])', content)
-        sentences = [s.strip() for s in sentences if s.strip()]
+        # 按句子分割，每个句子只strip一次并过滤空句
+        sentences = list(filter(None, map(str.strip, _SENT_RE_MIX.split(content))))
         
         for sentence in sentences:
-            if len(current_chunk) + len(sentence) <= self.chunk_size:
-                if current_chunk:
-                    current_chunk += " " + sentence
+            sentence_size = len(sentence)
+            if current_size + sentence_size <= self.chunk_size:
+                if current_parts:
+                    current_size += 1 + sentence_size
                 else:
-                    current_chunk = sentence
+                    current_size = sentence_size
+                current_parts.append(sentence)
             else:
-                chunks.append(current_chunk)
-                current_chunk = sentence
+                chunks.append(" ".join(current_parts))
+                current_parts = [sentence]
+                current_size = sentence_size
         
-        if current_chunk:
-            chunks.append(current_chunk)
+        if current_parts:
+            chunks.append(" ".join(current_parts))
         
         return chunks
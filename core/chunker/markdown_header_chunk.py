@@ -2,6 +2,13 @@ import re
 from typing import List, Dict, Any, Optional, Tuple
 from docx import Document
 
+# 段落分隔（空行）
+_PARA_RE = re.compile(r'\n\s*\n')
+# 不是恰好一个空行（\n\n）的段落分隔，出现时才需要走正则分割
+_IRREGULAR_BLANKS_RE = re.compile(r'\n\s+\n')
+# 默认标题行（1到6个#加空格）
+_HDR_RE = re.compile(r'^(#{1,6}) (.+)$')
+
 class MarkdownHeaderTextSplitter:
     """基于Markdown标题的文本分割器"""
     
@@ -26,6 +33,15 @@ class MarkdownHeaderTextSplitter:
             ("#####", "标题5"),
             ("######", "标题6"),
         ]
+        
+        # 标题识别用一次正则匹配代替逐个前缀比较；自定义前缀按配置顺序组成分支，保持先匹配者优先
+        if headers_to_split_on:
+            self._header_re = re.compile(
+                "^(" + "|".join(re.escape(prefix) for prefix, _ in headers_to_split_on) + ") (.+)$"
+            )
+        else:
+            self._header_re = _HDR_RE
+        self._max_level = max(len(prefix) for prefix, _ in self.headers_to_split_on)
     
     def split_text(self, text: str) -> List[Dict[str, Any]]:
         """
@@ -42,7 +58,8 @@ class MarkdownHeaderTextSplitter:
         
         # 初始化结果列表和当前块
         chunks = []
-        current_headers = {}
+        # 按标题级别索引的当前标题，下标0不使用
+        current_headers = [None] * (self._max_level + 1)
         current_content = []
         
         for line in lines:
@@ -50,11 +67,10 @@ class MarkdownHeaderTextSplitter:
             header_match = None
             header_level = None
             
-            for header_prefix, header_name in self.headers_to_split_on:
-                if line.strip().startswith(header_prefix + " "):
-                    header_match = line.strip()[len(header_prefix) + 1:]
-                    header_level = len(header_prefix)
-                    break
+            m = self._header_re.match(line.strip())
+            if m:
+                header_match = m.group(2)
+                header_level = len(m.group(1))
             
             # 如果是标题行，处理当前内容块
             if header_match is not None:
@@ -63,19 +79,18 @@ class MarkdownHeaderTextSplitter:
                     chunk_text = "\n".join(current_content).strip()
                     if chunk_text:
                         chunks.append({
-                            "content": chunk_text,
-                            "metadata": {**current_headers}
+                            "text": chunk_text,
+                            "metadata": self._headers_metadata(current_headers)
                         })
                     current_content = []
                 
                 # 更新当前标题信息
                 # 移除所有等级大于等于当前标题的标题
-                for level in list(current_headers.keys()):
-                    if int(level) >= header_level:
-                        current_headers.pop(level)
+                for level in range(header_level, len(current_headers)):
+                    current_headers[level] = None
                 
                 # 添加当前标题
-                current_headers[str(header_level)] = header_match
+                current_headers[header_level] = header_match
                 
                 # 将标题行添加到当前内容
                 current_content.append(line)
@@ -88,19 +103,19 @@ class MarkdownHeaderTextSplitter:
             chunk_text = "\n".join(current_content).strip()
             if chunk_text:
                 chunks.append({
-                    "content": chunk_text,
-                    "metadata": {**current_headers}
+                    "text": chunk_text,
+                    "metadata": self._headers_metadata(current_headers)
                 })
         
         # 处理过大的块
         result_chunks = []
         for chunk in chunks:
-            if len(chunk["content"]) > self.chunk_size:
+            if len(chunk["text"]) > self.chunk_size:
                 # 如果块太大，进一步分割
-                sub_chunks = self._split_large_chunk(chunk["content"])
+                sub_chunks = self._split_large_chunk(chunk["text"])
                 for sub_chunk in sub_chunks:
                     result_chunks.append({
-                        "content": sub_chunk,
+                        "text": sub_chunk,
                         "metadata": {**chunk["metadata"]}
                     })
             else:
@@ -108,6 +123,11 @@ class MarkdownHeaderTextSplitter:
         
         return result_chunks
     
+    @staticmethod
+    def _headers_metadata(current_headers: List[Optional[str]]) -> Dict[str, str]:
+        """将按级别索引的标题列表转换为{级别: 标题}形式的元数据"""
+        return {str(level): title for level, title in enumerate(current_headers) if title is not None}
+    
     def _split_large_chunk(self, text: str) -> List[str]:
         """
         将大块文本分割成更小的块
@@ -118,9 +138,12 @@ class MarkdownHeaderTextSplitter:
         返回:
             分割后的文本列表
         """
-        # 按段落分割
-        paragraphs = re.split(r'\n\s*\n', text)
-        paragraphs = [p.strip() for p in paragraphs if p.strip()]
+        # 按段落分割，常见的\n\n分隔直接用str.split
+        if '\n\n' in text and not _IRREGULAR_BLANKS_RE.search(text):
+            paragraphs = text.split('\n\n')
+        else:
+            paragraphs = _PARA_RE.split(text)
+        paragraphs = list(filter(None, map(str.strip, paragraphs)))
         
         chunks = []
         current_chunk = []
@@ -1,4 +1,5 @@
 import re
+from bisect import bisect_left
 from typing import List, Dict, Any, Optional, Tuple
 
 class RecursiveCharacterTextSplitter:
@@ -28,6 +29,13 @@ class RecursiveCharacterTextSplitter:
             " ",     # 空格（单词）
             ""       # 字符
         ]
+        
+        # 所有非空分隔符合成一个带分组的正则，一次扫描即可找出全部分隔位置，
+        # 匹配到的分组序号对应分隔符的优先级
+        self._sep_levels = [level for level, sep in enumerate(self.separators) if sep]
+        self._sep_re = re.compile(
+            "(" + ")|(".join(re.escape(self.separators[level]) for level in self._sep_levels) + ")"
+        ) if self._sep_levels else None
     
     def split_text(self, text: str) -> List[Dict[str, Any]]:
         """
@@ -39,13 +47,16 @@ class RecursiveCharacterTextSplitter:
         返回:
             包含分割后文本块的列表，每个块包含内容和元数据
         """
-        chunks = self._split_text_recursive(text, self.separators)
+        # 先只计算各块在原文中的(起, 止)偏移，最后每块切片一次
+        offsets = self._find_separator_offsets(text)
+        spans = self._split_spans(0, len(text), 0, offsets)
+        chunks = self._slice_with_overlap(text, spans)
         
         # 将纯文本块转换为带元数据的字典格式
         result = []
         for i, chunk in enumerate(chunks):
             result.append({
-                "content": chunk,
+                "text": chunk,
                 "metadata": {
                     "chunk_index": i,
                     "chunk_size": len(chunk)
@@ -54,123 +65,94 @@ class RecursiveCharacterTextSplitter:
         
         return result
     
-    def _split_text_recursive(self, text: str, separators: List[str]) -> List[str]:
+    def _split_spans(self, start: int, end: int, first_level: int, offsets: List[List[int]]) -> List[Tuple[int, int]]:
         """
-        递归分割文本
+        递归分割text[start:end]，返回各块的偏移区间
+        
+        分隔符归属于其后的片段，因此相邻区间首尾相接、完整覆盖原文
         
         参数:
-            text: 要分割的文本
-            separators: 当前可用的分隔符列表
+            start: 待分割区间起始偏移
+            end: 待分割区间结束偏移
+            first_level: 当前可用的最高优先级分隔符下标
+            offsets: 各级分隔符在原文中的起始偏移（升序）
             
         返回:
-            分割后的文本块列表
+            分割后的(起, 止)偏移列表
         """
         # 如果文本长度小于块大小，直接返回
-        if len(text) <= self.chunk_size:
-            return [text]
-        
-        # 如果没有更多分隔符，则按块大小强制分割
-        if not separators:
-            return self._split_by_character(text)
-        
-        # 获取当前分隔符和剩余分隔符
-        separator = separators[0]
-        next_separators = separators[1:]
+        if end - start <= self.chunk_size:
+            return [(start, end)]
         
-        # 使用当前分隔符分割文本
-        splits = text.split(separator)
-        
-        # 如果分割后只有一个元素，使用下一个分隔符
-        if len(splits) == 1:
-            return self._split_text_recursive(text, next_separators)
-        
-        # 处理分割后的文本
-        chunks = []
-        current_chunk = []
-        current_length = 0
-        
-        for split in splits:
-            # 如果不是第一个分割，添加分隔符
-            if current_chunk:
-                split_with_separator = separator + split
-            else:
-                split_with_separator = split
+        for level in range(first_level, len(self.separators)):
+            # 空分隔符表示按字符分割
+            if not self.separators[level]:
+                break
             
-            split_length = len(split_with_separator)
+            # 取当前分隔符落在区间内的位置，没有则尝试下一个分隔符
+            level_offsets = offsets[level]
+            inner = level_offsets[bisect_left(level_offsets, start):bisect_left(level_offsets, end)]
+            if not inner:
+                continue
             
-            # 如果添加当前分割会超过块大小
-            if current_length + split_length > self.chunk_size:
-                # 如果当前块不为空，添加到结果
-                if current_chunk:
-                    chunk_text = "".join(current_chunk)
-                    chunks.append(chunk_text)
-                
-                # 如果当前分割本身超过块大小，递归处理
-                if split_length > self.chunk_size:
-                    sub_chunks = self._split_text_recursive(split_with_separator, next_separators)
-                    chunks.extend(sub_chunks)
-                    current_chunk = []
-                    current_length = 0
-                else:
-                    # 开始新的块
-                    current_chunk = [split_with_separator]
-                    current_length = split_length
-            else:
-                # 添加到当前块
-                current_chunk.append(split_with_separator)
-                current_length += split_length
-        
-        # 添加最后一个块
-        if current_chunk:
-            chunk_text = "".join(current_chunk)
-            chunks.append(chunk_text)
-        
-        # 处理块重叠
-        if self.chunk_overlap > 0:
-            return self._merge_chunks_with_overlap(chunks)
+            # 按片段边界贪心打包，超长片段用剩余分隔符递归处理
+            spans = []
+            chunk_start = chunk_end = start
+            for piece_start, piece_end in zip([start] + inner, inner + [end]):
+                if piece_end - chunk_start > self.chunk_size:
+                    if chunk_end > chunk_start:
+                        spans.append((chunk_start, chunk_end))
+                    if piece_end - piece_start > self.chunk_size:
+                        spans.extend(self._split_spans(piece_start, piece_end, level + 1, offsets))
+                        chunk_start = chunk_end = piece_end
+                        continue
+                    chunk_start = piece_start
+                chunk_end = piece_end
+            
+            if chunk_end > chunk_start:
+                spans.append((chunk_start, chunk_end))
+            return spans
         
-        return chunks
+        # 如果没有更多分隔符，则按块大小强制分割
+        return [(i, min(i + self.chunk_size, end)) for i in range(start, end, self.chunk_size)]
     
-    def _split_by_character(self, text: str) -> List[str]:
+    def _find_separator_offsets(self, text: str) -> List[List[int]]:
         """
-        按字符强制分割文本
+        用合成正则一次扫描全文，按优先级收集各分隔符的起始偏移
         
         参数:
-            text: 要分割的文本
+            text: 原始文本
             
         返回:
-            分割后的文本块列表
+            与separators等长的列表，每项为该分隔符的起始偏移（升序）
         """
-        chunks = []
-        for i in range(0, len(text), self.chunk_size):
-            chunks.append(text[i:i + self.chunk_size])
-        return chunks
+        offsets = [[] for _ in self.separators]
+        if self._sep_re is not None:
+            sep_levels = self._sep_levels
+            for match in self._sep_re.finditer(text):
+                offsets[sep_levels[match.lastindex - 1]].append(match.start())
+        return offsets
     
-    def _merge_chunks_with_overlap(self, chunks: List[str]) -> List[str]:
+    def _slice_with_overlap(self, text: str, spans: List[Tuple[int, int]]) -> List[str]:
         """
-        处理块之间的重叠
+        按偏移切出文本块，并处理块之间的重叠
+        
+        相邻区间首尾相接，重叠部分只需把起点前移，每块只切片一次
         
         参数:
-            chunks: 原始文本块列表
+            text: 原始文本
+            spans: 块的(起, 止)偏移列表
             
         返回:
             处理重叠后的文本块列表
         """
-        if not chunks or len(chunks) == 1:
-            return chunks
-        
-        result = []
-        for i in range(len(chunks)):
-            if i == 0:
-                # 第一个块不需要前向重叠
-                result.append(chunks[i])
-            else:
-                # 获取前一个块的末尾部分作为重叠
-                prev_chunk = chunks[i-1]
-                overlap_size = min(self.chunk_overlap, len(prev_chunk))
-                overlap_text = prev_chunk[-overlap_size:]
-                
-                # 将重叠部分添加到当前块的开头
-                result.append(overlap_text + chunks[i])
-        
-        return result
+        if self.chunk_overlap <= 0 or len(spans) <= 1:
+            return [text[start:end] for start, end in spans]
+        
+        # 第一个块不需要前向重叠，其余块的起点前移，但不超过前一个块的起点
+        chunks = [text[spans[0][0]:spans[0][1]]]
+        chunks.extend(
+            text[max(prev_start, start - self.chunk_overlap):end]
+            for (prev_start, _), (start, end) in zip(spans, spans[1:])
+        )
+        return chunks
@@ -1,11 +1,51 @@
 import re
 import numpy as np
-import re
-import numpy as np
 from typing import List, Dict, Any, Optional, Tuple
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 from core.embbeding_model import get_embedding
+from core.chunker.embedding_cache import EmbeddingCache
+
+# numba为可选依赖，未安装时使用同一份纯Python实现
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def _compute_boundaries(sims, lengths, threshold, min_chunk_size, max_chunk_size):
+    """
+    根据相邻段落相似度决定语义边界
+    
+    参数:
+        sims: 长度为n-1的相邻段落相似度
+        lengths: 长度为n的段落字符数
+        threshold: 相似度阈值
+        min_chunk_size: 最小块大小
+        max_chunk_size: 最大块大小
+        
+    返回:
+        长度为n-1的布尔数组，第i项为True表示第i+1个段落开始新块
+    """
+    boundaries = np.zeros(sims.shape[0], dtype=np.bool_)
+    current_len = lengths[0]
+    for i in range(sims.shape[0]):
+        next_len = lengths[i + 1]
+        if sims[i] < threshold:
+            # 相似度低于阈值认为是语义边界，但当前块过小时继续合并
+            split = current_len >= min_chunk_size
+        else:
+            # 相似度足够时合并，除非超过最大块大小
+            split = current_len + next_len > max_chunk_size
+        if split:
+            boundaries[i] = True
+            current_len = next_len
+        else:
+            current_len += 2 + next_len  # 段落之间以"\n\n"连接
+    return boundaries
+
+
+if NUMBA_AVAILABLE:
+    _compute_boundaries = njit(cache=True)(_compute_boundaries)
 
 
 class SemanticChunker:
@@ -25,6 +65,7 @@ class SemanticChunker:
         self.similarity_threshold = similarity_threshold
         self.min_chunk_size = min_chunk_size
         self.max_chunk_size = max_chunk_size
+        self._emb_cache = EmbeddingCache()
     
     def chunk_text(self, text: str) -> List[str]:
         """
@@ -44,73 +85,47 @@ class SemanticChunker:
         if len(paragraphs) <= 1:
             return paragraphs
         
-        # 计算每个段落的嵌入向量
-        embeddings = []
-        for para in paragraphs:
-            if self.embedding_model:
-                embedding = self.embedding_model.encode(para)
-            else:
-                # 如果没有提供嵌入模型，使用简单的TF-IDF作为替代
-                embedding = self._simple_embedding(para)
-            embeddings.append(embedding)
-        
-        # 计算相邻段落之间的相似度
-        similarities = []
-        for i in range(len(embeddings) - 1):
-            sim = self._compute_similarity(embeddings[i], embeddings[i+1])
-            similarities.append(sim)
+        # 批量计算所有段落的嵌入向量
+        if self.embedding_model:
+            embeddings = self._emb_cache.embed(paragraphs, self.embedding_model.encode)
+        else:
+            # 如果没有提供嵌入模型，使用简单的TF-IDF作为替代
+            embeddings = np.stack([self._simple_embedding(para) for para in paragraphs])
         
-        # 根据相似度确定语义边界
-        chunks = []
-        current_chunk = paragraphs[0]
+        # 一次性计算所有相邻段落之间的相似度
+        similarities = self._pairwise_adjacent_cosine(np.asarray(embeddings, dtype=np.float64))
         
-        for i in range(len(similarities)):
-            # 如果相似度低于阈值，认为是语义边界
-            if similarities[i] < self.similarity_threshold:
-                # 检查当前块大小
-                if len(current_chunk) >= self.min_chunk_size:
-                    chunks.append(current_chunk)
-                    current_chunk = paragraphs[i+1]
-                else:
-                    current_chunk += "\n\n" + paragraphs[i+1]
-            else:
-                # 检查添加下一段后是否超过最大块大小
-                if len(current_chunk) + len(paragraphs[i+1]) > self.max_chunk_size:
-                    chunks.append(current_chunk)
-                    current_chunk = paragraphs[i+1]
-                else:
-                    current_chunk += "\n\n" + paragraphs[i+1]
-        
-        # 添加最后一个块
-        if current_chunk:
-            chunks.append(current_chunk)
-        
-        return chunks
-
+        # 根据相似度确定语义边界，边界处切开后每块只join一次
+        lengths = np.fromiter((len(para) for para in paragraphs), dtype=np.int64, count=len(paragraphs))
+        boundaries = _compute_boundaries(
+            np.asarray(similarities, dtype=np.float64), lengths,
+            float(self.similarity_threshold), int(self.min_chunk_size), int(self.max_chunk_size)
+        )
+        starts = [0] + [int(i) + 1 for i in np.flatnonzero(boundaries)]
+        ends = starts[1:] + [len(paragraphs)]
+        return ["\n\n".join(paragraphs[start:end]) for start, end in zip(starts, ends)]
 
     def _simple_embedding(self, text: str) -> np.ndarray:
         """简单的文本表示方法，当没有嵌入模型时使用"""
-        # 这里使用字符频率作为简单的文本表示
-        chars = {}
-        for char in text:
-            chars[char] = chars.get(char, 0) + 1
-        
-        # 转换为向量
-        vec = np.zeros(256)  # 假设使用ASCII字符
-        for char, count in chars.items():
-            try:
-                vec[ord(char) % 256] = count / len(text)
-            except:
-                pass
+        # 这里使用字符频率作为简单的文本表示：按码点取模256统计直方图
+        # UTF-32编码后每个字符正好对应一个uint32码点，一次bincount完成统计
+        codepoints = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        vec = np.bincount(codepoints % 256, minlength=256).astype(np.float64)
+        vec /= max(len(text), 1)
         return vec
     
-    def _compute_similarity(self, vec1: np.ndarray, vec2: np.ndarray) -> float:
-        """计算两个向量之间的余弦相似度"""
-        dot_product = np.dot(vec1, vec2)
-        norm1 = np.linalg.norm(vec1)
-        norm2 = np.linalg.norm(vec2)
-        
-        if norm1 == 0 or norm2 == 0:
-            return 0
+    @staticmethod
+    def _pairwise_adjacent_cosine(embeddings: np.ndarray) -> np.ndarray:
+        """
+        计算相邻向量之间的余弦相似度
         
-        return dot_product / (norm1 * norm2)
\ No newline at end of file
+        参数:
+            embeddings: 形状为 (n, d) 的向量矩阵
+            
+        返回:
+            长度为 n-1 的相似度数组，第i项为第i与第i+1个向量的相似度（含零向量时为0）
+        """
+        # 先整体归一化一次，余弦相似度即相邻行的点积
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+        normalized = embeddings / norms
+        return np.einsum('ij,ij->i', normalized[:-1], normalized[1:])
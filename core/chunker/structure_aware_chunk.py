@@ -1,20 +1,29 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
 
-
+# 段落分隔（空行）与中英文句子分隔
+_PARA_RE = re.compile(r'\n\s*\n')
+_SENT_RE = re.compile(r'(?<=[。！？.!?])')
 
 
 class StructureAwareChunker:
     """结构感知分块器，保留文档的层级结构信息进行分块"""
     
-    def __init__(self, min_chunk_size=200, max_chunk_size=1000):
+    # 标题行（例如：# 标题，## 子标题等），允许行首尾空白，一次扫描整篇文档
+    _HDR_RE = re.compile(r'^[^\S\n]*(#{1,6})[^\S\n]+(\S.*?)[^\S\n]*$', re.MULTILINE)
+    
+    def __init__(self, min_chunk_size=200, max_chunk_size=1000, max_workers=1):
         """
         初始化结构感知分块器
         
         参数:
             min_chunk_size (int): 最小块大小（字符数）
             max_chunk_size (int): 最大块大小（字符数）
+            max_workers (int): 并行分块各章节文本的线程数，1表示顺序处理
         """
         self.min_chunk_size = min_chunk_size
         self.max_chunk_size = max_chunk_size
+        self.max_workers = max_workers
         
     def chunk_document(self, document):
         """
@@ -29,13 +38,46 @@ class StructureAwareChunker:
         # 1. 解析文档结构
         doc_structure = self._parse_document_structure(document)
         
-        # 2. 生成带结构上下文的分块
-        structured_chunks = []
+        # 2. 按先序展开所有章节（父章节在前，子章节依次在后），
+        #    同时由父章节的路径和上下文延伸出本章节的，路径节点在父子章节间共享
+        sections = []
+        paths = []
+        contexts = []
+        stack = [(section, [], None) for section in reversed(doc_structure)]
+        while stack:
+            section, parent_path, parent_context = stack.pop()
+            component = self._get_path_component(section)
+            path = parent_path + [component]
+            
+            # 上下文为各层可显示节点以" > "连接，None表示尚无可显示节点
+            label = self._format_path_component(component)
+            if label is None:
+                context = parent_context
+            elif parent_context is None:
+                context = label
+            else:
+                context = f"{parent_context} > {label}"
+            
+            sections.append(section)
+            paths.append(path)
+            contexts.append(context or "")
+            stack.extend(
+                (subsection, path, context)
+                for subsection in reversed(section.get('subsections', []))
+            )
         
-        for section in doc_structure:
-            # 处理每个章节及其子章节
-            section_chunks = self._process_section(section)
-            structured_chunks.extend(section_chunks)
+        # 3. 各章节文本相互独立，可并行分块；map保持章节顺序
+        contents = [section['content'] for section in sections]
+        if self.max_workers > 1 and len(sections) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(sections))) as executor:
+                section_texts = list(executor.map(self._chunk_text, contents))
+        else:
+            section_texts = map(self._chunk_text, contents)
+        
+        # 4. 生成带结构上下文的分块
+        structured_chunks = []
+        for section, path, context, content_chunks in zip(sections, paths, contexts, section_texts):
+            structured_chunks.extend(self._process_section(section, path, context, content_chunks))
             
         return structured_chunks
     
@@ -53,61 +95,52 @@ class StructureAwareChunker:
         structure = []
         
         if isinstance(document, str):
-            # 文本文档解析逻辑
-            lines = document.split('\n')
-            current_section = None
+            # 文本文档解析逻辑：一次找出所有标题，标题之间的原文切片即为章节内容
+            matches = list(self._HDR_RE.finditer(document))
             
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                    
-                # 检测标题（例如：# 标题，## 子标题等）
-                header_match = re.match(r'^(#{1,6})\s+(.+)$', line)
-                if header_match:
-                    level = len(header_match.group(1))
-                    title = header_match.group(2)
-                    
-                    new_section = {
-                        'id': f"section_{len(structure)}",
-                        'type': 'section',
-                        'level': level,
-                        'title': title,
-                        'number': str(len(structure) + 1),
-                        'content': '',
-                        'subsections': [],
-                        'parent': None
-                    }
-                    
-                    # 处理层级关系
-                    if current_section is None:
-                        structure.append(new_section)
-                    else:
-                        if level > current_section.get('level', 1):
-                            new_section['parent'] = current_section
-                            current_section['subsections'].append(new_section)
-                        else:
-                            structure.append(new_section)
-                    
-                    current_section = new_section
+            # 从根到当前章节的祖先栈，栈内章节级别严格递增
+            section_stack = []
+            
+            # 第一个标题之前的内容，创建默认章节
+            preface = document[:matches[0].start() if matches else len(document)].strip()
+            if preface:
+                default_section = {
+                    'id': 'default_section',
+                    'type': 'section',
+                    'level': 1,
+                    'title': '文档内容',
+                    'number': '1',
+                    'content': preface,
+                    'subsections': [],
+                    'parent': None
+                }
+                structure.append(default_section)
+                section_stack.append(default_section)
+            
+            for index, match in enumerate(matches):
+                level = len(match.group(1))
+                content_end = matches[index + 1].start() if index + 1 < len(matches) else len(document)
+                
+                new_section = {
+                    'id': f"section_{len(structure)}",
+                    'type': 'section',
+                    'level': level,
+                    'title': match.group(2),
+                    'number': str(len(structure) + 1),
+                    'content': document[match.end():content_end].strip(),
+                    'subsections': [],
+                    'parent': None
+                }
+                
+                # 处理层级关系：回溯到最近的级别更小的祖先作为父级
+                while section_stack and section_stack[-1]['level'] >= level:
+                    section_stack.pop()
+                if section_stack:
+                    new_section['parent'] = section_stack[-1]
+                    section_stack[-1]['subsections'].append(new_section)
                 else:
-                    # 普通段落内容
-                    if current_section:
-                        current_section['content'] += line + '\n'
-                    else:
-                        # 没有标题的内容，创建默认章节
-                        default_section = {
-                            'id': 'default_section',
-                            'type': 'section',
-                            'level': 1,
-                            'title': '文档内容',
-                            'number': '1',
-                            'content': line + '\n',
-                            'subsections': [],
-                            'parent': None
-                        }
-                        structure.append(default_section)
-                        current_section = default_section
+                    structure.append(new_section)
+                section_stack.append(new_section)
         else:
             # 结构化文档（如JSON、XML等）的解析逻辑
             # 这里需要根据具体的文档格式进行定制
@@ -115,41 +148,33 @@ class StructureAwareChunker:
             
         return structure
     
-    def _process_section(self, section):
+    def _process_section(self, section, path, context, content_chunks):
         """
-        处理单个章节，保留结构上下文
+        处理单个章节（不含子章节），保留结构上下文
         
         参数:
             section (Dict): 章节信息
+            path (List[Dict]): 从根到当前章节的结构路径，同一章节的块共用
+            context (str): 格式化的结构上下文
+            content_chunks (List[str]): 该章节文本的分块结果
             
         返回:
             List[Dict]: 该章节的结构化块列表
         """
         section_chunks = []
         
-        # 获取结构路径
-        path = self._get_structure_path(section)
-        
-        # 分块处理文本内容
-        content_chunks = self._chunk_text(section['content'])
-        
         for i, chunk in enumerate(content_chunks):
             # 为每个块添加结构路径作为前缀或元数据
             structured_chunk = {
                 'text': chunk,
                 'structure_path': path,  # 存储结构路径
-                'structure_context': self._format_structure_context(path),  # 格式化的上下文
+                'structure_context': context,  # 格式化的上下文
                 'is_first_chunk': i == 0,
                 'is_last_chunk': i == len(content_chunks) - 1,
                 'section_id': section['id']
             }
             section_chunks.append(structured_chunk)
             
-        # 递归处理子章节
-        for subsection in section.get('subsections', []):
-            subsection_chunks = self._process_section(subsection)
-            section_chunks.extend(subsection_chunks)
-            
         return section_chunks
     
     def _chunk_text(self, text):
@@ -164,93 +189,92 @@ class StructureAwareChunker:
         """
         chunks = []
         
-        # 按段落分割
-        paragraphs = re.split(r'\n\s*\n', text)
+        # 按段落分割，去掉空段落
+        paragraphs = [para.strip() for para in _PARA_RE.split(text)]
+        paragraphs = [para for para in paragraphs if para]
         
-        current_chunk = ""
+        # 收集段落并记录拼接后的长度，块确定时才join
+        current_parts = []
+        current_size = 0
         for para in paragraphs:
-            para = para.strip()
-            if not para:
-                continue
+            para_size = len(para)
                 
             # 如果当前块加上新段落超过最大块大小，保存当前块并开始新块
-            if len(current_chunk) + len(para) > self.max_chunk_size:
-                if current_chunk:
-                    chunks.append(current_chunk)
+            if current_size + para_size > self.max_chunk_size:
+                if current_parts:
+                    chunks.append("\n\n".join(current_parts))
+                current_parts = []
+                current_size = 0
                 
-                # 如果段落本身超过最大块大小，进一步分割
-                if len(para) > self.max_chunk_size:
-                    # 按句子分割
-                    sentences = re.split(r'(?<=[。！？.!?])', para)
-                    temp_chunk = ""
+                # 如果段落本身超过最大块大小，只对该段落按句子进一步分割
+                if para_size > self.max_chunk_size:
+                    temp_parts = []
+                    temp_size = 0
                     
-                    for sentence in sentences:
+                    for sentence in _SENT_RE.split(para):
                         if not sentence.strip():
                             continue
-                            
-                        if len(temp_chunk) + len(sentence) > self.max_chunk_size:
-                            if temp_chunk:
-                                chunks.append(temp_chunk)
-                            temp_chunk = sentence
+                        
+                        sentence_size = len(sentence)
+                        if temp_size + sentence_size > self.max_chunk_size:
+                            if temp_parts:
+                                chunks.append("".join(temp_parts))
+                            temp_parts = [sentence]
+                            temp_size = sentence_size
                         else:
-                            temp_chunk += sentence
+                            temp_parts.append(sentence)
+                            temp_size += sentence_size
                     
-                    if temp_chunk:
-                        current_chunk = temp_chunk
+                    if temp_parts:
+                        current_parts = ["".join(temp_parts)]
+                        current_size = temp_size
                 else:
-                    current_chunk = para
+                    current_parts = [para]
+                    current_size = para_size
             else:
-                if current_chunk:
-                    current_chunk += "\n\n" + para
+                if current_parts:
+                    current_size += 2 + para_size
                 else:
-                    current_chunk = para
+                    current_size = para_size
+                current_parts.append(para)
                     
         # 添加最后一个块
-        if current_chunk and len(current_chunk) >= self.min_chunk_size:
-            chunks.append(current_chunk)
+        if current_parts and current_size >= self.min_chunk_size:
+            chunks.append("\n\n".join(current_parts))
             
         return chunks
     
-    def _get_structure_path(self, section):
+    def _get_path_component(self, section):
         """
-        获取章节的完整结构路径
+        获取章节在结构路径中的节点
         
         参数:
             section (Dict): 章节信息
             
         返回:
-            List[Dict]: 从根到当前章节的路径
+            Dict: 章节的路径节点
         """
-        path = []
-        current = section
-        while current:
-            path_component = {
-                'type': current.get('type', 'section'),  # section, list_item, etc.
-                'number': current.get('number'),         # 1, 2, (1), etc.
-                'title': current.get('title', '')        # 章节标题
-            }
-            path.insert(0, path_component)
-            current = current.get('parent')
-        return path
+        return {
+            'type': section.get('type', 'section'),  # section, list_item, etc.
+            'number': section.get('number'),         # 1, 2, (1), etc.
+            'title': section.get('title', '')        # 章节标题
+        }
     
-    def _format_structure_context(self, path):
+    def _format_path_component(self, item):
         """
-        格式化结构上下文为可读文本
+        格式化结构路径中的单个节点
         
         参数:
-            path (List[Dict]): 结构路径
+            item (Dict): 路径节点
             
         返回:
-            str: 格式化后的结构上下文
+            str或None: 节点的可读文本，不需要显示的节点返回None
         """
-        context = []
-        for item in path:
-            if item['type'] == 'section' and item['title']:
-                context.append(f"{item['number'] or ''} {item['title']}")
-            elif item['type'] == 'list_item':
-                context.append(f"{item['number'] or ''}")
-        return " > ".join(context)
-
+        if item['type'] == 'section' and item['title']:
+            return f"{item['number'] or ''} {item['title']}"
+        if item['type'] == 'list_item':
+            return f"{item['number'] or ''}"
+        return None
 
 
 # if __name__ == "__main__":
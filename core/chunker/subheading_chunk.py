@@ -4,6 +4,9 @@ from typing import List, Dict, Any, Optional, Tuple
 class SubheadingTextSplitter:
     """基于小标题的文本分割器，保留大标题和内容结构"""
     
+    # Markdown标题行（# 到 ######，标记后恰好一个空格，允许行首尾空白），一次扫描整篇文档
+    _HDR_RE = re.compile(r'^[^\S\n]*(#{1,6}) ([^\n]*?\S)[^\S\n]*$', re.MULTILINE)
+    
     def __init__(self, 
                  chunk_size=1000, 
                  chunk_overlap=200, 
@@ -22,9 +25,6 @@ class SubheadingTextSplitter:
         self.chunk_overlap = chunk_overlap
         self.main_headers_level = main_headers_level
         self.subheaders_level = subheaders_level
-        
-        # 默认的Markdown标题标记
-        self.header_markers = ["#", "##", "###", "####", "#####", "######"]
     
     def split_text(self, text: str) -> List[Dict[str, Any]]:
         """
@@ -36,127 +36,93 @@ class SubheadingTextSplitter:
         返回:
             包含分割后文本块的列表，每个块包含内容和元数据
         """
-        # 分割文本为行
-        lines = text.split('\n')
-        
-        # 初始化结果列表和当前块
+        # 初始化结果列表（块在确定时直接写成最终格式）和当前块
         chunks = []
         current_main_headers = {}  # 存储主标题
         current_sub_headers = {}   # 存储子标题
-        current_content = []
+        # 当前块在原文中的起始偏移，块确定时才切片
+        chunk_start = 0
         
         # 当前标题级别状态
         current_section = None
-        is_in_main_header = False
-        current_header_level = 0
         
-        for line in lines:
-            # 检查是否是标题行
-            header_match = None
-            header_level = 0
+        for match in self._HDR_RE.finditer(text):
+            header_level = len(match.group(1))
+            header_match = match.group(2)
             
-            # 检测标题级别
-            for level, marker in enumerate(self.header_markers, 1):
-                if line.strip().startswith(marker + " "):
-                    header_match = line.strip()[len(marker) + 1:]
-                    header_level = level
-                    break
+            # 确定标题类型（主标题或子标题）
+            is_main_header = header_level <= self.main_headers_level
             
-            # 处理标题行
-            if header_match is not None:
-                # 确定标题类型（主标题或子标题）
-                is_main_header = header_level <= self.main_headers_level
-                
-                # 如果是子标题级别标题，处理当前内容块
-                if header_level in self.subheaders_level:
-                    # 如果有累积的内容，创建一个新块
-                    if current_content:
-                        chunk_text = "\n".join(current_content).strip()
-                        if chunk_text:
-                            chunks.append({
-                                "content": chunk_text,
-                                "metadata": {
-                                    **current_main_headers,  # 主标题信息
-                                    **current_sub_headers,   # 子标题信息
-                                    "main_header": current_main_headers.get(str(self.main_headers_level), ""),
-                                    "sub_header": current_section
-                                }
-                            })
-                        current_content = []
-                
-                # 更新标题信息
-                if is_main_header:
-                    # 对于主标题，更新主标题信息
-                    current_main_headers[str(header_level)] = header_match
-                    # 清除所有子标题
-                    current_sub_headers = {}
-                    is_in_main_header = True
-                    current_section = header_match
-                else:
-                    # 对于子标题，更新子标题信息
-                    # 移除所有等级大于等于当前子标题的子标题
-                    for level in list(current_sub_headers.keys()):
-                        if int(level) >= header_level:
-                            current_sub_headers.pop(level)
-                    
-                    # 添加当前子标题
-                    current_sub_headers[str(header_level)] = header_match
-                    current_section = header_match
-                
-                # 将标题行添加到当前内容
-                current_content.append(line)
-                current_header_level = header_level
-            else:
-                # 非标题行，直接添加到当前内容
-                current_content.append(line)
-        
-        # 处理最后一个块
-        if current_content:
-            chunk_text = "\n".join(current_content).strip()
-            if chunk_text:
-                chunks.append({
-                    "content": chunk_text,
-                    "metadata": {
-                        **current_main_headers,
-                        **current_sub_headers,
+            # 如果是子标题级别标题，处理当前内容块（标题行之前的所有内容）
+            if header_level in self.subheaders_level:
+                chunk_text = text[chunk_start:match.start()].strip()
+                if chunk_text:
+                    self._append_chunk(chunks, chunk_text, {
+                        **current_main_headers,  # 主标题信息
+                        **current_sub_headers,   # 子标题信息
                         "main_header": current_main_headers.get(str(self.main_headers_level), ""),
                         "sub_header": current_section
-                    }
-                })
-        
-        # 处理过大的块
-        result_chunks = []
-        for chunk in chunks:
-            if len(chunk["content"]) > self.chunk_size:
-                # 如果块太大，进一步分割
-                sub_chunks = self._split_large_chunk(chunk["content"])
-                for i, sub_chunk in enumerate(sub_chunks):
-                    # 为分割后的块添加序号信息
-                    metadata = {**chunk["metadata"]}
-                    metadata["is_split"] = True
-                    metadata["split_index"] = i + 1
-                    metadata["total_splits"] = len(sub_chunks)
-                    
-                    result_chunks.append({
-                        "content": sub_chunk,
-                        "metadata": metadata
                     })
+                # 新块从该标题行开始
+                chunk_start = match.start()
+            
+            # 更新标题信息
+            if is_main_header:
+                # 对于主标题，更新主标题信息
+                current_main_headers[str(header_level)] = header_match
+                # 清除所有子标题
+                current_sub_headers = {}
+                current_section = header_match
             else:
-                result_chunks.append({
-                    "content": chunk["content"],
-                    "metadata": {**chunk["metadata"], "is_split": False}
-                })
+                # 对于子标题，更新子标题信息
+                # 移除所有等级大于等于当前子标题的子标题
+                for level in list(current_sub_headers.keys()):
+                    if int(level) >= header_level:
+                        current_sub_headers.pop(level)
+                
+                # 添加当前子标题
+                current_sub_headers[str(header_level)] = header_match
+                current_section = header_match
         
-        # 格式化最终结果
-        formatted_chunks = []
-        for chunk in result_chunks:
-            # 标准化为统一格式
-            formatted_chunks.append({
-                "text": chunk["content"],
-                "metadata": chunk["metadata"]
+        # 处理最后一个块
+        chunk_text = text[chunk_start:].strip()
+        if chunk_text:
+            self._append_chunk(chunks, chunk_text, {
+                **current_main_headers,
+                **current_sub_headers,
+                "main_header": current_main_headers.get(str(self.main_headers_level), ""),
+                "sub_header": current_section
             })
         
-        return formatted_chunks
+        return chunks
+    
+    def _append_chunk(self, chunks: List[Dict[str, Any]], content: str, metadata: Dict[str, Any]):
+        """
+        将一个小标题块追加到结果中，过大的块就地进一步分割
+        
+        参数:
+            chunks: 结果列表，元素格式为 {"text": ..., "metadata": ...}
+            content: 块文本
+            metadata: 块的标题元数据（未分割时直接作为该块的元数据）
+        """
+        if len(content) <= self.chunk_size:
+            metadata["is_split"] = False
+            chunks.append({"text": content, "metadata": metadata})
+            return
+        
+        # 如果块太大，进一步分割，并为分割后的块添加序号信息
+        sub_chunks = self._split_large_chunk(content)
+        total_splits = len(sub_chunks)
+        for i, sub_chunk in enumerate(sub_chunks, 1):
+            chunks.append({
+                "text": sub_chunk,
+                "metadata": {
+                    **metadata,
+                    "is_split": True,
+                    "split_index": i,
+                    "total_splits": total_splits
+                }
+            })
     
     def _split_large_chunk(self, text: str) -> List[str]:
         """
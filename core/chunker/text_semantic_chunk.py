@@ -1,9 +1,11 @@
 import re
 import numpy as np
 from typing import List, Dict, Any, Optional, Tuple
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from core.embbeding_model import get_embedding
+from core.embbeding_model import get_embeddings
+from core.chunker.embedding_cache import EmbeddingCache, default_embedding_cache
+
+# 中英文句子分隔（保留句末标点）
+_SENT_RE = re.compile(r'(?<=[。！？.!?])')
 
 
 
@@ -24,6 +26,8 @@ class TextSemanticChunker:
         self.embedding_model = embedding_model
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        # 自定义模型的向量与默认模型不通用，各自使用独立缓存
+        self._emb_cache = EmbeddingCache() if embedding_model else default_embedding_cache
     
     def create_chunks(self, text: str) -> List[Dict[str, Any]]:
         """
@@ -36,71 +40,80 @@ class TextSemanticChunker:
             包含文本块和元数据的字典列表
         """
         # 首先按句子分割
-        sentences = re.split(r'(?<=[。！？.!?])', text)
+        sentences = _SENT_RE.split(text)
         sentences = [s.strip() for s in sentences if s.strip()]
         
-        # 创建块
+        # 创建块：当前块以句子列表及对应长度表示，记录总长度，输出时才join
         chunks = []
-        current_chunk = ""
         current_sentences = []
+        current_lens = []
+        current_len = 0
         
         for sentence in sentences:
+            sentence_len = len(sentence)
             # 如果添加当前句子会超过块大小，保存当前块并开始新块
-            if len(current_chunk) + len(sentence) > self.chunk_size and current_chunk:
+            if current_len + sentence_len > self.chunk_size and current_sentences:
                 # 创建块对象
                 chunk_obj = {
-                    "text": current_chunk,
+                    "text": "".join(current_sentences),
                     "sentences": current_sentences,
                     "metadata": {
-                        "char_count": len(current_chunk),
+                        "char_count": current_len,
                         "sentence_count": len(current_sentences)
                     }
                 }
-                
-                # 如果有嵌入模型，添加嵌入向量
-                if self.embedding_model:
-                    chunk_obj["embedding"] = self.embedding_model.encode(current_chunk)
-                else:
-                    chunk_obj["embedding"] = get_embedding(current_chunk)
-                
                 chunks.append(chunk_obj)
                 
-                # 开始新块，保留重叠部分
-                overlap_text = ""
-                overlap_sentences = []
-                
-                # 从后向前计算重叠部分
+                # 开始新块，保留重叠部分：从后向前找出总长度不超过chunk_overlap的最长句子后缀
+                start = len(current_sentences)
                 char_count = 0
-                for s in reversed(current_sentences):
-                    if char_count + len(s) <= self.chunk_overlap:
-                        overlap_text = s + overlap_text
-                        overlap_sentences.insert(0, s)
-                        char_count += len(s)
-                    else:
-                        break
+                while start > 0 and char_count + current_lens[start - 1] <= self.chunk_overlap:
+                    start -= 1
+                    char_count += current_lens[start]
                 
-                current_chunk = overlap_text + sentence
-                current_sentences = overlap_sentences + [sentence]
+                current_sentences = current_sentences[start:]
+                current_sentences.append(sentence)
+                current_lens = current_lens[start:]
+                current_lens.append(sentence_len)
+                current_len = char_count + sentence_len
             else:
-                current_chunk += sentence
                 current_sentences.append(sentence)
+                current_lens.append(sentence_len)
+                current_len += sentence_len
         
         # 添加最后一个块
-        if current_chunk:
+        if current_sentences:
             chunk_obj = {
-                "text": current_chunk,
+                "text": "".join(current_sentences),
                 "sentences": current_sentences,
                 "metadata": {
-                    "char_count": len(current_chunk),
+                    "char_count": current_len,
                     "sentence_count": len(current_sentences)
                 }
             }
             
-            if self.embedding_model:
-                chunk_obj["embedding"] = self.embedding_model.encode(current_chunk)
-            else:
-                chunk_obj["embedding"] = get_embedding(current_chunk)
-            
             chunks.append(chunk_obj)
         
+        # 所有块确定后一次批量计算嵌入向量，再按顺序回填
+        if chunks:
+            texts = [chunk_obj["text"] for chunk_obj in chunks]
+            embeddings = self._embed_batch(texts)
+            for chunk_obj, embedding in zip(chunks, embeddings):
+                # 缓存中保存float32数组，写入分块时才转为列表
+                chunk_obj["embedding"] = embedding if self.embedding_model else embedding.tolist()
+        
         return chunks
+    
+    def _embed_batch(self, texts: List[str]) -> List[Any]:
+        """
+        批量获取文本嵌入向量，已缓存的文本不再调用模型
+        
+        参数:
+            texts: 文本列表
+            
+        返回:
+            与texts顺序一致的float32向量数组列表
+        """
+        if self.embedding_model:
+            return self._emb_cache.embed(texts, lambda batch: self.embedding_model.encode(batch, batch_size=32))
+        return self._emb_cache.embed(texts, get_embeddings)
@@ -2,6 +2,8 @@ from modelscope.pipelines import pipeline
 from modelscope.utils.constant import Tasks
 import numpy as np
 
+from core.vector_ops import normalize_vector, normalize_rows
+
 
 # embedding model
 model_id = "iic/nlp_gte_sentence-embedding_chinese-large"
@@ -17,10 +19,31 @@ def get_embedding(text):
     }
     result = pipeline_se(input=inputs)
     text = result['text_embedding'][0]
-    vector = np.array(text, dtype=np.float32)
-    vector = (vector / np.linalg.norm(vector))[:512]
+    vector = normalize_vector(text)[:512]
     return vector.tolist()  
 
+def get_embeddings(texts, batch_size=64):
+    """
+    批量生成文本向量，每批调用一次模型
+    
+    参数:
+        texts: 文本列表
+        batch_size: 每批送入模型的文本数量
+        
+    返回:
+        np.ndarray: 形状为 (len(texts), 512) 的float32归一化向量矩阵
+    """
+    batches = []
+    for start in range(0, len(texts), batch_size):
+        inputs = {
+            "source_sentence": list(texts[start:start + batch_size])
+        }
+        result = pipeline_se(input=inputs)
+        batches.append(np.asarray(result['text_embedding'], dtype=np.float32))
+    if not batches:
+        return np.empty((0, 512), dtype=np.float32)
+    return normalize_rows(np.vstack(batches))[:, :512]
+
 
 
 
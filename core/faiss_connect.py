@@ -6,44 +6,263 @@ from typing import List, Dict, Any, Optional, Tuple, Union
 import logging
 import time
 import json
+import orjson
 from datetime import datetime
 import urllib.parse
 import math
 import traceback
+import tempfile
+import atexit
+import warnings
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 
 logger = logging.getLogger(__name__)
 
+# 元数据、文件注册表、变更历史以orjson读写，文件格式仍为JSON（UTF-8，不转义非ASCII字符）；
+# 允许非字符串键（如按整数向量ID组织的元数据）和numpy类型
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+# mkstemp创建的临时文件权限为0600，替换目标前改为按umask创建普通文件时的权限
+_umask = os.umask(0)
+os.umask(_umask)
+_NEW_FILE_MODE = 0o666 & ~_umask
+
+# IVF集合在向量数达到该值（64个倒排列表、每个列表39个训练样本）前以Flat索引保存，避免小批量首次上传
+# 就把nlist固定得很小；训练后向量数增长到按其计算的nlist达到当前的_IVF_RETRAIN_GROWTH倍时重新训练
+_IVF_MIN_TRAIN_VECTORS = 39 * 64
+_IVF_RETRAIN_GROWTH = 4
+
+# SQ8集合在向量数达到该值前以Flat索引保存，之后用全部真实向量训练量化器（按各维实际取值范围划分256级）
+_SQ8_MIN_TRAIN_VECTORS = 1000
+
+# 集合列表缓存的最长有效期（秒），用于发现其他进程创建或删除的集合；本进程内的变化会立即使缓存失效
+_COLLECTIONS_CACHE_TTL = 5.0
+
+
+@lru_cache(maxsize=4096)
+def _safe_collection_name(collection_name: str) -> str:
+    """集合名称URL编码后的文件名前缀（各_get_*_path频繁调用，按名称缓存）"""
+    return urllib.parse.quote(collection_name, safe='')
+
+
+def _atomic_write_file(path: str, write_fn) -> None:
+    """
+    原子地写入文件：write_fn先写入同目录下的临时文件，在写入句柄上fsync后再os.replace替换目标，
+    读者只会看到完整的旧文件或新文件，也不会原地覆盖正被内存映射的文件。
+    每次写入使用唯一的临时文件名，并发写入同一路径时互不干扰（最后完成替换的生效）
+
+    Args:
+        path: 目标文件路径
+        write_fn: 接收以二进制写模式打开的文件对象的写入函数
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        os.chmod(tmp_path, _NEW_FILE_MODE)
+        with os.fdopen(fd, 'wb') as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _dump_json_file(path: str, obj: Any, indent: bool = False) -> None:
+    """将对象以JSON格式原子地写入文件"""
+    option = _ORJSON_OPTIONS | orjson.OPT_INDENT_2 if indent else _ORJSON_OPTIONS
+    data = orjson.dumps(obj, option=option)
+    _atomic_write_file(path, lambda f: f.write(data))
+
+
+def _stat_or_none(path: str) -> Optional[os.stat_result]:
+    """返回文件的os.stat结果，文件不存在时返回None（一次系统调用同时得到是否存在和大小）"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _load_json_file(path: str) -> Any:
+    """从文件读取JSON，解析失败时抛出json.JSONDecodeError（orjson.JSONDecodeError是其子类）"""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def _load_legacy_pickle(path: str) -> Any:
+    """
+    读取旧版pickle格式的数据文件（读取后由调用方转换为JSON）
+
+    pickle已弃用；设置环境变量FAISS_DISALLOW_PICKLE=1时拒绝读取，避免反序列化不可信的文件
+    """
+    if os.environ.get("FAISS_DISALLOW_PICKLE") == "1":
+        raise ValueError(f"已通过FAISS_DISALLOW_PICKLE禁止加载pickle格式文件: {path}")
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    warnings.warn(f"pickle格式的数据文件已弃用，将转换为JSON: {path}", DeprecationWarning, stacklevel=2)
+    return data
+
+
+def _append_json_line(path: str, obj: Any, fsync: bool = False) -> None:
+    """将对象序列化为一行JSON追加到JSON Lines文件末尾，不重写已有内容；fsync为True时写入后同步到磁盘"""
+    with open(path, 'a+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        if end:
+            f.seek(end - 1)
+            if f.read(1) != b'\n':
+                # 上次追加中途中断留下了不完整的末行，先截掉，否则新记录会与之拼成一行而无法解析
+                f.seek(0)
+                valid_end = f.read().rfind(b'\n') + 1
+                f.truncate(valid_end)
+                logger.warning(f"截掉JSON Lines文件中不完整的末行: {path}")
+        f.write(orjson.dumps(obj, option=_ORJSON_OPTIONS) + b'\n')
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _read_json_lines(path: str) -> List[Any]:
+    """逐行读取JSON Lines文件，跳过空行和无法解析的行（如追加中途中断留下的不完整记录）"""
+    records = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                # 不能在此停止读取，否则其后追加的记录在每次加载时都会被丢弃
+                logger.warning(f"忽略JSON Lines文件中无法解析的记录: {path}")
+                continue
+    return records
+
+
+def _share_metadata_strings(collection_metadata: Union[List[Dict], Dict[str, Dict]]) -> None:
+    """
+    让各条目"metadata"字段中相同的字符串值共享同一对象
+
+    同一文件的块在file_name、file_path、document_id、标题等字段上取值相同，
+    从JSON加载时每个条目都会各自创建一份，合并后显著降低大集合的常驻内存。
+    条目的结构和取值不变，只是原地替换为相等的共享对象。
+
+    Args:
+        collection_metadata: 集合元数据（条目列表或以向量ID为键的字典）
+    """
+    entries = collection_metadata.values() if isinstance(collection_metadata, dict) else collection_metadata
+    pool = {}
+    for entry in entries:
+        fields = entry.get("metadata") if isinstance(entry, dict) else None
+        if isinstance(fields, dict):
+            for key, value in fields.items():
+                if isinstance(value, str):
+                    fields[key] = pool.setdefault(value, value)
+
+
+def _set_file_fields(entries, file_name: str, file_path: str) -> None:
+    """为一批元数据条目写入所属文件的file_name和file_path"""
+    for entry in entries:
+        fields = entry.setdefault("metadata", {})
+        fields["file_name"] = file_name
+        fields["file_path"] = file_path
+
+
+def _set_file_fields_dict(collection_metadata: Dict[str, Dict], start: int, count: int,
+                          file_name: str, file_path: str) -> None:
+    """以向量ID字符串为键的元数据：为ID在[start, start+count)内且存在的条目写入文件信息"""
+    keys = (str(vector_idx) for vector_idx in range(start, start + count))
+    _set_file_fields((collection_metadata[key] for key in keys if key in collection_metadata), file_name, file_path)
+
+
+def _set_file_fields_list(collection_metadata: List[Dict], start: int, count: int,
+                          file_name: str, file_path: str) -> None:
+    """列表形式的元数据：为下标在[start, start+count)内且存在的条目写入文件信息"""
+    _set_file_fields(collection_metadata[start:start + count], file_name, file_path)
+
+
+# 存在延迟写入、尚未落盘集合的管理器，进程退出时统一写入；落盘后即移除，不延长管理器的生命周期
+_managers_pending_flush = set()
+_managers_pending_flush_lock = threading.Lock()
+
+
+@atexit.register
+def _flush_pending_managers() -> None:
+    """进程退出时写入所有管理器中尚未落盘的集合"""
+    with _managers_pending_flush_lock:
+        managers = list(_managers_pending_flush)
+    for manager in managers:
+        manager.flush()
+
+
+def _with_collection_lock(method):
+    """
+    FaissManager方法装饰器：方法以集合名称为第一个参数，执行期间持有该集合的锁，
+    使同一集合的写入、删除、搜索和一致性修复在多个线程中串行执行（可重入，方法间可互相调用）
+    """
+    @wraps(method)
+    def wrapper(self, collection_name, *args, **kwargs):
+        with self._collection_lock(collection_name):
+            return method(self, collection_name, *args, **kwargs)
+    return wrapper
+
+
 class FaissManager:
     """
     FAISS向量数据库管理类，提供创建、查询、写入、删除等操作，
     并支持文件级别的管理，包括文件版本控制和文件替换
     """
     
-    def __init__(self, index_folder: str = "../db/faiss_indexes"):
+    def __init__(self, index_folder: str = "../db/faiss_indexes", max_resident_bytes: Optional[int] = None,
+                 preload: bool = False):
         """
         初始化FAISS管理器
         
         Args:
             index_folder: 索引文件夹路径
-        """
+            max_resident_bytes: 常驻内存的索引总大小上限（按向量编码字节数估算），
+                超出时按最近最少使用淘汰其他集合的索引，下次访问时重新加载；None表示不限制
+            preload: 是否在初始化时并发加载所有已存在的集合，默认在首次访问时按需加载
+        """
+        self.max_resident_bytes = max_resident_bytes
+        self._index_cache_lock = threading.Lock()  # 保护self.indexes的LRU顺序和淘汰
+        self._batch_depth = {}  # 处于batch_writes块中的集合及嵌套层数
+        self._dirty = set()  # 已在内存中修改、尚未写入文件的集合
+        self._dirty_lock = threading.Lock()
+        self._search_buffers = threading.local()  # 各线程复用的查询/结果缓冲区，见_get_search_buffers
+        self._collection_locks = {}  # 集合名称 -> 该集合的可重入锁，见_collection_lock
+        self._index_types = {}  # 集合名称 -> 创建时指定的索引类型，见_get_collection_index_type
+        self._collection_locks_lock = threading.Lock()
         try:
             # 设置索引存储路径
             self.index_folder = index_folder
             os.makedirs(index_folder, exist_ok=True)
             
             # 存储映射: 集合名称 -> 索引/元数据
-            self.indexes = {}  # 存储加载的FAISS索引
+            self.indexes = OrderedDict()  # 存储加载的FAISS索引，按最近使用排序
+            self._mmap_indexes = {}  # 以内存映射只读方式加载的索引，写入前需重新完整加载
             self.metadata = {}  # 存储向量对应的元数据
             self.file_registry = {}  # 存储文件信息
             self.file_change_history = {}  # 存储文件变更历史
+            self._registry_counts = {}  # 集合 -> (统计时的注册表对象, [文件数, 向量数])，见_get_registry_counts
+            self._collections_cache = None  # (扫描时间, 集合名称列表, 目录中的索引/元数据文件名集合)，见_scan_index_folder
             
             # 检查版本和依赖
             logger.info(f"初始化FAISS管理器，FAISS版本: {faiss.__version__}")
+            self._check_simd_support()
             logger.info(f"索引存储路径: {os.path.abspath(index_folder)}")
             
             # 检查预先存在的集合
             collections = self.list_collections()
             logger.info(f"发现 {len(collections)} 个已存在的知识库集合: {collections}")
+            if preload and collections:
+                self.preload_collections(collections)
             
             # 记录初始化事件
             logger.info("FAISS管理器初始化完成")
@@ -51,10 +270,26 @@ class FaissManager:
             logger.error(f"初始化FAISS管理器时出错: {str(e)}")
             logger.exception(e)
             # 尽管发生错误，但仍然初始化对象，以便后续操作可以尝试恢复
-            self.indexes = {}
+            self.indexes = OrderedDict()
+            self._mmap_indexes = {}
             self.metadata = {}
             self.file_registry = {}
             self.file_change_history = {}
+            self._registry_counts = {}
+            self._collections_cache = None
+        
+    def _check_simd_support(self) -> None:
+        """
+        检查FAISS是否以SIMD指令集编译，距离计算（fvec_L2sqr等）依赖其向量化实现
+        """
+        get_compile_options = getattr(faiss, "get_compile_options", None)
+        if get_compile_options is None:
+            return
+        compile_options = get_compile_options()
+        logger.info(f"FAISS编译选项: {compile_options}")
+        if not any(flag in compile_options for flag in ("AVX2", "AVX512", "NEON", "SVE")):
+            logger.warning("当前FAISS未启用AVX2/AVX512/NEON等SIMD优化，向量距离计算会明显变慢，"
+                           "建议安装支持AVX2的faiss-cpu版本")
         
     def _get_index_path(self, collection_name: str) -> str:
         """
@@ -67,7 +302,7 @@ class FaissManager:
             str: 索引文件路径
         """
         # 对集合名称进行URL编码，避免中文路径问题
-        safe_name = urllib.parse.quote(collection_name, safe='')
+        safe_name = _safe_collection_name(collection_name)
         return os.path.join(self.index_folder, f"{safe_name}.index")
         
     def _get_metadata_path(self, collection_name: str) -> str:
@@ -81,7 +316,7 @@ class FaissManager:
             str: 元数据文件路径
         """
         # 对集合名称进行URL编码，避免中文路径问题
-        safe_name = urllib.parse.quote(collection_name, safe='')
+        safe_name = _safe_collection_name(collection_name)
         return os.path.join(self.index_folder, f"{safe_name}.meta")
         
     def kb_exists(self, kb_name: str) -> bool:
@@ -95,12 +330,8 @@ class FaissManager:
             bool: 知识库是否存在
         """
         try:
-            # 检查索引文件和元数据文件是否存在
-            index_path = self._get_index_path(kb_name)
-            metadata_path = self._get_metadata_path(kb_name)
-            
-            # 如果两个文件都存在，则认为知识库存在
-            return os.path.exists(index_path) and os.path.exists(metadata_path)
+            # 索引文件和元数据文件都存在则认为知识库存在（从缓存的目录扫描结果中查找）
+            return self._collection_files_exist(kb_name)
         except Exception as e:
             logger.error(f"检查知识库 {kb_name} 是否存在时出错: {str(e)}")
             return False
@@ -116,12 +347,26 @@ class FaissManager:
             str: 文件注册表路径
         """
         # 对集合名称进行URL编码，避免中文路径问题
-        safe_name = urllib.parse.quote(collection_name, safe='')
+        safe_name = _safe_collection_name(collection_name)
         return os.path.join(self.index_folder, f"{safe_name}.files.json")
     
+    def _get_file_registry_log_path(self, collection_name: str) -> str:
+        """
+        获取文件注册表追加日志路径（JSON Lines，记录上次写入快照后的条目变更）
+        
+        Args:
+            collection_name: 集合名称
+            
+        Returns:
+            str: 文件注册表日志路径
+        """
+        # 对集合名称进行URL编码，避免中文路径问题
+        safe_name = _safe_collection_name(collection_name)
+        return os.path.join(self.index_folder, f"{safe_name}.files.log")
+    
     def _get_file_history_path(self, collection_name: str) -> str:
         """
-        获取文件变更历史记录路径
+        获取文件变更历史记录路径（JSON Lines，每行一个事件）
         
         Args:
             collection_name: 集合名称
@@ -130,7 +375,20 @@ class FaissManager:
             str: 文件历史记录路径
         """
         # 对集合名称进行URL编码，避免中文路径问题
-        safe_name = urllib.parse.quote(collection_name, safe='')
+        safe_name = _safe_collection_name(collection_name)
+        return os.path.join(self.index_folder, f"{safe_name}.history.jsonl")
+    
+    def _get_legacy_file_history_path(self, collection_name: str) -> str:
+        """
+        获取旧版文件变更历史记录路径（整体保存的JSON或pickle数组），加载时迁移为JSON Lines
+        
+        Args:
+            collection_name: 集合名称
+            
+        Returns:
+            str: 旧版文件历史记录路径
+        """
+        safe_name = _safe_collection_name(collection_name)
         return os.path.join(self.index_folder, f"{safe_name}.history.json")
     
     def _get_collection_info_path(self) -> str:
@@ -142,14 +400,22 @@ class FaissManager:
         """
         return os.path.join(self.index_folder, "collections_info.json")
     
-    def create_collection(self, collection_name: str, dimension: int = 1536, index_type: str = "Flat") -> bool:
+    @_with_collection_lock
+    def create_collection(self, collection_name: str, dimension: int = 1536, index_type: str = "Flat",
+                          hnsw_m: int = 32, ef_construction: int = 200, ef_search: int = 64) -> bool:
         """
         创建新的向量集合
         
         Args:
             collection_name: 集合名称
             dimension: 向量维度，默认1536（适用于多种嵌入模型）
-            index_type: 索引类型，支持"Flat"（精确搜索）、"IVF"（倒排索引）、"HNSW"（层次导航小世界图）
+            index_type: 索引类型，支持"Flat"（精确搜索）、"IVF"（倒排索引）、"HNSW"（层次导航小世界图）、
+                "SQ8"（8位标量量化，内存与扫描带宽约为Flat的1/4，召回略有损失；向量数较少时先以Flat保存，
+                足够训练时再转换）。
+                向量规模较大（>1万）且可接受近似结果时建议使用HNSW，查询为对数级图遍历而非全量扫描
+            hnsw_m: HNSW每个节点的最大连接数
+            ef_construction: HNSW构建时的候选队列长度，越大图质量越高、构建越慢
+            ef_search: HNSW查询时的候选队列长度，越大召回越高、查询越慢
             
         Returns:
             bool: 创建是否成功
@@ -169,18 +435,18 @@ class FaissManager:
             if index_type == "Flat":
                 index = faiss.IndexFlatL2(dimension)  # 使用L2距离的Flat索引
             elif index_type == "IVF":
-                # 创建量化器
-                quantizer = faiss.IndexFlatL2(dimension)
-                # 创建倒排索引，nlist为聚类中心数量
-                nlist = max(4, int(math.sqrt(1000)))  # 根据预期向量数量调整
-                index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
-                # 训练空索引（理想情况下应该有训练数据）
-                if not self._train_index(index, dimension):
-                    return False
+                # 先以Flat索引保存，向量数足够时再按实际数据量确定nlist并用真实向量训练，见_maybe_train_index
+                index = faiss.IndexFlatL2(dimension)
             elif index_type == "HNSW":
-                # 创建HNSW索引，M为每个节点的最大连接数
-                M = 16  # 默认值通常为16-64之间
-                index = faiss.IndexHNSWFlat(dimension, M, faiss.METRIC_L2)
+                # 创建HNSW索引，M为每个节点的最大连接数（通常为16-64之间）
+                index = faiss.IndexHNSWFlat(dimension, hnsw_m, faiss.METRIC_L2)
+                # efConstruction/efSearch随索引一起保存
+                index.hnsw.efConstruction = ef_construction
+                index.hnsw.efSearch = ef_search
+            elif index_type == "SQ8":
+                # 归一化向量的分量集中在很小的范围内，按[-1, 1]训练会浪费大部分量化级别；
+                # 先以Flat索引保存，向量数足够后用真实数据训练，见_maybe_train_index
+                index = faiss.IndexFlatL2(dimension)
             else:
                 logger.error(f"不支持的索引类型: {index_type}")
                 return False
@@ -210,6 +476,10 @@ class FaissManager:
                 logger.info(f"创建文件注册表: {file_registry_path}")
                 with open(file_registry_path, 'w', encoding='utf-8') as f:
                     json.dump({}, f)
+                # 清除同名旧集合残留的注册表日志
+                registry_log_path = self._get_file_registry_log_path(collection_name)
+                if os.path.exists(registry_log_path):
+                    os.remove(registry_log_path)
             except Exception as e:
                 logger.error(f"创建文件注册表失败: {str(e)}")
                 # 清理已创建的文件
@@ -222,8 +492,7 @@ class FaissManager:
             # 创建文件历史记录
             try:
                 logger.info(f"创建文件历史记录: {file_history_path}")
-                with open(file_history_path, 'w', encoding='utf-8') as f:
-                    json.dump([], f)
+                open(file_history_path, 'wb').close()
             except Exception as e:
                 logger.error(f"创建文件历史记录失败: {str(e)}")
                 # 清理已创建的文件
@@ -249,6 +518,8 @@ class FaissManager:
                     os.remove(file_history_path)
                 return False
             
+            self._index_types[collection_name] = index_type
+            self._invalidate_collections_cache()
             logger.info(f"集合 {collection_name} 创建成功")
             return True
             
@@ -274,28 +545,15 @@ class FaissManager:
                 index = self.indexes[collection_name]
                 logger.info(f"保存索引 {collection_name}, 当前索引包含 {index.ntotal} 个向量")
                 
-                # 写入索引
-                faiss.write_index(index, index_path)
-                
-                # 强制同步文件系统
-                try:
-                    os.fsync(os.open(index_path, os.O_RDONLY))
-                except Exception as sync_err:
-                    logger.warning(f"同步索引文件时出错 (非致命): {str(sync_err)}")
+                # 写入临时文件并同步后原子替换，避免原地覆盖正被内存映射的索引文件
+                _atomic_write_file(index_path, lambda f: faiss.write_index(index, faiss.PyCallbackIOWriter(f.write)))
+                self._invalidate_collections_cache(index_path)
                 
-                # 验证索引文件是否成功写入及其大小
-                if os.path.exists(index_path) and os.path.getsize(index_path) > 0:
-                    # 再次读取索引文件以验证其完整性
-                    try:
-                        test_index = faiss.read_index(index_path)
-                        if test_index.ntotal != index.ntotal:
-                            logger.error(f"索引验证失败: 内存中有 {index.ntotal} 个向量，但文件中有 {test_index.ntotal} 个向量")
-                            return False
-                        logger.info(f"成功保存并验证索引到文件: {index_path}, 大小: {os.path.getsize(index_path)} 字节, 向量数: {test_index.ntotal}")
-                        return True
-                    except Exception as verify_err:
-                        logger.error(f"验证索引文件时出错: {str(verify_err)}")
-                        return False
+                # 写入失败时write_index会抛出异常，这里只检查文件大小，不再整体读回验证
+                st = _stat_or_none(index_path)
+                if st and st.st_size > 0:
+                    logger.info(f"成功保存索引到文件: {index_path}, 大小: {st.st_size} 字节, 向量数: {index.ntotal}")
+                    return True
                 else:
                     logger.error(f"索引文件写入失败或为空: {index_path}")
                     return False
@@ -320,12 +578,13 @@ class FaissManager:
         try:
             if collection_name in self.metadata:
                 metadata_path = self._get_metadata_path(collection_name)
-                with open(metadata_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.metadata[collection_name], f)
+                _dump_json_file(metadata_path, self.metadata[collection_name])
+                self._invalidate_collections_cache(metadata_path)
                 
                 # 验证元数据文件是否成功写入
-                if os.path.exists(metadata_path) and os.path.getsize(metadata_path) > 0:
-                    logger.info(f"成功保存元数据到文件: {metadata_path}, 大小: {os.path.getsize(metadata_path)} 字节")
+                st = _stat_or_none(metadata_path)
+                if st and st.st_size > 0:
+                    logger.info(f"成功保存元数据到文件: {metadata_path}, 大小: {st.st_size} 字节")
                     return True
                 else:
                     logger.error(f"元数据文件写入失败或为空: {metadata_path}")
@@ -338,12 +597,13 @@ class FaissManager:
             logger.error(traceback.format_exc())
             return False
     
-    def _save_file_registry(self, collection_name: str) -> bool:
+    def _save_file_registry(self, collection_name: str, pretty: bool = False) -> bool:
         """
         将文件注册表保存到文件
         
         Args:
             collection_name: 集合名称
+            pretty: 是否缩进排版以便人工查看；默认写入紧凑格式，编码更快、文件更小
             
         Returns:
             bool: 保存是否成功
@@ -373,42 +633,20 @@ class FaissManager:
                         "_vector_count": 0
                     }
                 else:
-                    # 更新最后修改时间
-                    self.file_registry[collection_name]["_last_updated"] = datetime.now().isoformat()
-                    
-                    # 计算并更新文件和向量计数
-                    file_count = 0
-                    vector_count = 0
-                    for key, value in self.file_registry[collection_name].items():
-                        if not key.startswith('_') and isinstance(value, dict):
-                            file_count += 1
-                            if "vector_count" in value:
-                                vector_count += value["vector_count"]
-                    
-                    self.file_registry[collection_name]["_file_count"] = file_count
-                    self.file_registry[collection_name]["_vector_count"] = vector_count
+                    self._refresh_registry_stats(collection_name)
                 
-                # 写入文件注册表
-                with open(registry_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.file_registry[collection_name], f, ensure_ascii=False, indent=2)
+                # 写入文件注册表（原子替换，写入句柄上同步）
+                _dump_json_file(registry_path, self.file_registry[collection_name], indent=pretty)
                 
-                # 同步文件系统
-                try:
-                    os.fsync(os.open(registry_path, os.O_RDONLY))
-                except Exception as sync_err:
-                    logger.warning(f"同步文件注册表时出错 (非致命): {str(sync_err)}")
-                
-                # 验证文件注册表是否成功写入
-                if os.path.exists(registry_path) and os.path.getsize(registry_path) > 0:
-                    # 再次读取文件以验证其完整性
-                    try:
-                        with open(registry_path, 'r', encoding='utf-8') as f:
-                            test_registry = json.load(f)
-                            logger.info(f"成功保存并验证文件注册表到文件: {registry_path}, 大小: {os.path.getsize(registry_path)} 字节, 条目数: {len(test_registry)}")
-                            return True
-                    except Exception as verify_err:
-                        logger.error(f"验证文件注册表时出错: {str(verify_err)}")
-                        return False
+                # 验证文件注册表是否成功写入（序列化失败会直接抛出异常，无需读回解析）
+                st = _stat_or_none(registry_path)
+                if st and st.st_size > 0:
+                    logger.info(f"成功保存文件注册表到文件: {registry_path}, 大小: {st.st_size} 字节, 条目数: {len(self.file_registry[collection_name])}")
+                    # 快照已包含日志中的全部变更
+                    log_path = self._get_file_registry_log_path(collection_name)
+                    if os.path.exists(log_path):
+                        os.remove(log_path)
+                    return True
                 else:
                     logger.error(f"文件注册表写入失败或为空: {registry_path}")
                     return False
@@ -420,55 +658,314 @@ class FaissManager:
             logger.error(traceback.format_exc())
             return False
     
-    def _save_file_history(self, collection_name: str) -> None:
-        """保存文件变更历史记录到文件"""
+    def _append_file_history(self, collection_name: str, event: Dict[str, Any]) -> None:
+        """将一条变更事件追加到历史记录文件末尾，历史已加载到内存时同时追加到内存"""
+        # 旧版整体文件需先迁移，否则会被新建的JSON Lines文件遮住
+        self._migrate_file_history(collection_name)
+        _append_json_line(self._get_file_history_path(collection_name), event)
         if collection_name in self.file_change_history:
-            with open(self._get_file_history_path(collection_name), 'w', encoding='utf-8') as f:
-                json.dump(self.file_change_history[collection_name], f)
+            self.file_change_history[collection_name].append(event)
     
-    def _record_collection_event(self, collection_name: str, event_type: str, event_data: Dict[str, Any]) -> None:
+    def _record_collection_event(self, collection_name: str, event_type: str, event_data: Dict[str, Any],
+                                 timestamp: Optional[datetime] = None) -> None:
         """记录集合事件"""
-        if collection_name not in self.file_change_history:
-            self.file_change_history[collection_name] = []
-        
         event = {
             "event_type": event_type,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": (timestamp or datetime.now()).strftime("%Y-%m-%d %H:%M:%S"),
             "data": event_data
         }
         
-        self.file_change_history[collection_name].append(event)
-        self._save_file_history(collection_name)
+        self._append_file_history(collection_name, event)
     
-    def _record_file_event(self, collection_name: str, file_name: str, event_type: str, event_data: Dict[str, Any]) -> None:
+    def _record_file_event(self, collection_name: str, file_name: str, event_type: str, event_data: Dict[str, Any],
+                           timestamp: Optional[datetime] = None) -> None:
         """记录文件事件"""
-        if collection_name not in self.file_change_history:
-            self.file_change_history[collection_name] = []
-        
         event = {
             "event_type": event_type,
             "file_name": file_name,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": (timestamp or datetime.now()).strftime("%Y-%m-%d %H:%M:%S"),
             "data": event_data
         }
         
-        self.file_change_history[collection_name].append(event)
-        self._save_file_history(collection_name)
+        self._append_file_history(collection_name, event)
+    
+    def _is_mmap_index(self, collection_name: str) -> bool:
+        """
+        判断集合当前的索引是否为内存映射的只读索引
+        
+        Args:
+            collection_name: 集合名称
+            
+        Returns:
+            bool: 是否为只读映射索引
+        """
+        index = self.indexes.get(collection_name)
+        return index is not None and self._mmap_indexes.get(collection_name) is index
+    
+    @staticmethod
+    def _estimate_index_bytes(index) -> int:
+        """
+        估算索引中向量编码占用的内存字节数
+        
+        Args:
+            index: FAISS索引对象
+            
+        Returns:
+            int: 估算的字节数（Flat为ntotal*d*4，SQ8等按每向量编码长度计算）
+        """
+        code_size = getattr(index, "code_size", None)
+        if not code_size:
+            # HNSW等以storage保存原始向量
+            code_size = getattr(getattr(index, "storage", None), "code_size", None) or index.d * 4
+        return index.ntotal * code_size
+    
+    def _cache_index(self, collection_name: str, index) -> None:
+        """
+        放入已加载的索引并标记为最近使用，超出内存上限时淘汰最久未使用的其他索引
+        
+        Args:
+            collection_name: 集合名称
+            index: FAISS索引对象
+        """
+        with self._index_cache_lock:
+            self.indexes[collection_name] = index
+            self.indexes.move_to_end(collection_name)
+            if self.max_resident_bytes is None:
+                return
+            
+            # 索引大小会随写入变化，淘汰时按当前状态重新估算
+            resident_bytes = sum(self._estimate_index_bytes(cached) for cached in self.indexes.values())
+            for evicted_name in list(self.indexes)[:-1]:
+                if resident_bytes <= self.max_resident_bytes:
+                    break
+                # 正被其他线程使用的集合跳过，不等待其锁（对方可能正等待本锁，会死锁）
+                lock = self._collection_lock(evicted_name)
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    # 未落盘的修改需先写入，否则淘汰后重新加载会丢失
+                    self._flush_collection(evicted_name)
+                    evicted_index = self.indexes.pop(evicted_name)
+                    self._mmap_indexes.pop(evicted_name, None)
+                finally:
+                    lock.release()
+                resident_bytes -= self._estimate_index_bytes(evicted_index)
+                logger.info(f"索引常驻内存超出上限，已释放集合 {evicted_name} 的索引")
+    
+    def _get_index(self, collection_name: str, read_only: bool = False):
+        """
+        获取集合的索引，未加载时从文件加载，并标记为最近使用
+        
+        Args:
+            collection_name: 集合名称
+            read_only: 仅用于查询时可用内存映射方式加载
+            
+        Returns:
+            FAISS索引对象，加载失败时返回None
+        """
+        if collection_name not in self.indexes:
+            if not self._load_index(collection_name, read_only=read_only):
+                return None
+        else:
+            self.indexes.move_to_end(collection_name)
+        return self.indexes[collection_name]
     
-    def _load_index(self, collection_name: str) -> bool:
+    def _collection_lock(self, collection_name: str) -> threading.RLock:
+        """
+        获取集合的可重入锁，不存在时创建
+        
+        Args:
+            collection_name: 集合名称
+            
+        Returns:
+            threading.RLock: 该集合的锁
+        """
+        with self._collection_locks_lock:
+            lock = self._collection_locks.get(collection_name)
+            if lock is None:
+                lock = self._collection_locks[collection_name] = threading.RLock()
+            return lock
+    
+    @contextmanager
+    def batch_writes(self, collection_name: str):
+        """
+        批量写入上下文：块内add_vectors只在内存中修改集合，不再每次调用都重写索引、
+        元数据和文件注册表，退出最外层块时每个文件只原子写入一次。支持嵌套。
+        
+        用法:
+            with manager.batch_writes("kb"):
+                for vectors, metadata in files:
+                    manager.add_vectors("kb", vectors, metadata)
+        
+        块内持有集合的锁，其他线程对该集合的写入和搜索会等待整批写入完成。
+        块内只应调用flush(collection_name)，不带参数的flush()会等待其他集合的锁。
+        
+        Args:
+            collection_name: 集合名称
+        """
+        with self._collection_lock(collection_name):
+            with self._dirty_lock:
+                self._batch_depth[collection_name] = self._batch_depth.get(collection_name, 0) + 1
+            try:
+                yield self
+            finally:
+                with self._dirty_lock:
+                    depth = self._batch_depth.pop(collection_name) - 1
+                    if depth:
+                        self._batch_depth[collection_name] = depth
+                if not depth:
+                    self._flush_collection(collection_name)
+    
+    def _is_batching(self, collection_name: str) -> bool:
+        """集合当前是否处于batch_writes块中"""
+        with self._dirty_lock:
+            return collection_name in self._batch_depth
+    
+    def _get_search_buffers(self, dim: int, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        获取当前线程复用的单条查询缓冲区，维度或k变化时才重新分配
+        
+        Args:
+            dim: 向量维度
+            k: 返回的近邻数量
+            
+        Returns:
+            Tuple: (查询向量(1, dim) float32, 距离(1, k) float32, 索引(1, k) int64)
+        """
+        buffers = getattr(self._search_buffers, "by_dim", None)
+        if buffers is None:
+            buffers = self._search_buffers.by_dim = {}
+        cached = buffers.get(dim)
+        if cached is None or cached[1].shape[1] != k:
+            cached = buffers[dim] = (
+                np.empty((1, dim), dtype=np.float32),
+                np.empty((1, k), dtype=np.float32),
+                np.empty((1, k), dtype=np.int64),
+            )
+        return cached
+    
+    def _mark_dirty(self, collection_name: str) -> None:
+        """
+        标记集合的索引、元数据和文件注册表已在内存中修改，待退出batch_writes或flush()时统一写入
+        
+        Args:
+            collection_name: 集合名称
+        """
+        with self._dirty_lock:
+            self._dirty.add(collection_name)
+        with _managers_pending_flush_lock:
+            _managers_pending_flush.add(self)
+    
+    @_with_collection_lock
+    def _flush_collection(self, collection_name: str) -> bool:
+        """
+        将集合延迟写入的修改保存到文件，集合未被标记时直接返回
+        
+        Args:
+            collection_name: 集合名称
+            
+        Returns:
+            bool: 保存是否成功（无待写入修改时为True）
+        """
+        with self._dirty_lock:
+            if collection_name not in self._dirty:
+                return True
+            self._dirty.discard(collection_name)
+        
+        index_saved = self._save_index(collection_name)
+        metadata_saved = self._save_metadata(collection_name)
+        registry_saved = self._save_file_registry(collection_name)
+        if index_saved and metadata_saved and registry_saved:
+            with self._dirty_lock:
+                all_flushed = not self._dirty
+            if all_flushed:
+                with _managers_pending_flush_lock:
+                    _managers_pending_flush.discard(self)
+            return True
+        
+        logger.error(f"写入集合 {collection_name} 的延迟修改失败: 索引={index_saved}, 元数据={metadata_saved}, 文件注册表={registry_saved}")
+        # 保留标记，下次flush或进程退出时重试
+        self._mark_dirty(collection_name)
+        return False
+    
+    def flush(self, collection_name: Optional[str] = None) -> bool:
+        """
+        将延迟写入的集合保存到文件
+        
+        Args:
+            collection_name: 只写入该集合，None表示所有集合
+        
+        Returns:
+            bool: 是否全部保存成功
+        """
+        if collection_name is not None:
+            return self._flush_collection(collection_name)
+        with self._dirty_lock:
+            pending = list(self._dirty)
+        success = True
+        for collection_name in pending:
+            success = self._flush_collection(collection_name) and success
+        return success
+    
+    @_with_collection_lock
+    def _load_collection_files(self, collection_name: str) -> bool:
+        """
+        加载单个集合的索引、元数据、文件注册表和变更历史
+        
+        Args:
+            collection_name: 集合名称
+            
+        Returns:
+            bool: 是否全部加载成功
+        """
+        loaded = [
+            self._load_index(collection_name),
+            self._load_metadata(collection_name),
+            self._load_file_registry(collection_name),
+            self._load_file_history(collection_name),
+        ]
+        return all(loaded)
+    
+    def preload_collections(self, collection_names: Optional[List[str]] = None, max_workers: int = 16) -> Dict[str, bool]:
+        """
+        并发加载多个集合（读取索引和解析JSON都在释放GIL的C代码中进行，各集合互不依赖）
+        
+        Args:
+            collection_names: 要加载的集合名称列表，None表示所有已存在的集合
+            max_workers: 最大线程数
+            
+        Returns:
+            Dict[str, bool]: 各集合是否加载成功
+        """
+        if collection_names is None:
+            collection_names = self.list_collections()
+        if not collection_names:
+            return {}
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(collection_names))) as executor:
+            results = dict(zip(collection_names, executor.map(self._load_collection_files, collection_names)))
+        logger.info(f"已并发加载 {sum(results.values())}/{len(results)} 个集合")
+        return results
+    
+    def _load_index(self, collection_name: str, read_only: bool = False) -> bool:
         """
         从文件加载索引
         
         Args:
             collection_name: 集合名称
+            read_only: 仅用于查询时以内存映射方式加载（IVF等支持的索引按需分页读入，
+                不整体载入内存），不支持映射的索引类型照常完整加载
             
         Returns:
             bool: 加载是否成功
         """
+        # 从文件重新加载前先写入延迟的修改，避免覆盖内存中尚未落盘的数据
+        self._flush_collection(collection_name)
         try:
             index_path = self._get_index_path(collection_name)
-            if os.path.exists(index_path):
-                file_size = os.path.getsize(index_path)
+            st = _stat_or_none(index_path)
+            if st:
+                file_size = st.st_size
                 logger.info(f"开始加载索引文件: {index_path}, 文件大小: {file_size} 字节")
                 
                 if file_size == 0:
@@ -477,8 +974,20 @@ class FaissManager:
                 
                 # 尝试加载索引
                 try:
-                    index = faiss.read_index(index_path)
-                    self.indexes[collection_name] = index
+                    index = None
+                    if read_only:
+                        try:
+                            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                        except Exception as mmap_err:
+                            logger.warning(f"以内存映射方式加载索引失败，改为完整加载: {str(mmap_err)}")
+                    if index is None:
+                        index = faiss.read_index(index_path)
+                    # 只有IVF的倒排表会真正映射为只读，Flat/HNSW等仍是完整加载的可写索引
+                    if read_only and faiss.try_extract_index_ivf(index) is not None:
+                        self._mmap_indexes[collection_name] = index
+                    else:
+                        self._mmap_indexes.pop(collection_name, None)
+                    self._cache_index(collection_name, index)
                     
                     # 记录索引信息
                     logger.info(f"成功加载索引 {collection_name}: 包含 {index.ntotal} 个向量, 维度: {index.d}")
@@ -489,8 +998,9 @@ class FaissManager:
                         
                         # 检查元数据大小进行交叉验证
                         metadata_path = self._get_metadata_path(collection_name)
-                        if os.path.exists(metadata_path) and os.path.getsize(metadata_path) > 100:
-                            logger.warning(f"元数据文件大小 ({os.path.getsize(metadata_path)} 字节) 表明应该有数据，但索引为空")
+                        metadata_st = _stat_or_none(metadata_path)
+                        if metadata_st and metadata_st.st_size > 100:
+                            logger.warning(f"元数据文件大小 ({metadata_st.st_size} 字节) 表明应该有数据，但索引为空")
                     
                     return True
                 except Exception as e:
@@ -523,7 +1033,8 @@ class FaissManager:
         Returns:
             bool: 加载是否成功
         """
-        import pickle
+        # 从文件重新加载前先写入延迟的修改，避免覆盖内存中尚未落盘的数据
+        self._flush_collection(collection_name)
         metadata_path = self._get_metadata_path(collection_name)
         if not os.path.exists(metadata_path):
             logger.warning(f"元数据文件不存在: {metadata_path}")
@@ -532,10 +1043,10 @@ class FaissManager:
             
         # 首先尝试JSON格式
         try:
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                self.metadata[collection_name] = json.load(f)
-                logger.info(f"成功使用JSON格式加载元数据: {metadata_path}")
-                return True
+            self.metadata[collection_name] = _load_json_file(metadata_path)
+            _share_metadata_strings(self.metadata[collection_name])
+            logger.info(f"成功使用JSON格式加载元数据: {metadata_path}")
+            return True
         except json.JSONDecodeError as e:
             logger.warning(f"使用JSON格式加载元数据失败，将尝试pickle格式: {str(e)}")
         except Exception as e:
@@ -547,14 +1058,12 @@ class FaissManager:
                 
         # 如果JSON失败，尝试pickle格式
         try:
-            with open(metadata_path, 'rb') as f:
-                self.metadata[collection_name] = pickle.load(f)
+            self.metadata[collection_name] = _load_legacy_pickle(metadata_path)
             logger.info(f"成功使用pickle格式加载元数据: {metadata_path}")
             
             # 将pickle格式转换为JSON格式保存回文件
             try:
-                with open(metadata_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.metadata[collection_name], f)
+                _dump_json_file(metadata_path, self.metadata[collection_name])
                 logger.info(f"已将元数据从pickle格式转换为JSON格式: {metadata_path}")
             except Exception as e:
                 logger.warning(f"将元数据从pickle转换为JSON失败: {str(e)}")
@@ -565,6 +1074,137 @@ class FaissManager:
             self.metadata[collection_name] = {}  # 初始化为空字典
             return False
     
+    @staticmethod
+    def _count_registry(registry: Dict[str, Any]) -> Tuple[int, int]:
+        """
+        完整统计文件注册表中的文件数和向量数
+        
+        Args:
+            registry: 集合的文件注册表
+            
+        Returns:
+            Tuple[int, int]: (文件数, 各文件vector_count之和)
+        """
+        file_count = 0
+        vector_count = 0
+        for key, value in registry.items():
+            if not key.startswith('_') and isinstance(value, dict):
+                file_count += 1
+                if "vector_count" in value:
+                    vector_count += value["vector_count"]
+        return file_count, vector_count
+    
+    def _get_registry_counts(self, collection_name: str) -> List[int]:
+        """
+        获取集合文件注册表的文件数和向量数
+        
+        计数在首次使用时完整统计一次，之后由_apply_registry_delta增量维护；
+        注册表被整体替换（重新加载、修复等）后自动重新统计。
+        日志级别为DEBUG时每次都与完整统计比对。
+        
+        Args:
+            collection_name: 集合名称
+            
+        Returns:
+            List[int]: [文件数, 向量数]
+        """
+        registry = self.file_registry[collection_name]
+        cached = self._registry_counts.get(collection_name)
+        if cached is None or cached[0] is not registry:
+            cached = self._registry_counts[collection_name] = (registry, list(self._count_registry(registry)))
+        elif logger.isEnabledFor(logging.DEBUG):
+            expected = list(self._count_registry(registry))
+            if cached[1] != expected:
+                logger.debug(f"集合 {collection_name} 的增量计数 {cached[1]} 与完整统计 {expected} 不一致，已更正")
+                cached[1][:] = expected
+        return cached[1]
+    
+    def _apply_registry_delta(self, collection_name: str, file_delta: int, vector_delta: int) -> None:
+        """
+        在文件注册表增删文件或改变文件向量数后更新计数（尚未统计过时无需处理）
+        
+        Args:
+            collection_name: 集合名称
+            file_delta: 文件数变化
+            vector_delta: 向量数变化
+        """
+        cached = self._registry_counts.get(collection_name)
+        if cached is not None and cached[0] is self.file_registry.get(collection_name):
+            cached[1][0] += file_delta
+            cached[1][1] += vector_delta
+    
+    def _refresh_registry_stats(self, collection_name: str) -> None:
+        """
+        更新文件注册表的最后修改时间和文件数、向量数统计字段
+        
+        Args:
+            collection_name: 集合名称
+        """
+        registry = self.file_registry[collection_name]
+        registry["_last_updated"] = datetime.now().isoformat()
+        
+        # 文件和向量计数按增量维护，不再每次保存时遍历整个注册表
+        file_count, vector_count = self._get_registry_counts(collection_name)
+        registry["_file_count"] = file_count
+        registry["_vector_count"] = vector_count
+    
+    def _append_registry_event(self, collection_name: str, file_name: str) -> bool:
+        """
+        以追加一行JSON的方式持久化单个文件条目的变更，不重写整个文件注册表
+        
+        事件记录该文件条目的最新值（已删除时记为删除）及统计字段，重复回放结果不变；
+        日志超过快照两倍大小时写入完整快照并清空日志
+        
+        Args:
+            collection_name: 集合名称
+            file_name: 发生变更的文件名
+            
+        Returns:
+            bool: 保存是否成功
+        """
+        try:
+            registry = self.file_registry.get(collection_name)
+            if not isinstance(registry, dict) or not registry:
+                return self._save_file_registry(collection_name)
+            self._refresh_registry_stats(collection_name)
+            
+            event = {"set": {key: value for key, value in registry.items() if key.startswith('_')}}
+            if file_name in registry:
+                event["set"][file_name] = registry[file_name]
+            else:
+                event["del"] = [file_name]
+            
+            log_path = self._get_file_registry_log_path(collection_name)
+            _append_json_line(log_path, event, fsync=True)
+            
+            snapshot_st = _stat_or_none(self._get_file_registry_path(collection_name))
+            if os.stat(log_path).st_size > 2 * (snapshot_st.st_size if snapshot_st else 0):
+                return self._save_file_registry(collection_name)
+            return True
+        except Exception as e:
+            logger.error(f"追加文件注册表日志 {collection_name} 失败: {str(e)}")
+            logger.error(traceback.format_exc())
+            return False
+    
+    def _replay_registry_log(self, collection_name: str) -> None:
+        """
+        将文件注册表日志中的变更依次应用到已从快照加载的注册表
+        
+        Args:
+            collection_name: 集合名称
+        """
+        log_path = self._get_file_registry_log_path(collection_name)
+        registry = self.file_registry.get(collection_name)
+        if not os.path.exists(log_path) or not isinstance(registry, dict):
+            return
+        
+        events = _read_json_lines(log_path)
+        for event in events:
+            registry.update(event.get("set", {}))
+            for key in event.get("del", []):
+                registry.pop(key, None)
+        logger.info(f"已回放文件注册表日志 {log_path} 中的 {len(events)} 条变更")
+    
     def _load_file_registry(self, collection_name: str) -> bool:
         """
         从文件加载文件注册表，支持JSON和pickle格式
@@ -575,19 +1215,21 @@ class FaissManager:
         Returns:
             bool: 加载是否成功
         """
-        import pickle
+        # 从文件重新加载前先写入延迟的修改，避免覆盖内存中尚未落盘的数据
+        self._flush_collection(collection_name)
         registry_path = self._get_file_registry_path(collection_name)
         if not os.path.exists(registry_path):
             logger.warning(f"文件注册表不存在: {registry_path}")
             self.file_registry[collection_name] = {}
+            self._replay_registry_log(collection_name)
             return True
             
         # 首先尝试JSON格式
         try:
-            with open(registry_path, 'r', encoding='utf-8') as f:
-                self.file_registry[collection_name] = json.load(f)
-                logger.info(f"成功使用JSON格式加载文件注册表: {registry_path}")
-                return True
+            self.file_registry[collection_name] = _load_json_file(registry_path)
+            logger.info(f"成功使用JSON格式加载文件注册表: {registry_path}")
+            self._replay_registry_log(collection_name)
+            return True
         except json.JSONDecodeError as e:
             logger.warning(f"使用JSON格式加载文件注册表失败，将尝试pickle格式: {str(e)}")
         except Exception as e:
@@ -600,27 +1242,67 @@ class FaissManager:
                 
         # 如果JSON失败，尝试pickle格式
         try:
-            with open(registry_path, 'rb') as f:
-                self.file_registry[collection_name] = pickle.load(f)
+            self.file_registry[collection_name] = _load_legacy_pickle(registry_path)
             logger.info(f"成功使用pickle格式加载文件注册表: {registry_path}")
             
             # 将pickle格式转换为JSON格式保存回文件
             try:
-                with open(registry_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.file_registry[collection_name], f)
+                _dump_json_file(registry_path, self.file_registry[collection_name])
                 logger.info(f"已将文件注册表从pickle格式转换为JSON格式: {registry_path}")
             except Exception as e:
                 logger.warning(f"将文件注册表从pickle转换为JSON失败: {str(e)}")
                 
+            self._replay_registry_log(collection_name)
             return True
         except Exception as e:
             logger.error(f"使用pickle格式加载文件注册表也失败: {str(e)}")
             self.file_registry[collection_name] = {}
             return False
     
+    def _migrate_file_history(self, collection_name: str) -> bool:
+        """
+        将旧版整体保存的文件变更历史（JSON或pickle数组）迁移为JSON Lines文件，
+        已存在的JSON Lines记录保留在迁移记录之后
+        
+        Args:
+            collection_name: 集合名称
+            
+        Returns:
+            bool: 迁移是否成功（无需迁移时为True）
+        """
+        legacy_path = self._get_legacy_file_history_path(collection_name)
+        if not os.path.exists(legacy_path):
+            return True
+        
+        try:
+            events = _load_json_file(legacy_path)
+        except json.JSONDecodeError as e:
+            logger.warning(f"使用JSON格式加载旧版文件变更历史失败，将尝试pickle格式: {str(e)}")
+            try:
+                events = _load_legacy_pickle(legacy_path)
+            except Exception as e:
+                logger.error(f"使用pickle格式加载旧版文件变更历史也失败: {str(e)}")
+                return False
+        except Exception as e:
+            logger.error(f"加载旧版文件变更历史失败: {str(e)}")
+            return False
+        
+        try:
+            history_path = self._get_file_history_path(collection_name)
+            if os.path.exists(history_path):
+                events = list(events) + _read_json_lines(history_path)
+            _atomic_write_file(history_path, lambda f: f.writelines(
+                orjson.dumps(event, option=_ORJSON_OPTIONS) + b'\n' for event in events))
+            os.remove(legacy_path)
+            logger.info(f"已将文件变更历史迁移为JSON Lines格式: {history_path}, 共 {len(events)} 条")
+            return True
+        except Exception as e:
+            logger.error(f"迁移文件变更历史失败: {str(e)}")
+            return False
+    
     def _load_file_history(self, collection_name: str) -> bool:
         """
-        从文件加载文件变更历史记录，支持JSON和pickle格式
+        从文件加载文件变更历史记录，首次加载时将旧版JSON/pickle格式迁移为JSON Lines
         
         Args:
             collection_name: 集合名称
@@ -628,46 +1310,22 @@ class FaissManager:
         Returns:
             bool: 加载是否成功
         """
-        import pickle
+        if not self._migrate_file_history(collection_name):
+            self.file_change_history[collection_name] = []
+            return False
+        
         history_path = self._get_file_history_path(collection_name)
         if not os.path.exists(history_path):
             logger.warning(f"文件变更历史记录不存在: {history_path}")
             self.file_change_history[collection_name] = []
             return True
-            
-        # 首先尝试JSON格式
-        try:
-            with open(history_path, 'r', encoding='utf-8') as f:
-                self.file_change_history[collection_name] = json.load(f)
-                logger.info(f"成功使用JSON格式加载文件变更历史: {history_path}")
-                return True
-        except json.JSONDecodeError as e:
-            logger.warning(f"使用JSON格式加载文件变更历史失败，将尝试pickle格式: {str(e)}")
-        except Exception as e:
-            if "invalid load key" in str(e):
-                logger.warning(f"可能是pickle格式的文件: {str(e)}")
-            else:
-                logger.error(f"加载文件变更历史失败: {str(e)}")
-                self.file_change_history[collection_name] = []
-                return False
-                
-        # 如果JSON失败，尝试pickle格式
+        
         try:
-            with open(history_path, 'rb') as f:
-                self.file_change_history[collection_name] = pickle.load(f)
-            logger.info(f"成功使用pickle格式加载文件变更历史: {history_path}")
-            
-            # 将pickle格式转换为JSON格式保存回文件
-            try:
-                with open(history_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.file_change_history[collection_name], f)
-                logger.info(f"已将文件变更历史从pickle格式转换为JSON格式: {history_path}")
-            except Exception as e:
-                logger.warning(f"将文件变更历史从pickle转换为JSON失败: {str(e)}")
-                
+            self.file_change_history[collection_name] = _read_json_lines(history_path)
+            logger.info(f"成功加载文件变更历史: {history_path}")
             return True
         except Exception as e:
-            logger.error(f"使用pickle格式加载文件变更历史也失败: {str(e)}")
+            logger.error(f"加载文件变更历史失败: {str(e)}")
             self.file_change_history[collection_name] = []
             return False
     
@@ -686,9 +1344,71 @@ class FaissManager:
             return True
             
         # 再检查文件是否存在
-        index_path = self._get_index_path(collection_name)
-        metadata_path = self._get_metadata_path(collection_name)
-        return os.path.exists(index_path) and os.path.exists(metadata_path)
+        return self._collection_files_exist(collection_name)
+    
+    def _scan_index_folder(self) -> Tuple[List[str], frozenset]:
+        """
+        扫描索引目录中的集合，缓存未失效时直接返回上次扫描的结果
+        
+        Returns:
+            Tuple[List[str], frozenset]: (集合名称列表, 目录中的文件名集合)
+        """
+        # 每次原子写入都会改变目录mtime，因此不按mtime判断；本进程新建或删除索引/元数据文件时
+        # 显式清除缓存（见_invalidate_collections_cache），其他进程的变化在缓存过期后发现
+        cache = self._collections_cache
+        now = time.monotonic()
+        if cache is not None and now - cache[0] < _COLLECTIONS_CACHE_TTL:
+            return cache[1], cache[2]
+        
+        collections = []
+        names = []
+        with os.scandir(self.index_folder) as entries:
+            for entry in entries:
+                if entry.name.endswith('.index'):
+                    names.append(entry.name)
+                    # 去掉.index后缀，文件名是URL编码后的集合名称
+                    collections.append(urllib.parse.unquote(entry.name[:-len('.index')]))
+                elif entry.name.endswith('.meta'):
+                    names.append(entry.name)
+        file_names = frozenset(names)
+        self._collections_cache = (now, collections, file_names)
+        return collections, file_names
+    
+    def _invalidate_collections_cache(self, written_path: Optional[str] = None) -> None:
+        """
+        清除集合列表缓存
+        
+        Args:
+            written_path: 刚写入的文件路径；给出时只在该文件不在缓存中（即新建的文件）时清除
+        """
+        cache = self._collections_cache
+        if written_path is not None and cache is not None and os.path.basename(written_path) in cache[2]:
+            return
+        self._collections_cache = None
+    
+    def _collection_files_exist(self, collection_name: str) -> bool:
+        """
+        集合的索引文件和元数据文件是否都存在，优先从缓存的目录扫描结果中查找
+        
+        Args:
+            collection_name: 集合名称
+            
+        Returns:
+            bool: 两个文件是否都存在
+        """
+        safe_name = _safe_collection_name(collection_name)
+        try:
+            _, file_names = self._scan_index_folder()
+        except FileNotFoundError:
+            return False
+        if f"{safe_name}.index" in file_names and f"{safe_name}.meta" in file_names:
+            return True
+        # 缓存中没有时再直接检查文件，避免其他进程刚创建的集合在缓存过期前被判为不存在
+        if not (os.path.exists(self._get_index_path(collection_name))
+                and os.path.exists(self._get_metadata_path(collection_name))):
+            return False
+        self._invalidate_collections_cache()
+        return True
     
     def list_collections(self) -> List[str]:
         """
@@ -697,12 +1417,10 @@ class FaissManager:
         Returns:
             List[str]: 集合名称列表
         """
-        collections = []
-        for filename in os.listdir(self.index_folder):
-            if filename.endswith('.index'):
-                collections.append(filename[:-6])  # 去掉.index后缀
-        return collections
+        collections, _ = self._scan_index_folder()
+        return list(collections)
     
+    @_with_collection_lock
     def get_collection_info(self, collection_name: str) -> Dict[str, Any]:
         """
         获取集合信息
@@ -717,14 +1435,12 @@ class FaissManager:
             return {"error": f"集合 {collection_name} 不存在"}
             
         # 确保索引已加载
-        if collection_name not in self.indexes:
-            self._load_index(collection_name)
+        index = self._get_index(collection_name)
             
         # 确保文件注册表已加载
         if collection_name not in self.file_registry:
             self._load_file_registry(collection_name)
             
-        index = self.indexes[collection_name]
         return {
             "name": collection_name,
             "vector_count": index.ntotal,
@@ -733,7 +1449,9 @@ class FaissManager:
             "file_count": len(self.file_registry[collection_name])
         }
     
-    def add_vectors(self, collection_name: str, vectors: np.ndarray, metadata: List[Dict[str, Any]], file_path: str = None) -> Dict[str, Any]:
+    @_with_collection_lock
+    def add_vectors(self, collection_name: str, vectors: np.ndarray, metadata: List[Dict[str, Any]], file_path: str = None,
+                    sync: bool = True) -> Dict[str, Any]:
         """
         将向量添加到集合中
         
@@ -742,10 +1460,15 @@ class FaissManager:
             vectors: 向量数组
             metadata: 元数据列表
             file_path: 文件路径（可选）
+            sync: 是否立即保存索引、元数据和文件注册表；为False时只标记集合待写入，
+                由flush()（或重新加载、淘汰该集合、进程退出时）统一保存。batch_writes块中总是延迟写入
             
         Returns:
             Dict: 添加结果信息
         """
+        # 同一次调用内的注册表、版本和事件时间戳取同一时刻
+        now = datetime.now()
+        now_iso = now.isoformat()
         try:
             # 文件路径检查和处理
             original_file_path = file_path  # 保存原始路径用于日志
@@ -773,8 +1496,8 @@ class FaissManager:
                     return {"status": "error", "message": f"无法创建集合 {collection_name}"}
                 logger.info(f"集合 {collection_name} 不存在，已创建新集合")
             
-            # 确保索引和元数据已加载
-            if collection_name not in self.indexes:
+            # 确保索引和元数据已加载（只读映射的索引需重新完整加载后才能写入）
+            if collection_name not in self.indexes or self._is_mmap_index(collection_name):
                 load_success = self._load_index(collection_name)
                 if not load_success:
                     logger.error(f"无法加载集合 {collection_name} 的索引")
@@ -795,8 +1518,8 @@ class FaissManager:
                 if not load_success:
                     logger.warning(f"无法加载集合 {collection_name} 的文件注册表，将创建新的文件注册表")
                     self.file_registry[collection_name] = {
-                        "_created_at": datetime.now().isoformat(),
-                        "_last_updated": datetime.now().isoformat(),
+                        "_created_at": now_iso,
+                        "_last_updated": now_iso,
                         "_file_count": 0,
                         "_vector_count": 0
                     }
@@ -807,8 +1530,8 @@ class FaissManager:
             elif not isinstance(self.file_registry[collection_name], dict):
                 logger.error(f"文件注册表格式错误: {type(self.file_registry[collection_name])}，重新初始化")
                 self.file_registry[collection_name] = {
-                    "_created_at": datetime.now().isoformat(),
-                    "_last_updated": datetime.now().isoformat(),
+                    "_created_at": now_iso,
+                    "_last_updated": now_iso,
                     "_file_count": 0,
                     "_vector_count": 0
                 }
@@ -817,7 +1540,7 @@ class FaissManager:
                     logger.error(f"无法保存重新初始化的文件注册表 {collection_name}")
             
             # 获取已加载的对象
-            index = self.indexes[collection_name]
+            index = self._get_index(collection_name)
             collection_metadata = self.metadata[collection_name]
             logger.info(f"集合 {collection_name} 当前状态: 索引包含 {index.ntotal} 个向量，元数据包含 {len(collection_metadata) if isinstance(collection_metadata, list) else len(collection_metadata.keys())} 条记录")
             
@@ -826,18 +1549,34 @@ class FaissManager:
                 logger.error(f"元数据条目数量 ({len(metadata)}) 与向量数量 ({len(vectors)}) 不匹配")
                 return {"status": "error", "message": "元数据条目数量与向量数量不匹配"}
             
+            # FAISS需要C连续的float32二维数组，否则会在内部再复制转换一次；在此统一转换
+            converted = np.ascontiguousarray(vectors, dtype=np.float32)
+            if converted is not vectors:
+                logger.warning(f"输入向量不是C连续的float32数组（{getattr(vectors, 'dtype', type(vectors).__name__)}），已转换")
+            vectors = converted
+            if vectors.ndim != 2 or vectors.shape[1] != index.d:
+                logger.error(f"向量形状 {vectors.shape} 与集合 {collection_name} 的维度 {index.d} 不匹配")
+                return {"status": "error", "message": f"向量维度与集合维度 {index.d} 不匹配"}
+            
             # 如果是空索引，直接添加所有向量
             if index.ntotal == 0:
                 logger.info(f"索引为空，直接添加所有 {len(vectors)} 个向量到集合 {collection_name}")
                 try:
-                    # 复制向量以防止修改原始数据
-                    vectors_to_add = np.array(vectors)
+                    # 旧版本创建的未训练IVF索引先换成Flat索引，向量数足够时再训练
+                    if not index.is_trained:
+                        index = faiss.IndexFlat(index.d, index.metric_type)
+                        self._mmap_indexes.pop(collection_name, None)
+                        self._cache_index(collection_name, index)
+                    
+                    # 入口处已转换为C连续的float32数组，index.add不会修改输入，无需再复制
+                    vectors_to_add = vectors
                     
                     # 记录添加前的计数，应该为0
                     before_count = index.ntotal
                     
                     # 添加向量到索引
                     index.add(vectors_to_add)
+                    index = self._maybe_train_index(collection_name, index)
                     
                     # 验证索引更新
                     after_count = index.ntotal
@@ -851,17 +1590,17 @@ class FaissManager:
                         # 如果元数据是列表，直接扩展
                         collection_metadata.extend(metadata)
                     elif isinstance(collection_metadata, dict):
-                        # 如果元数据是字典，使用索引作为键
-                        for i in range(added_count):
-                            if i < len(metadata):
-                                collection_metadata[str(before_count + i)] = metadata[i]
+                        # 如果元数据是字典，使用索引作为键，一次性构造全部条目后合并
+                        collection_metadata.update({
+                            str(before_count + i): meta for i, meta in enumerate(metadata[:added_count])
+                        })
                     
                     # 确保文件注册表已正确初始化
                     if collection_name not in self.file_registry or not isinstance(self.file_registry[collection_name], dict):
                         logger.warning(f"文件注册表未正确初始化，重新创建")
                         self.file_registry[collection_name] = {
-                            "_created_at": datetime.now().isoformat(),
-                            "_last_updated": datetime.now().isoformat(),
+                            "_created_at": now_iso,
+                            "_last_updated": now_iso,
                             "_file_count": 0,
                             "_vector_count": 0
                         }
@@ -876,26 +1615,28 @@ class FaissManager:
                         self.file_registry[collection_name][file_name] = {
                             "file_name": file_name,  # 明确存储文件名
                             "file_path": file_path,  # 存储完整路径
-                            "added_at": datetime.now().isoformat(),
+                            "added_at": now_iso,
                             "vector_count": added_count,
-                            "last_updated": datetime.now().isoformat(),
+                            "last_updated": now_iso,
                             "versions": [
                                 {
                                     "version": 1,
                                     "vector_count": added_count,
                                     "vector_ids": list(range(before_count, before_count + added_count)),
-                                    "created_at": datetime.now().isoformat()
+                                    "created_at": now_iso
                                 }
                             ],
                             "current_version": 1
                         }
+                        if not file_name.startswith('_'):
+                            self._apply_registry_delta(collection_name, 1, added_count)
                         logger.info(f"文件注册表: 添加新文件 {file_name} 记录，包含 {added_count} 个向量")
                         
                         # 记录新文件添加事件
                         self._record_file_event(collection_name, file_name, "file_added", {
                             "vector_count": added_count,
                             "file_path": file_path
-                        })
+                        }, timestamp=now)
                     else:
                         # 更新现有文件记录
                         current_file = self.file_registry[collection_name][file_name]
@@ -917,7 +1658,9 @@ class FaissManager:
                         # 更新向量计数
                         old_count = current_file["vector_count"]
                         current_file["vector_count"] += added_count
-                        current_file["last_updated"] = datetime.now().isoformat()
+                        if not file_name.startswith('_'):
+                            self._apply_registry_delta(collection_name, 0, added_count)
+                        current_file["last_updated"] = now_iso
                         logger.info(f"更新向量计数: {old_count} -> {current_file['vector_count']}")
                         
                         # 确保versions字段存在
@@ -926,15 +1669,17 @@ class FaissManager:
                             logger.debug("添加缺失的versions字段")
                             
                         # 创建新版本
+                        # 版本只在此处按递增顺序追加，最后一个即最大版本号；
+                        # 不能用current_version，恢复旧版本后它会小于已有的最大版本号
                         next_version = 1
                         if current_file["versions"]:
-                            next_version = max([v.get("version", 0) for v in current_file["versions"]]) + 1
+                            next_version = current_file["versions"][-1].get("version", 0) + 1
                             
                         new_version = {
                             "version": next_version,
                             "vector_count": added_count,
                             "vector_ids": list(range(before_count, before_count + added_count)),
-                            "created_at": datetime.now().isoformat()
+                            "created_at": now_iso
                         }
                         
                         current_file["versions"].append(new_version)
@@ -945,35 +1690,32 @@ class FaissManager:
                         self._record_file_event(collection_name, file_name, "file_updated", {
                             "new_version": next_version,
                             "added_vectors": added_count
-                        })
+                        }, timestamp=now)
                     
                     # 更新元数据信息，确保每个向量都有文件信息
-                    for i, meta in enumerate(metadata):
-                        vector_idx = before_count + i
-                        if isinstance(collection_metadata, dict):
-                            if str(vector_idx) in collection_metadata:
-                                if "metadata" not in collection_metadata[str(vector_idx)]:
-                                    collection_metadata[str(vector_idx)]["metadata"] = {}
-                                collection_metadata[str(vector_idx)]["metadata"]["file_name"] = file_name
-                                collection_metadata[str(vector_idx)]["metadata"]["file_path"] = file_path
-                        elif isinstance(collection_metadata, list) and vector_idx < len(collection_metadata):
-                            if "metadata" not in collection_metadata[vector_idx]:
-                                collection_metadata[vector_idx]["metadata"] = {}
-                            collection_metadata[vector_idx]["metadata"]["file_name"] = file_name
-                            collection_metadata[vector_idx]["metadata"]["file_path"] = file_path
+                    # （按元数据类型选择一次处理函数，循环内不再逐条判断类型）
+                    if isinstance(collection_metadata, dict):
+                        _set_file_fields_dict(collection_metadata, before_count, len(metadata), file_name, file_path)
+                    elif isinstance(collection_metadata, list):
+                        _set_file_fields_list(collection_metadata, before_count, len(metadata), file_name, file_path)
                     
                     # 更新文件注册表的基本统计信息
-                    self.file_registry[collection_name]["_last_updated"] = datetime.now().isoformat()
-                    file_count = sum(1 for k in self.file_registry[collection_name].keys() if not k.startswith('_'))
+                    self.file_registry[collection_name]["_last_updated"] = now_iso
+                    # 文件数已随上面的新增/更新增量维护，无需遍历注册表
+                    file_count = self._get_registry_counts(collection_name)[0]
                     self.file_registry[collection_name]["_file_count"] = file_count
                     self.file_registry[collection_name]["_vector_count"] = index.ntotal
                     logger.info(f"更新文件注册表统计信息: {file_count} 个文件, {index.ntotal} 个向量")
                     
-                    # 保存更新后的数据
-                    logger.info(f"开始保存索引、元数据和文件注册表...")
-                    index_saved = self._save_index(collection_name)
-                    metadata_saved = self._save_metadata(collection_name)
-                    registry_saved = self._save_file_registry(collection_name)
+                    # 保存更新后的数据（sync=False或batch_writes块中只标记，稍后统一写入）
+                    if not sync or self._is_batching(collection_name):
+                        self._mark_dirty(collection_name)
+                        index_saved = metadata_saved = registry_saved = True
+                    else:
+                        logger.info(f"开始保存索引、元数据和文件注册表...")
+                        index_saved = self._save_index(collection_name)
+                        metadata_saved = self._save_metadata(collection_name)
+                        registry_saved = self._append_registry_event(collection_name, file_name)
                     
                     # 检查所有组件是否成功保存
                     if not index_saved:
@@ -989,16 +1731,16 @@ class FaissManager:
                         # 记录保存失败事件
                         self._record_collection_event(collection_name, "save_failed", {
                             "error": error_msg,
-                            "timestamp": datetime.now().isoformat()
-                        })
+                            "timestamp": now_iso
+                        }, timestamp=now)
                         return {"status": "error", "message": "向量添加成功但保存数据失败"}
                     
                     # 记录成功事件
                     self._record_collection_event(collection_name, "vectors_added", {
                         "count": added_count,
                         "file_name": file_name,
-                        "timestamp": datetime.now().isoformat()
-                    })
+                        "timestamp": now_iso
+                    }, timestamp=now)
                     
                     logger.info(f"成功添加 {added_count} 个向量到空索引 {collection_name}")
                     return {
@@ -1015,47 +1757,47 @@ class FaissManager:
                     self._record_collection_event(collection_name, "add_vectors_error", {
                         "error": str(e),
                         "file_path": file_path,
-                        "timestamp": datetime.now().isoformat()
-                    })
+                        "timestamp": now_iso
+                    }, timestamp=now)
                     return {"status": "error", "message": error_msg}
             
-            # 对于非空索引，首先检查重复
-            accepted_vectors = []
-            accepted_metadata = []
-            duplicates_count = 0
+            # 对于非空索引，首先检查重复：所有新向量一次批量查询各自的最近邻
+            # （只与已有向量比较，新向量之间不互相去重）
+            D, I = index.search(vectors, 1)
+            nearest_dists = D[:, 0]
+            nearest_ids = I[:, 0]
             
-            for i, (vector, meta) in enumerate(zip(vectors, metadata)):
-                # 搜索最相似的向量
-                D, I = index.search(np.array([vector]), 1)
+            # 有匹配结果且距离小于阈值即视为重复
+            is_duplicate = (nearest_ids != -1) & (nearest_dists < 0.01)
+            duplicates_count = int(is_duplicate.sum())
+            
+            for i in np.flatnonzero(is_duplicate):
+                existing_idx = int(nearest_ids[i])
                 
-                # 检查是否有匹配结果以及距离是否小于阈值
-                if I[0][0] != -1 and D[0][0] < 0.01:
-                    duplicates_count += 1
-                    existing_idx = I[0][0]
-                    
-                    if isinstance(collection_metadata, list) and 0 <= existing_idx < len(collection_metadata):
-                        existing_meta = collection_metadata[existing_idx]
-                    elif isinstance(collection_metadata, dict) and str(existing_idx) in collection_metadata:
-                        existing_meta = collection_metadata[str(existing_idx)]
-                    else:
-                        existing_meta = {"text": "未知文档"}
-                    
-                    logger.info(f"发现重复向量: 距离={D[0][0]}, 索引={I[0][0]}, 现有文本: {existing_meta.get('text', '')[:50]}...")
+                if isinstance(collection_metadata, list) and 0 <= existing_idx < len(collection_metadata):
+                    existing_meta = collection_metadata[existing_idx]
+                elif isinstance(collection_metadata, dict) and str(existing_idx) in collection_metadata:
+                    existing_meta = collection_metadata[str(existing_idx)]
                 else:
-                    logger.info(f"接受新向量 #{i}: 距离={D[0][0] if I[0][0] != -1 else 'N/A'}, 原因: {'距离 > 阈值(0.01)' if I[0][0] != -1 else '没有找到匹配项'}")
-                    accepted_vectors.append(vector)
-                    accepted_metadata.append(meta)
+                    existing_meta = {"text": "未知文档"}
+                
+                logger.info(f"发现重复向量: 距离={nearest_dists[i]}, 索引={existing_idx}, 现有文本: {existing_meta.get('text', '')[:50]}...")
+            
+            accepted_vectors = vectors[~is_duplicate]
+            accepted_metadata = [meta for meta, duplicate in zip(metadata, is_duplicate) if not duplicate]
+            logger.info(f"接受 {len(accepted_metadata)} 个新向量（距离 > 阈值(0.01) 或没有找到匹配项）")
             
             # 如果有向量被接受，则添加它们
-            if accepted_vectors:
+            if accepted_metadata:
                 try:
                     logger.info(f"准备添加 {len(accepted_vectors)} 个非重复向量到集合 {collection_name}")
-                    # 将接受的向量转换为NumPy数组
-                    vectors_to_add = np.array(accepted_vectors)
+                    # 布尔掩码取出的已是新的C连续float32数组，直接添加
+                    vectors_to_add = accepted_vectors
                     
                     # 添加向量到索引
                     before_count = index.ntotal
                     index.add(vectors_to_add)
+                    index = self._maybe_train_index(collection_name, index)
                     after_count = index.ntotal
                     added_count = after_count - before_count
                     
@@ -1068,17 +1810,17 @@ class FaissManager:
                         # 如果元数据是列表，直接扩展
                         collection_metadata.extend(accepted_metadata)
                     elif isinstance(collection_metadata, dict):
-                        # 如果元数据是字典，使用索引作为键
-                        for i in range(added_count):
-                            if i < len(accepted_metadata):
-                                collection_metadata[str(before_count + i)] = accepted_metadata[i]
+                        # 如果元数据是字典，使用索引作为键，一次性构造全部条目后合并
+                        collection_metadata.update({
+                            str(before_count + i): meta for i, meta in enumerate(accepted_metadata[:added_count])
+                        })
                     
                     # 确保文件注册表已正确初始化
                     if collection_name not in self.file_registry or not isinstance(self.file_registry[collection_name], dict):
                         logger.warning(f"文件注册表未正确初始化，重新创建")
                         self.file_registry[collection_name] = {
-                            "_created_at": datetime.now().isoformat(),
-                            "_last_updated": datetime.now().isoformat(),
+                            "_created_at": now_iso,
+                            "_last_updated": now_iso,
                             "_file_count": 0,
                             "_vector_count": 0
                         }
@@ -1094,19 +1836,21 @@ class FaissManager:
                         self.file_registry[collection_name][file_name] = {
                             "file_name": file_name,
                             "file_path": file_path,
-                            "added_at": datetime.now().isoformat(),
+                            "added_at": now_iso,
                             "vector_count": added_count,
-                            "last_updated": datetime.now().isoformat(),
+                            "last_updated": now_iso,
                             "versions": [
                                 {
                                     "version": 1,
                                     "vector_count": added_count,
                                     "vector_ids": list(range(before_count, before_count + added_count)),
-                                    "created_at": datetime.now().isoformat()
+                                    "created_at": now_iso
                                 }
                             ],
                             "current_version": 1
                         }
+                        if not file_name.startswith('_'):
+                            self._apply_registry_delta(collection_name, 1, added_count)
                         logger.info(f"文件注册表: 添加新文件 {file_name} 记录，包含 {added_count} 个向量")
                         
                         # 记录新文件添加事件
@@ -1114,7 +1858,7 @@ class FaissManager:
                             "vector_count": added_count,
                             "file_path": file_path,
                             "duplicates_skipped": duplicates_count
-                        })
+                        }, timestamp=now)
                     else:
                         # 更新现有文件记录
                         current_file = self.file_registry[collection_name][file_name]
@@ -1137,19 +1881,23 @@ class FaissManager:
                         # 更新向量计数
                         old_count = current_file["vector_count"]
                         current_file["vector_count"] += added_count
-                        current_file["last_updated"] = datetime.now().isoformat()
+                        if not file_name.startswith('_'):
+                            self._apply_registry_delta(collection_name, 0, added_count)
+                        current_file["last_updated"] = now_iso
                         logger.info(f"更新向量计数: {old_count} -> {current_file['vector_count']}")
                         
                         # 创建新版本
+                        # 版本只在此处按递增顺序追加，最后一个即最大版本号；
+                        # 不能用current_version，恢复旧版本后它会小于已有的最大版本号
                         next_version = 1
                         if current_file["versions"]:
-                            next_version = max([v.get("version", 0) for v in current_file["versions"]]) + 1
+                            next_version = current_file["versions"][-1].get("version", 0) + 1
                             
                         new_version = {
                             "version": next_version,
                             "vector_count": added_count,
                             "vector_ids": list(range(before_count, before_count + added_count)),
-                            "created_at": datetime.now().isoformat()
+                            "created_at": now_iso
                         }
                         
                         current_file["versions"].append(new_version)
@@ -1161,35 +1909,32 @@ class FaissManager:
                             "new_version": next_version,
                             "added_vectors": added_count,
                             "duplicates_skipped": duplicates_count
-                        })
+                        }, timestamp=now)
                     
                     # 更新元数据中的文件信息
-                    for i, meta in enumerate(accepted_metadata):
-                        vector_idx = before_count + i
-                        if isinstance(collection_metadata, dict):
-                            if str(vector_idx) in collection_metadata:
-                                if "metadata" not in collection_metadata[str(vector_idx)]:
-                                    collection_metadata[str(vector_idx)]["metadata"] = {}
-                                collection_metadata[str(vector_idx)]["metadata"]["file_name"] = file_name
-                                collection_metadata[str(vector_idx)]["metadata"]["file_path"] = file_path
-                        elif isinstance(collection_metadata, list) and vector_idx < len(collection_metadata):
-                            if "metadata" not in collection_metadata[vector_idx]:
-                                collection_metadata[vector_idx]["metadata"] = {}
-                            collection_metadata[vector_idx]["metadata"]["file_name"] = file_name
-                            collection_metadata[vector_idx]["metadata"]["file_path"] = file_path
+                    # （按元数据类型选择一次处理函数，循环内不再逐条判断类型）
+                    if isinstance(collection_metadata, dict):
+                        _set_file_fields_dict(collection_metadata, before_count, len(accepted_metadata), file_name, file_path)
+                    elif isinstance(collection_metadata, list):
+                        _set_file_fields_list(collection_metadata, before_count, len(accepted_metadata), file_name, file_path)
                     
                     # 更新文件注册表的基本统计信息
-                    self.file_registry[collection_name]["_last_updated"] = datetime.now().isoformat()
-                    file_count = sum(1 for k in self.file_registry[collection_name].keys() if not k.startswith('_'))
+                    self.file_registry[collection_name]["_last_updated"] = now_iso
+                    # 文件数已随上面的新增/更新增量维护，无需遍历注册表
+                    file_count = self._get_registry_counts(collection_name)[0]
                     self.file_registry[collection_name]["_file_count"] = file_count
                     self.file_registry[collection_name]["_vector_count"] = index.ntotal
                     logger.info(f"更新文件注册表统计信息: {file_count} 个文件, {index.ntotal} 个向量")
                     
-                    # 保存更新后的数据
-                    logger.info(f"开始保存索引、元数据和文件注册表...")
-                    index_saved = self._save_index(collection_name)
-                    metadata_saved = self._save_metadata(collection_name)
-                    registry_saved = self._save_file_registry(collection_name)
+                    # 保存更新后的数据（sync=False或batch_writes块中只标记，稍后统一写入）
+                    if not sync or self._is_batching(collection_name):
+                        self._mark_dirty(collection_name)
+                        index_saved = metadata_saved = registry_saved = True
+                    else:
+                        logger.info(f"开始保存索引、元数据和文件注册表...")
+                        index_saved = self._save_index(collection_name)
+                        metadata_saved = self._save_metadata(collection_name)
+                        registry_saved = self._append_registry_event(collection_name, file_name)
                     
                     # 检查所有组件是否成功保存
                     if not index_saved:
@@ -1205,8 +1950,8 @@ class FaissManager:
                         # 记录保存失败事件
                         self._record_collection_event(collection_name, "save_failed", {
                             "error": error_msg,
-                            "timestamp": datetime.now().isoformat()
-                        })
+                            "timestamp": now_iso
+                        }, timestamp=now)
                         return {"status": "error", "message": "向量添加成功但保存数据失败"}
                     
                     # 记录成功事件
@@ -1214,8 +1959,8 @@ class FaissManager:
                         "count": added_count,
                         "file_name": file_name,
                         "duplicates_skipped": duplicates_count,
-                        "timestamp": datetime.now().isoformat()
-                    })
+                        "timestamp": now_iso
+                    }, timestamp=now)
                     
                     logger.info(f"成功添加 {added_count} 个向量到集合 {collection_name}, 拒绝了 {duplicates_count} 个重复向量")
                     return {
@@ -1233,8 +1978,8 @@ class FaissManager:
                     self._record_collection_event(collection_name, "add_vectors_error", {
                         "error": str(e),
                         "file_path": file_path,
-                        "timestamp": datetime.now().isoformat()
-                    })
+                        "timestamp": now_iso
+                    }, timestamp=now)
                     return {"status": "error", "message": error_msg}
             else:
                 logger.info(f"所有 {len(vectors)} 个向量都被视为重复，没有添加任何向量到索引 {collection_name}")
@@ -1242,8 +1987,8 @@ class FaissManager:
                 self._record_collection_event(collection_name, "all_vectors_duplicate", {
                     "vector_count": len(vectors),
                     "file_path": file_path,
-                    "timestamp": datetime.now().isoformat()
-                })
+                    "timestamp": now_iso
+                }, timestamp=now)
                 return {
                     "status": "success", 
                     "message": f"所有 {len(vectors)} 个向量都是重复的，没有添加任何新向量", 
@@ -1261,13 +2006,14 @@ class FaissManager:
                 self._record_collection_event(collection_name, "critical_error", {
                     "error": str(e),
                     "file_path": file_path if file_path else "未知",
-                    "timestamp": datetime.now().isoformat()
-                })
+                    "timestamp": now_iso
+                }, timestamp=now)
             except:
                 # 如果连错误记录都失败，则静默处理
                 pass
             return {"status": "error", "message": error_msg}
     
+    @_with_collection_lock
     def search(self, collection_name: str, query_vector: np.ndarray, top_k: int = 5) -> Tuple[List[int], List[float], List[Dict]]:
         """
         搜索与查询向量最相似的文档
@@ -1280,12 +2026,11 @@ class FaissManager:
         Returns:
             Tuple: (索引列表, 相似度列表, 元数据列表)
         """
-        if collection_name not in self.indexes:
-            self._load_index(collection_name)
+        index = self._get_index(collection_name, read_only=True)
         if collection_name not in self.metadata:
             self._load_metadata(collection_name)
         
-        if collection_name not in self.indexes:
+        if index is None:
             logger.error(f"搜索失败: 无法加载索引 {collection_name}")
             return [], [], []
         
@@ -1296,11 +2041,13 @@ class FaissManager:
         consistency_check = self.check_and_fix_collection_consistency(collection_name)
         if not consistency_check:
             logger.warning(f"集合 {collection_name} 可能存在一致性问题，搜索结果可能不完整")
+        # 一致性检查可能重新加载索引，取其最新的索引对象
+        index = self.indexes.get(collection_name, index)
         
         try:
-            logger.info(f"搜索集合：{collection_name}，当前索引总数：{self.indexes[collection_name].ntotal}，请求top_k：{top_k}")
+            logger.info(f"搜索集合：{collection_name}，当前索引总数：{index.ntotal}，请求top_k：{top_k}")
             
-            if self.indexes[collection_name].ntotal == 0:
+            if index.ntotal == 0:
                 logger.warning(f"集合 {collection_name} 是空的，没有可搜索的向量")
                 
                 if collection_name in self.file_registry and self.file_registry[collection_name]:
@@ -1318,12 +2065,10 @@ class FaissManager:
                 
                 return [], [], []
             
-            # 确保向量格式正确
-            query_vector = np.array(query_vector).astype('float32').reshape(1, -1)
-            
             # 检查向量维度
-            expected_dim = self.indexes[collection_name].d
-            actual_dim = query_vector.shape[1]
+            query_vector = np.asarray(query_vector)
+            expected_dim = index.d
+            actual_dim = query_vector.size
             
             # 记录向量维度信息
             logger.info(f"查询向量维度: {actual_dim}, 索引期望维度: {expected_dim}")
@@ -1332,8 +2077,15 @@ class FaissManager:
                 logger.error(f"查询向量维度错误: 期望{expected_dim}维，但提供{actual_dim}维")
                 return [], [], []
             
-            # 执行搜索
-            D, I = self.indexes[collection_name].search(query_vector, min(top_k, self.indexes[collection_name].ntotal))
+            # IVF索引按聚类中心数设置探查的倒排列表数，默认只查1个列表召回过低
+            ivf = faiss.try_extract_index_ivf(index)
+            if ivf is not None:
+                ivf.nprobe = min(ivf.nlist, max(8, ivf.nlist // 32))
+            
+            # 执行搜索：查询向量复制（并转换为float32）到复用的缓冲区，结果直接写入复用的D、I
+            q, D, I = self._get_search_buffers(expected_dim, min(top_k, index.ntotal))
+            q[0] = query_vector.reshape(-1)
+            index.search(q, I.shape[1], D=D, I=I)
             
             # 展平结果
             indices = I[0].tolist()
@@ -1429,6 +2181,7 @@ class FaissManager:
             logger.error(f"应用筛选条件时出错: {str(e)}")
             return False
     
+    @_with_collection_lock
     def delete_vectors(self, collection_name: str, ids: List[int]) -> bool:
         """
         从集合中删除指定ID的向量
@@ -1497,7 +2250,7 @@ class FaissManager:
                         })
             
             # 更新索引和元数据
-            self.indexes[collection_name] = new_index
+            self._cache_index(collection_name, new_index)
             self.metadata[collection_name] = new_metadata
             
             # 保存索引、元数据和文件注册表
@@ -1518,6 +2271,7 @@ class FaissManager:
             logger.error(f"从集合 {collection_name} 中删除向量失败: {str(e)}")
             return False
     
+    @_with_collection_lock
     def delete_collection(self, collection_name: str) -> bool:
         """
         删除整个集合
@@ -1538,6 +2292,8 @@ class FaissManager:
             metadata_path = self._get_metadata_path(collection_name)
             registry_path = self._get_file_registry_path(collection_name)
             history_path = self._get_file_history_path(collection_name)
+            legacy_history_path = self._get_legacy_file_history_path(collection_name)
+            registry_log_path = self._get_file_registry_log_path(collection_name)
             
             if os.path.exists(index_path):
                 os.remove(index_path)
@@ -1547,8 +2303,16 @@ class FaissManager:
                 os.remove(registry_path)
             if os.path.exists(history_path):
                 os.remove(history_path)
+            if os.path.exists(legacy_history_path):
+                os.remove(legacy_history_path)
+            if os.path.exists(registry_log_path):
+                os.remove(registry_log_path)
+            self._invalidate_collections_cache()
+            self._index_types.pop(collection_name, None)
                 
-            # 从内存中移除
+            # 从内存中移除，并丢弃尚未落盘的修改
+            with self._dirty_lock:
+                self._dirty.discard(collection_name)
             if collection_name in self.indexes:
                 del self.indexes[collection_name]
             if collection_name in self.metadata:
@@ -1565,6 +2329,7 @@ class FaissManager:
             logger.error(f"删除集合 {collection_name} 失败: {str(e)}")
             return False
     
+    @_with_collection_lock
     def list_files(self, collection_name: str) -> List[Dict[str, Any]]:
         """
         获取集合中的所有文件信息
@@ -1637,10 +2402,8 @@ class FaissManager:
                         file_data['chunks_count'] = 0
                     
                     # 尝试获取文件大小
-                    if 'file_path' in file_info and os.path.exists(file_info['file_path']):
-                        file_data['file_size'] = os.path.getsize(file_info['file_path'])
-                    else:
-                        file_data['file_size'] = 0
+                    file_st = _stat_or_none(file_info['file_path']) if 'file_path' in file_info else None
+                    file_data['file_size'] = file_st.st_size if file_st else 0
                         
                     files_info.append(file_data)
                     logger.debug(f"已添加文件信息: {file_data}")
@@ -1655,6 +2418,29 @@ class FaissManager:
             logger.exception(e)
             return []
     
+    @_with_collection_lock
+    def file_exists(self, collection_name: str, file_name: str) -> bool:
+        """
+        检查集合中是否存在指定文件（直接查文件注册表，O(1)）
+        
+        Args:
+            collection_name: 集合名称
+            file_name: 文件名
+            
+        Returns:
+            bool: 文件是否存在
+        """
+        if file_name.startswith('_') or not self.collection_exists(collection_name):
+            return False
+            
+        if collection_name not in self.file_registry:
+            if not self._load_file_registry(collection_name):
+                logger.error(f"加载集合 {collection_name} 的文件注册表失败")
+                return False
+                
+        return file_name in self.file_registry[collection_name]
+    
+    @_with_collection_lock
     def get_file_info(self, collection_name: str, file_name: str) -> Dict[str, Any]:
         """
         获取集合中特定文件的详细信息
@@ -1682,6 +2468,7 @@ class FaissManager:
             
         return self.file_registry[collection_name][file_name]
     
+    @_with_collection_lock
     def get_file_change_history(self, collection_name: str, file_name: str = None) -> List[Dict[str, Any]]:
         """
         获取文件变更历史记录
@@ -1709,6 +2496,7 @@ class FaissManager:
             # 返回所有文件变更历史
             return self.file_change_history[collection_name]
     
+    @_with_collection_lock
     def replace_file(self, collection_name: str, file_path: str, vectors: np.ndarray, metadata: List[Dict]) -> bool:
         """
         替换集合中的文件（创建新版本）
@@ -1747,8 +2535,8 @@ class FaissManager:
                     # 删除当前版本的向量
                     self.delete_vectors(collection_name, current_version_info['vector_ids'])
             
-            # 添加新版本的向量
-            success = self.add_vectors(collection_name, vectors, metadata, file_path)
+            # 添加新版本的向量（add_vectors返回结果字典）
+            success = self.add_vectors(collection_name, vectors, metadata, file_path).get("status") == "success"
             
             if success:
                 logger.info(f"成功替换文件 {file_name} 在集合 {collection_name} 中的内容")
@@ -1758,6 +2546,7 @@ class FaissManager:
             logger.error(f"替换文件 {file_name} 在集合 {collection_name} 中的内容失败: {str(e)}")
             return False
     
+    @_with_collection_lock
     def delete_file(self, collection_name: str, file_name: str) -> bool:
         """
         从集合中删除指定文件
@@ -1800,9 +2589,11 @@ class FaissManager:
             
             # 从文件注册表中删除文件
             del file_registry[file_name]
+            if not file_name.startswith('_') and isinstance(file_info, dict):
+                self._apply_registry_delta(collection_name, -1, -file_info.get("vector_count", 0))
             
             # 保存更新后的文件注册表
-            self._save_file_registry(collection_name)
+            self._append_registry_event(collection_name, file_name)
             
             # 记录文件删除事件
             event_data = {
@@ -1823,6 +2614,7 @@ class FaissManager:
             logger.exception(e)
             return False
     
+    @_with_collection_lock
     def update_file_metadata(self, collection_name: str, file_name: str, metadata_update: Dict[str, Any]) -> bool:
         """
         更新文件的元数据信息，包括重要性系数等
@@ -1861,9 +2653,12 @@ class FaissManager:
             if not updated:
                 logger.info(f"文件 {file_name} 的元数据无变化，不需要更新")
                 return True
+            
+            # 更新的字段可能包括vector_count，下次保存时重新统计
+            self._registry_counts.pop(collection_name, None)
                 
             # 保存更新后的文件注册表
-            self._save_file_registry(collection_name)
+            self._append_registry_event(collection_name, file_name)
             
             # 记录元数据更新事件
             event_data = {
@@ -1881,6 +2676,7 @@ class FaissManager:
             logger.exception(e)
             return False
     
+    @_with_collection_lock
     def restore_file_version(self, collection_name: str, file_name: str, version: int) -> bool:
         """
         恢复文件的特定版本
@@ -1921,7 +2717,7 @@ class FaissManager:
         try:
             # 更新当前版本
             file_info['current_version'] = version
-            self._save_file_registry(collection_name)
+            self._append_registry_event(collection_name, file_name)
             
             logger.info(f"成功将文件 {file_name} 恢复到版本 {version}")
             return True
@@ -1948,8 +2744,7 @@ class FaissManager:
         collections_info = {}
         if os.path.exists(collections_info_path):
             try:
-                with open(collections_info_path, 'r', encoding='utf-8') as f:
-                    collections_info = json.load(f)
+                collections_info = _load_json_file(collections_info_path)
             except Exception as e:
                 logger.error(f"读取集合信息文件失败: {str(e)}")
                 collections_info = {}
@@ -1967,8 +2762,7 @@ class FaissManager:
         
         # 保存集合信息
         try:
-            with open(collections_info_path, 'w', encoding='utf-8') as f:
-                json.dump(collections_info, f, ensure_ascii=False, indent=2)
+            _dump_json_file(collections_info_path, collections_info, indent=True)
             return True
         except Exception as e:
             logger.error(f"保存集合信息失败: {str(e)}")
@@ -1991,8 +2785,7 @@ class FaissManager:
         # 读取现有集合信息
         if os.path.exists(collections_info_path):
             try:
-                with open(collections_info_path, 'r', encoding='utf-8') as f:
-                    collections_info = json.load(f)
+                collections_info = _load_json_file(collections_info_path)
             except Exception as e:
                 logger.error(f"读取集合信息文件失败: {str(e)}")
                 return False
@@ -2006,8 +2799,7 @@ class FaissManager:
                 
                 # 保存更新后的集合信息
                 try:
-                    with open(collections_info_path, 'w', encoding='utf-8') as f:
-                        json.dump(collections_info, f, ensure_ascii=False, indent=2)
+                    _dump_json_file(collections_info_path, collections_info, indent=True)
                     return True
                 except Exception as e:
                     logger.error(f"保存更新后的集合信息失败: {str(e)}")
@@ -2015,31 +2807,129 @@ class FaissManager:
         
         return False
 
-    def _train_index(self, index, dimension: int, n_samples: int = 1000) -> bool:
+    def _get_collection_index_type(self, collection_name: str) -> Optional[str]:
         """
-        训练FAISS索引，用于IVF等需要训练的索引类型
+        获取集合创建时指定的索引类型（记录在集合信息文件中）
         
         Args:
-            index: FAISS索引对象
-            dimension: 向量维度
-            n_samples: 训练样本数量
+            collection_name: 集合名称
             
         Returns:
-            bool: 训练是否成功
+            Optional[str]: 索引类型，集合信息中没有记录时返回None
         """
-        try:
-            # 生成随机训练数据
-            np.random.seed(42)  # 设置随机种子确保可重复性
-            training_data = np.random.random((n_samples, dimension)).astype('float32')
+        if collection_name not in self._index_types:
+            index_type = None
+            try:
+                collections_info = _load_json_file(self._get_collection_info_path())
+                index_type = collections_info.get(collection_name, {}).get("index_type")
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"读取集合信息文件失败: {str(e)}")
+                return None
+            self._index_types[collection_name] = index_type
+        return self._index_types[collection_name]
+    
+    def _maybe_train_index(self, collection_name: str, index):
+        """
+        需要训练的集合在向量数达到训练所需的样本数前以Flat索引保存，达到后用全部真实向量
+        训练目标索引、写入已有向量并替换集合中的Flat索引（向量ID保持不变）；
+        IVF集合的向量数增长到当前nlist明显偏小时，按新的向量数重新训练
+        
+        Args:
+            collection_name: 集合名称
+            index: 刚写入向量的索引
             
-            # 训练索引
-            logger.info(f"训练索引，样本数量: {n_samples}")
-            index.train(training_data)
-            return True
-        except Exception as e:
-            logger.error(f"训练索引失败: {str(e)}")
-            return False
+        Returns:
+            集合当前的索引（可能是替换后的新索引）
+        """
+        n = index.ntotal
+        if isinstance(index, faiss.IndexIVFFlat):
+            # 向量数增长后当前nlist明显偏小（每个列表过长）时，用全部向量按新的数量重新训练
+            if self._ivf_nlist(n) < index.nlist * _IVF_RETRAIN_GROWTH:
+                return index
+            ids, vectors = self._get_ivf_vectors(index)
+            return self._train_ivf_index(collection_name, index, vectors, ids)
+        if not isinstance(index, faiss.IndexFlat):
+            return index
+        
+        index_type = self._get_collection_index_type(collection_name)
+        if index_type == "IVF" and n >= _IVF_MIN_TRAIN_VECTORS:
+            return self._train_ivf_index(collection_name, index, index.reconstruct_n(0, n))
+        if index_type != "SQ8" or n < _SQ8_MIN_TRAIN_VECTORS:
+            return index
+        
+        vectors = index.reconstruct_n(0, n)
+        trained = faiss.IndexScalarQuantizer(index.d, faiss.ScalarQuantizer.QT_8bit, index.metric_type)
+        logger.info(f"使用 {n} 个向量训练集合 {collection_name} 的SQ8量化器")
+        trained.train(vectors)
+        trained.add(vectors)
+        self._mmap_indexes.pop(collection_name, None)
+        self._cache_index(collection_name, trained)
+        return trained
+    
+    @staticmethod
+    def _ivf_nlist(n: int) -> int:
+        """按向量数确定IVF的nlist：经验值≈4*sqrt(N)；FAISS建议每个聚类中心至少39个训练样本，样本不足时减少中心数"""
+        return min(65536, int(4 * math.sqrt(n)), max(1, n // 39))
+    
+    @staticmethod
+    def _get_ivf_vectors(index) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        从IVFFlat索引的倒排列表中取出全部向量及其ID（IVFFlat按原始float32保存向量，无损）
+        
+        Args:
+            index: IVFFlat索引
+            
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: (ID数组 int64, 向量数组 float32 (n, d))
+        """
+        invlists = index.invlists
+        all_ids = []
+        all_codes = []
+        for list_no in range(index.nlist):
+            size = invlists.list_size(list_no)
+            if not size:
+                continue
+            ids_ptr = invlists.get_ids(list_no)
+            codes_ptr = invlists.get_codes(list_no)
+            all_ids.append(faiss.rev_swig_ptr(ids_ptr, size).copy())
+            all_codes.append(faiss.rev_swig_ptr(codes_ptr, size * invlists.code_size).copy())
+            invlists.release_ids(list_no, ids_ptr)
+            invlists.release_codes(list_no, codes_ptr)
+        if not all_ids:
+            return np.empty(0, dtype=np.int64), np.empty((0, index.d), dtype=np.float32)
+        return np.concatenate(all_ids), np.concatenate(all_codes).view(np.float32).reshape(-1, index.d)
+    
+    def _train_ivf_index(self, collection_name: str, index, vectors: np.ndarray, ids: Optional[np.ndarray] = None):
+        """
+        按集合全部向量的数量确定nlist，用这些真实向量训练IVF索引、写入全部向量并替换集合中的索引
+        
+        Args:
+            collection_name: 集合名称
+            index: 集合当前的索引（Flat或nlist偏小的IVFFlat）
+            vectors: 集合中的全部向量（C连续的float32二维数组）
+            ids: 各向量的ID，None表示按顺序为0..n-1（Flat索引）
+            
+        Returns:
+            训练并写入向量后的IVF索引
+        """
+        n = len(vectors)
+        nlist = self._ivf_nlist(n)
+        quantizer = faiss.IndexFlat(index.d, index.metric_type)
+        trained = faiss.IndexIVFFlat(quantizer, index.d, nlist, index.metric_type)
+        logger.info(f"使用 {n} 个向量训练集合 {collection_name} 的IVF索引，nlist={nlist}"
+                    f"（原为{getattr(index, 'nlist', 'Flat索引')}）")
+        trained.train(vectors)
+        if ids is None:
+            trained.add(vectors)
+        else:
+            trained.add_with_ids(vectors, ids)
+        self._mmap_indexes.pop(collection_name, None)
+        self._cache_index(collection_name, trained)
+        return trained
 
+    @_with_collection_lock
     def load_collection(self, collection_name: str) -> bool:
         """
         加载已有的向量集合
@@ -2051,6 +2941,7 @@ class FaissManager:
             bool: 加载是否成功
         """
         try:
+            self._flush_collection(collection_name)
             index_path = self._get_index_path(collection_name)
             metadata_path = self._get_metadata_path(collection_name)
             file_registry_path = self._get_file_registry_path(collection_name)
@@ -2065,7 +2956,7 @@ class FaissManager:
             try:
                 logger.info(f"加载索引文件: {index_path}")
                 index = faiss.read_index(index_path)
-                self.indexes[collection_name] = index
+                self._cache_index(collection_name, index)
             except Exception as e:
                 logger.error(f"加载索引 {collection_name} 失败: {str(e)}")
                 return False
@@ -2074,8 +2965,8 @@ class FaissManager:
             try:
                 logger.info(f"加载元数据文件: {metadata_path}")
                 if os.path.exists(metadata_path):
-                    with open(metadata_path, 'r', encoding='utf-8') as f:
-                        self.metadata[collection_name] = json.load(f)
+                    self.metadata[collection_name] = _load_json_file(metadata_path)
+                    _share_metadata_strings(self.metadata[collection_name])
                 else:
                     logger.warning(f"元数据文件不存在，创建空元数据")
                     self.metadata[collection_name] = []
@@ -2092,13 +2983,13 @@ class FaissManager:
             try:
                 logger.info(f"加载文件注册表: {file_registry_path}")
                 if os.path.exists(file_registry_path):
-                    with open(file_registry_path, 'r', encoding='utf-8') as f:
-                        self.file_registry[collection_name] = json.load(f)
+                    self.file_registry[collection_name] = _load_json_file(file_registry_path)
                 else:
                     logger.warning(f"文件注册表不存在，创建空注册表")
                     self.file_registry[collection_name] = {}
                     with open(file_registry_path, 'w', encoding='utf-8') as f:
                         json.dump({}, f)
+                self._replay_registry_log(collection_name)
             except Exception as e:
                 logger.error(f"加载文件注册表失败: {str(e)}")
                 # 移除已加载的数据
@@ -2109,18 +3000,9 @@ class FaissManager:
                 return False
             
             # 加载文件变更历史
-            try:
-                logger.info(f"加载文件变更历史: {file_history_path}")
-                if os.path.exists(file_history_path):
-                    with open(file_history_path, 'r', encoding='utf-8') as f:
-                        self.file_change_history[collection_name] = json.load(f)
-                else:
-                    logger.warning(f"文件变更历史不存在，创建空历史记录")
-                    self.file_change_history[collection_name] = []
-                    with open(file_history_path, 'w', encoding='utf-8') as f:
-                        json.dump([], f)
-            except Exception as e:
-                logger.error(f"加载文件变更历史失败: {str(e)}")
+            logger.info(f"加载文件变更历史: {file_history_path}")
+            if not self._load_file_history(collection_name):
+                logger.error(f"加载文件变更历史失败: {file_history_path}")
                 # 移除已加载的数据
                 if collection_name in self.indexes:
                     del self.indexes[collection_name]
@@ -2150,9 +3032,7 @@ class FaissManager:
         Returns:
             Dict: 修复结果报告
         """
-        import pickle
         import glob
-        import os
         
         logger.info("开始修复集合文件格式...")
         results = {}
@@ -2174,24 +3054,23 @@ class FaissManager:
             metadata_path = self._get_metadata_path(name)
             if os.path.exists(metadata_path):
                 try:
-                    # 尝试以pickle格式加载
-                    with open(metadata_path, 'rb') as f:
+                    # 尝试以pickle格式加载（FAISS_DISALLOW_PICKLE=1时直接按JSON检查）
+                    try:
+                        metadata = _load_legacy_pickle(metadata_path)
+                        # 以JSON格式保存
+                        with open(metadata_path, 'w', encoding='utf-8') as jf:
+                            json.dump(metadata, jf)
+                        logger.info(f"成功将元数据从pickle转换为JSON: {metadata_path}")
+                        results[name]["metadata"] = True
+                    except Exception as e:
+                        # 如果pickle加载失败，尝试JSON格式
                         try:
-                            metadata = pickle.load(f)
-                            # 以JSON格式保存
-                            with open(metadata_path, 'w', encoding='utf-8') as jf:
-                                json.dump(metadata, jf)
-                            logger.info(f"成功将元数据从pickle转换为JSON: {metadata_path}")
+                            with open(metadata_path, 'r', encoding='utf-8') as jf:
+                                json.load(jf)
+                            logger.info(f"元数据已经是JSON格式: {metadata_path}")
                             results[name]["metadata"] = True
-                        except Exception as e:
-                            # 如果pickle加载失败，尝试JSON格式
-                            try:
-                                with open(metadata_path, 'r', encoding='utf-8') as jf:
-                                    json.load(jf)
-                                logger.info(f"元数据已经是JSON格式: {metadata_path}")
-                                results[name]["metadata"] = True
-                            except Exception as je:
-                                logger.error(f"元数据文件无法修复: {str(je)}")
+                        except Exception as je:
+                            logger.error(f"元数据文件无法修复: {str(je)}")
                 except Exception as e:
                     logger.error(f"处理元数据时出错: {str(e)}")
             
@@ -2199,55 +3078,54 @@ class FaissManager:
             registry_path = self._get_file_registry_path(name)
             if os.path.exists(registry_path):
                 try:
-                    # 尝试以pickle格式加载
-                    with open(registry_path, 'rb') as f:
+                    # 尝试以pickle格式加载（FAISS_DISALLOW_PICKLE=1时直接按JSON检查）
+                    try:
+                        registry = _load_legacy_pickle(registry_path)
+                        # 以JSON格式保存
+                        with open(registry_path, 'w', encoding='utf-8') as jf:
+                            json.dump(registry, jf)
+                        logger.info(f"成功将文件注册表从pickle转换为JSON: {registry_path}")
+                        results[name]["file_registry"] = True
+                    except Exception as e:
+                        # 如果pickle加载失败，尝试JSON格式
                         try:
-                            registry = pickle.load(f)
-                            # 以JSON格式保存
-                            with open(registry_path, 'w', encoding='utf-8') as jf:
-                                json.dump(registry, jf)
-                            logger.info(f"成功将文件注册表从pickle转换为JSON: {registry_path}")
+                            with open(registry_path, 'r', encoding='utf-8') as jf:
+                                json.load(jf)
+                            logger.info(f"文件注册表已经是JSON格式: {registry_path}")
                             results[name]["file_registry"] = True
-                        except Exception as e:
-                            # 如果pickle加载失败，尝试JSON格式
-                            try:
-                                with open(registry_path, 'r', encoding='utf-8') as jf:
-                                    json.load(jf)
-                                logger.info(f"文件注册表已经是JSON格式: {registry_path}")
-                                results[name]["file_registry"] = True
-                            except Exception as je:
-                                logger.error(f"文件注册表无法修复: {str(je)}")
+                        except Exception as je:
+                            logger.error(f"文件注册表无法修复: {str(je)}")
                 except Exception as e:
                     logger.error(f"处理文件注册表时出错: {str(e)}")
             
-            # 修复文件历史
-            history_path = self._get_file_history_path(name)
+            # 修复文件历史（仅旧版整体格式可能为pickle，加载时再迁移为JSON Lines）
+            history_path = self._get_legacy_file_history_path(name)
             if os.path.exists(history_path):
                 try:
-                    # 尝试以pickle格式加载
-                    with open(history_path, 'rb') as f:
+                    # 尝试以pickle格式加载（FAISS_DISALLOW_PICKLE=1时直接按JSON检查）
+                    try:
+                        history = _load_legacy_pickle(history_path)
+                        # 以JSON格式保存
+                        with open(history_path, 'w', encoding='utf-8') as jf:
+                            json.dump(history, jf)
+                        logger.info(f"成功将文件历史从pickle转换为JSON: {history_path}")
+                        results[name]["file_history"] = True
+                    except Exception as e:
+                        # 如果pickle加载失败，尝试JSON格式
                         try:
-                            history = pickle.load(f)
-                            # 以JSON格式保存
-                            with open(history_path, 'w', encoding='utf-8') as jf:
-                                json.dump(history, jf)
-                            logger.info(f"成功将文件历史从pickle转换为JSON: {history_path}")
+                            with open(history_path, 'r', encoding='utf-8') as jf:
+                                json.load(jf)
+                            logger.info(f"文件历史已经是JSON格式: {history_path}")
                             results[name]["file_history"] = True
-                        except Exception as e:
-                            # 如果pickle加载失败，尝试JSON格式
-                            try:
-                                with open(history_path, 'r', encoding='utf-8') as jf:
-                                    json.load(jf)
-                                logger.info(f"文件历史已经是JSON格式: {history_path}")
-                                results[name]["file_history"] = True
-                            except Exception as je:
-                                logger.error(f"文件历史无法修复: {str(je)}")
+                        except Exception as je:
+                            logger.error(f"文件历史无法修复: {str(je)}")
                 except Exception as e:
                     logger.error(f"处理文件历史时出错: {str(e)}")
                     
         logger.info(f"集合文件修复完成: {results}")
         return results
 
+    @_with_collection_lock
     def synchronize_index_and_metadata(self, collection_name):
         """
         同步索引和元数据，确保它们一致
@@ -2323,6 +3201,7 @@ class FaissManager:
             logger.exception(e)
             return False
 
+    @_with_collection_lock
     def diagnose_and_repair_kb(self, collection_name: str) -> Dict:
         """
         诊断知识库的索引和元数据，尝试发现并修复不一致问题
@@ -2460,6 +3339,7 @@ class FaissManager:
             
         return result
 
+    @_with_collection_lock
     def diagnose_knowledge_base(self, collection_name: str) -> Dict[str, Any]:
         """
         诊断知识库是否存在数据一致性问题
@@ -2504,9 +3384,12 @@ class FaissManager:
             }
             
             # 检查文件是否存在
-            result["index_exists"] = os.path.exists(index_path) and os.path.getsize(index_path) > 0
-            result["metadata_exists"] = os.path.exists(metadata_path) and os.path.getsize(metadata_path) > 0
-            result["file_registry_exists"] = os.path.exists(registry_path) and os.path.getsize(registry_path) > 0
+            index_st = _stat_or_none(index_path)
+            metadata_st = _stat_or_none(metadata_path)
+            registry_st = _stat_or_none(registry_path)
+            result["index_exists"] = bool(index_st and index_st.st_size > 0)
+            result["metadata_exists"] = bool(metadata_st and metadata_st.st_size > 0)
+            result["file_registry_exists"] = bool(registry_st and registry_st.st_size > 0)
             
             # 加载索引和元数据
             index = None
@@ -2563,6 +3446,7 @@ class FaissManager:
             result["issues"].append(f"诊断过程发生错误: {str(e)}")
             return result
             
+    @_with_collection_lock
     def repair_knowledge_base(self, collection_name: str) -> Dict[str, Any]:
         """
         修复知识库的数据一致性问题
@@ -2836,6 +3720,7 @@ class FaissManager:
             "results": results
         }
 
+    @_with_collection_lock
     def check_and_fix_collection_consistency(self, collection_name: str) -> bool:
         """
         检查集合的索引和元数据是否一致，如果不一致则尝试修复
@@ -0,0 +1,75 @@
+import numpy as np
+
+# numba为可选依赖，未安装时退化为numpy实现
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+    @njit(fastmath=True, cache=True)
+    def _normalize_1d(vector):
+        norm = 0.0
+        for i in range(vector.shape[0]):
+            norm += vector[i] * vector[i]
+        norm = np.sqrt(norm)
+        out = np.empty_like(vector)
+        if norm == 0.0:
+            out[:] = vector
+            return out
+        for i in range(vector.shape[0]):
+            out[i] = vector[i] / norm
+        return out
+
+    # 不用parallel：各上传线程会并发调用，workqueue线程层并发进入并行区域会终止进程
+    @njit(fastmath=True, cache=True)
+    def _normalize_2d(matrix):
+        n, d = matrix.shape
+        out = np.empty_like(matrix)
+        for r in range(n):
+            norm = 0.0
+            for c in range(d):
+                norm += matrix[r, c] * matrix[r, c]
+            norm = np.sqrt(norm)
+            if norm == 0.0:
+                norm = 1.0
+            for c in range(d):
+                out[r, c] = matrix[r, c] / norm
+        return out
+else:
+    def _normalize_1d(vector):
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector.copy()
+
+    def _normalize_2d(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+
+def normalize_vector(vector) -> np.ndarray:
+    """
+    L2归一化单个向量
+
+    参数:
+        vector: 一维向量
+
+    返回:
+        np.ndarray: 归一化后的float32向量，零向量原样返回
+    """
+    return _normalize_1d(np.ascontiguousarray(vector, dtype=np.float32))
+
+
+def normalize_rows(matrix) -> np.ndarray:
+    """
+    按行L2归一化向量矩阵
+
+    参数:
+        matrix: 二维向量矩阵，每行一个向量
+
+    返回:
+        np.ndarray: 归一化后的float32矩阵，零向量行原样返回
+    """
+    return _normalize_2d(np.ascontiguousarray(matrix, dtype=np.float32))
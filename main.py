@@ -5,7 +5,7 @@ from typing import List, Dict, Any, Tuple, Optional
 
 # 导入自定义模块
 from core.faiss_connect import FaissManager, DataLineageTracker
-from core.embbeding_model import get_embedding
+from core.embbeding_model import get_embedding, get_embeddings
 from core.rerank_model import reranker, load_rerank_model
 from core.chunker.chunker_main import DocumentChunker, ChunkMethod
 # from core.file_read.file_handle import FileHandler
@@ -47,6 +47,18 @@ class DocumentProcessor:
         """
         return self.file_handler.process_file(file_path)
     
+    def extract_text(self, file_path: str) -> Dict[str, Any]:
+        """
+        提取文件文本，不进行分块
+        
+        Args:
+            file_path: 文件路径
+            
+        Returns:
+            Dict: 文件信息，content字段为提取出的文本
+        """
+        return self.process_file(file_path)
+    
     def chunk_document(self, document: str, progress_callback=None) -> List[Dict[str, Any]]:
         """
         对文档内容进行分块
@@ -251,7 +263,7 @@ class RAGService:
         Args:
             kb_name: 知识库名称
             dimension: 向量维度，默认为512（与embedding模型匹配）
-            index_type: 索引类型，支持"Flat"、"IVF"、"HNSW"
+            index_type: 索引类型，支持"Flat"、"IVF"、"HNSW"、"SQ8"
             
         Returns:
             bool: 创建是否成功
@@ -356,6 +368,55 @@ class RAGService:
                 progress_callback(100, f"添加失败：{str(e)}")
             return False
     
+    def add_documents_bulk(self, kb_name: str, file_documents: List[List[Dict[str, Any]]]) -> List[bool]:
+        """
+        批量向知识库添加多个文件的文档，所有文本一次性批量生成向量
+        
+        Args:
+            kb_name: 知识库名称
+            file_documents: 每个文件分块后的文档列表
+            
+        Returns:
+            List[bool]: 每个文件是否添加成功
+        """
+        if not self.vector_db.collection_exists(kb_name):
+            logger.error(f"知识库 {kb_name} 不存在")
+            return [False] * len(file_documents)
+            
+        try:
+            texts = [doc.get("text", "") for documents in file_documents for doc in documents]
+            vectors = get_embeddings(texts)
+        except Exception as e:
+            logger.error(f"向知识库 {kb_name} 批量生成向量失败: {str(e)}")
+            return [False] * len(file_documents)
+        
+        # 文件注册表按文件记录向量，因此按文件分段写入，但索引等文件只在最后写入一次
+        results = []
+        offset = 0
+        with self.vector_db.batch_writes(kb_name):
+            for documents in file_documents:
+                file_vectors = vectors[offset:offset + len(documents)]
+                offset += len(documents)
+                if not documents:
+                    # 空文件会被 add_vectors 当作成功并生成系统文件名，直接报告失败
+                    logger.warning(f"向知识库 {kb_name} 添加的文件没有任何文档，跳过")
+                    results.append(False)
+                    continue
+                try:
+                    result = self.vector_db.add_vectors(kb_name, file_vectors, documents)
+                    results.append(result.get("status") == "success")
+                except Exception as e:
+                    logger.error(f"向知识库 {kb_name} 添加文档失败: {str(e)}")
+                    results.append(False)
+            
+            # 在块内显式写入，以便保存失败时所有文件都报告失败
+            if not self.vector_db.flush(kb_name):
+                logger.error(f"保存知识库 {kb_name} 失败")
+                results = [False] * len(results)
+        
+        # 内存中的集合已是最新状态且已写入文件，无需重新创建管理器（会丢弃所有已加载的索引）
+        return results
+    
     def add_file(self, kb_name: str, file_path: str, progress_callback=None, check_duplicates: bool = True) -> bool:
         """
         处理文件并添加到知识库
@@ -411,6 +472,10 @@ class RAGService:
         """获取知识库中的所有文件信息"""
         return self.vector_db.list_files(kb_name)
         
+    def file_exists(self, kb_name: str, file_name: str) -> bool:
+        """检查知识库中是否存在指定文件"""
+        return self.vector_db.file_exists(kb_name, file_name)
+        
     def update_file_importance(self, kb_name: str, file_name: str, importance_factor: float) -> bool:
         """更新文件的重要性系数
         
@@ -3,7 +3,6 @@ import gradio as gr
 import pandas as pd
 import traceback
 import requests
-import json
 import time
 import sys
 import locale
@@ -268,18 +267,13 @@ class RAGServiceWebUI:
         try:
             # 打开文件
             with open(file_path, "rb") as file:
-                # 创建分块配置
-                chunk_config = {
-                    "method": chunk_method,
-                    "chunk_size": chunk_size,
-                    "chunk_overlap": chunk_overlap
-                }
-                
-                # 创建表单数据
+                # 创建表单数据（分块配置作为独立表单字段提交）
                 form_data = {
                     "kb_name": kb_name,
                     "file_to_replace": file_to_replace,
-                    "chunk_config": json.dumps(chunk_config)
+                    "method": chunk_method,
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": chunk_overlap
                 }
                 
                 # 添加文件
@@ -367,14 +361,12 @@ class RAGServiceWebUI:
             # 创建分块配置
             chunk_method = "text_semantic"
             
-            chunk_config = {
+            # 添加分块配置（作为独立表单字段提交）
+            form_data.update({
                 "method": chunk_method,
                 "chunk_size": chunk_size,
                 "chunk_overlap": chunk_overlap
-            }
-            
-            # 添加分块配置
-            form_data["chunk_config"] = json.dumps(chunk_config)
+            })
             
             # 添加文件
             form_files = []
@@ -1209,7 +1201,7 @@ class RAGServiceWebUI:
                                 gr.Markdown("### 创建知识库")
                                 kb_name = gr.Textbox(label="知识库名称", placeholder="输入新知识库名称...", lines=1)
                                 dimension = gr.Slider(label="向量维度", minimum=128, maximum=1024, step=128, value=512)
-                                index_type = gr.Dropdown(label="索引类型", choices=["Flat", "IVF", "HNSW"], value="Flat")
+                                index_type = gr.Dropdown(label="索引类型", choices=["Flat", "IVF", "HNSW", "SQ8"], value="Flat")
                                 with gr.Row():
                                     create_kb_btn = gr.Button("创建知识库", variant="primary")
                                     refresh_kb_btn = gr.Button("刷新列表", variant="secondary")